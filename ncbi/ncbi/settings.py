@@ -82,6 +82,20 @@ DATABASES = {
     }
 }
 
+# Caches
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+# query/cache.py keeps serialized papers and query result pages here. The
+# local-memory cache is per process; use a file-based (or shared) cache to
+# let runjobs workers invalidate what the web server has cached.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ncbi',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
@@ -101,3 +115,41 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.8/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# NCBI connector
+
+# Process-local cache for journal, country, agency and MeSH lookups during
+# ingestion. Use 'query.lookup.NullCache' to disable it.
+NCBI_LOOKUP_CACHE = 'query.lookup.LRUCache'
+NCBI_LOOKUP_CACHE_SIZE = 10000
+
+# E-utilities transport; see query/transport.py. With an API key NCBI allows
+# 10 requests per second instead of 3. Set NCBI_RATE_LIMIT_FILE to share the
+# rate limit between worker processes on the same host.
+NCBI_API_KEY = os.environ.get('NCBI_API_KEY')
+NCBI_RATE_LIMIT_FILE = None
+NCBI_MAX_RETRIES = 5
+
+# Raw response archive; see query/archive.py. Archived EFetch records younger
+# than NCBI_ARCHIVE_TTL days are used instead of the network (None: never).
+NCBI_ARCHIVE_ROOT = None
+NCBI_ARCHIVE_TTL = None
+
+# Per-stage metrics, exported at /metrics; see query/metrics.py. Use
+# 'query.metrics.FileMetrics' with NCBI_METRICS_FILE to include the metrics
+# of runjobs workers. Set NCBI_PROFILE_DIR to dump a cProfile file per job.
+NCBI_METRICS = 'query.metrics.Metrics'
+NCBI_METRICS_FILE = None
+# Serves /metrics without a staff login, e.g. to a Prometheus scraper on a
+# private network.
+NCBI_METRICS_PUBLIC = False
+NCBI_PROFILE_DIR = None
+
+# Read-through cache of papers and query results; see query/cache.py.
+NCBI_CACHE = 'default'
+NCBI_CACHE_TIMEOUT = 3600
+
+# XML parser for E-utilities responses; see query/extract.py. 'lxml' is
+# faster, if lxml is installed.
+NCBI_XML_PARSER = 'etree'
@@ -16,6 +16,14 @@ Including another URLconf
 from django.conf.urls import include, url
 from django.contrib import admin
 
+from query import api, views as query_views
+
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^metrics$', query_views.metrics, name='metrics'),
+    url(r'^api/queries/(?P<pk>\d+)/papers$', api.query_papers,
+        name='api_query_papers'),
+    url(r'^api/(?P<resource>\w+)$', api.listing, name='api_list'),
+    url(r'^api/(?P<resource>\w+)/(?P<pk>\d+)$', api.detail,
+        name='api_detail'),
 ]
@@ -1,45 +1,172 @@
+from django.conf.urls import url
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
 from django import forms
-from query.models import Query, Paper
-from query.connector import PubMedManager, PMCManager
+from django.db import connections
+from django.db.models import Count, Max, Prefetch
+from django.http import JsonResponse, StreamingHttpResponse
+from query.models import Query, Paper, Job, Grant, MeSHHeading
+from query import jobs, search
+from query.export import FORMATS, export
 from django.utils.translation import ugettext_lazy as _
-from datetime import datetime
-
-def get_manager(dbname):
-    dbManagers = [
-        ('PubMed', PubMedManager),
-        ('PMC', PMCManager),
-    ]
-    return dict(dbManagers)[dbname]
 
 def execute(modeladmin, request, queryset):
+    count = 0
     for obj in queryset:
-        manager = get_manager(obj.database)()
-        manager.search(obj)
-        obj.executed = True
-        obj.executed_on = datetime.now()
-        obj.save()
+        jobs.enqueue(Job.EXECUTE, obj.database, query=obj, user=request.user)
+        count += 1
+    modeladmin.message_user(request, "Queued %i queries for execution" % count)
 
 execute.short_description = "Execute selected queries"
 
-def retrieve(modeladmin, request, queryset):
+def refresh(modeladmin, request, queryset):
+    count = 0
     for obj in queryset:
-        manager = get_manager(obj.source)()
-        if not obj.retrieved:
-            paper = manager.fetch(obj.identifier)
-            paper.retrieved = True
-            paper.save()
+        jobs.enqueue(Job.REFRESH, obj.database, query=obj, user=request.user)
+        count += 1
+    modeladmin.message_user(request, "Queued %i queries for refresh" % count)
+refresh.short_description = "Refresh selected queries (new and changed records)"
+
+def retrieve_results(modeladmin, request, queryset):
+    count = 0
+    for obj in queryset.filter(executed=True):
+        jobs.enqueue(Job.RETRIEVE, obj.database, query=obj, user=request.user)
+        count += 1
+    modeladmin.message_user(request,
+                            "Queued results of %i queries for retrieval" % count)
+retrieve_results.short_description = "Retrieve results of selected queries"
+
+def retrieve(modeladmin, request, queryset):
+    pending = queryset.filter(retrieved=False)
+    count = 0
+    for source in pending.values_list('source', flat=True).distinct():
+        identifiers = pending.filter(source=source).values_list('identifier',
+                                                                flat=True)
+        job = jobs.enqueue(Job.RETRIEVE, source, identifiers=identifiers,
+                           user=request.user)
+        count += len(job.identifiers)
+    modeladmin.message_user(request, "Queued %i papers for retrieval" % count)
 retrieve.short_description = "Retrieve selected papers"
 
+def export_action(format):
+    def export_results(modeladmin, request, queryset):
+        papers = Paper.objects.filter(query__in=queryset).distinct()
+        content_type, writer = FORMATS[format]
+        response = StreamingHttpResponse(export(papers, format),
+                                         content_type=content_type)
+        filename = 'results.{0}'.format(format)
+        response['Content-Disposition'] = \
+            'attachment; filename="{0}"'.format(filename)
+        return response
+    export_results.__name__ = 'export_{0}'.format(format)
+    export_results.short_description = \
+        "Export results of selected queries ({0})".format(format)
+    return export_results
+
+
+def estimated_count(queryset):
+    """
+    Cheap estimate of the number of rows in the table behind ``queryset``:
+    the planner statistics on PostgreSQL, otherwise the largest primary key.
+    """
+    model = queryset.model
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [model._meta.db_table])
+            row = cursor.fetchone()
+        return int(row[0]) if row else 0
+    return model._default_manager.using(queryset.db) \
+                .aggregate(Max('pk'))['pk__max'] or 0
+
+
+class ApproximatePaginator(Paginator):
+    """
+    Uses :func:`estimated_count` instead of ``COUNT(*)`` for unfiltered
+    changelists of large tables. Filtered changelists are counted exactly.
+    """
+    threshold = 10000
+
+    def _get_count(self):
+        if self._count is None:
+            query = self.object_list.query
+            if not query.where and not query.distinct:
+                estimate = estimated_count(self.object_list)
+                if estimate > self.threshold:
+                    self._count = estimate
+                    return self._count
+            self._count = self.object_list.count()
+        return self._count
+    count = property(_get_count)
+
+
+class QueryChangeList(ChangeList):
+    """
+    Annotates the queries on the current page with their result counts and
+    latest jobs, with one query each for the whole page.
+    """
+    def get_results(self, request):
+        super(QueryChangeList, self).get_results(request)
+        queries = list(self.result_list)
+        ids = [query.pk for query in queries]
+
+        through = Query.results.through
+        counts = dict(through.objects.filter(query__in=ids)
+                                     .values('query')
+                                     .annotate(count=Count('paper'))
+                                     .values_list('query', 'count'))
+        latest = Job.objects.filter(query__in=ids).values('query') \
+                            .annotate(latest=Max('pk')).values('latest')
+        latest_jobs = dict([(job.query_id, job) for job
+                            in Job.objects.filter(pk__in=latest)])
+        for query in queries:
+            query.results_count = counts.get(query.pk, 0)
+            query.latest_job = latest_jobs.get(query.pk)
+
 
 class QueryAdmin(admin.ModelAdmin):
-    readonly_fields = ['created_by', 'created_on', 'executed', 'executed_on']
-    exclude = ['results']
+    readonly_fields = ['created_by', 'created_on', 'executed', 'executed_on',
+                       'result_count']
+    exclude = ['results', 'webenv', 'query_key']
     list_display = ['database', 'querystring', 'created_by', 'created_on',
-                    'executed', 'executed_on']
+                    'executed', 'executed_on', 'results_link', 'status']
     list_display_links =['querystring']
     list_filter = ['database', 'created_by', 'executed']
-    actions = [execute]
+    list_select_related = ['created_by']
+    search_fields = ['querystring']
+    paginator = ApproximatePaginator
+    show_full_result_count = False
+    actions = [execute, refresh, retrieve_results] + \
+              [export_action(format) for format in FORMATS]
+
+    def get_changelist(self, request, **kwargs):
+        return QueryChangeList
+
+    def get_urls(self):
+        urls = [
+            url(r'^autocomplete/$',
+                self.admin_site.admin_view(self.autocomplete_view),
+                name='query_query_autocomplete'),
+        ]
+        return urls + super(QueryAdmin, self).get_urls()
+
+    def autocomplete_view(self, request):
+        """
+        Returns up to 20 of the latest queries matching ``term``, as JSON.
+        """
+        queries = self.get_queryset(request).order_by('-pk')
+        term = request.GET.get('term', '').strip()
+        if term.isdigit():
+            queries = queries.filter(pk=term)
+        elif term:
+            queries = queries.filter(querystring__icontains=term)
+        return JsonResponse({'results': [
+            {'id': query.pk, 'text': query_label(query)}
+            for query in queries.only('database', 'querystring',
+                                      'executed_on')[:20]]})
 
     def save_model(self, request, obj, form, change):
         obj.created_by = request.user
@@ -53,19 +180,42 @@ class QueryAdmin(admin.ModelAdmin):
         return super(QueryAdmin, self).get_form(request, obj, **kwargs)
 
 
+def query_label(query):
+    return u'{db}: {qstring} on {exec_on}'.format(
+        db=query.database, qstring=query.querystring,
+        exec_on=query.executed_on)
+
+
 class QueryListFilter(admin.SimpleListFilter):
+    """
+    Filters papers by query. Lists only the most recent queries, and the
+    selected one; others are found with the autocomplete box.
+    """
     title = _('query')
     parameter_name = 'query'
+    template = 'admin/query/paper/query_filter.html'
+    limit = 10
 
     def lookups(self, request, model_admin):
-        queryname = '{db}: {qstring} on {exec_on}'
-        qname = lambda q: queryname.format(db=q.database, qstring=q.querystring,
-                                           exec_on=q.executed_on)
-        return tuple([(q.id, qname(q)) for q in Query.objects.all()])
+        queries = Query.objects.only('database', 'querystring', 'executed_on')
+        choices = [(unicode(q.id), query_label(q))
+                   for q in queries.order_by('-pk')[:self.limit]]
+        value = self.value()
+        if value and value not in [choice[0] for choice in choices]:
+            selected = queries.filter(pk=value).first() \
+                       if value.isdigit() else None
+            if selected is not None:
+                choices.insert(0, (value, query_label(selected)))
+        return choices
+
+    def choices(self, cl):
+        # Lets the template add the selected query to the other parameters.
+        self.query_string = cl.get_query_string(remove=[self.parameter_name])
+        return super(QueryListFilter, self).choices(cl)
 
     def queryset(self, request, queryset):
         if self.value():
-            return Paper.objects.filter(query=self.value())
+            return queryset.filter(query=self.value())
 
 class PaperAdmin(admin.ModelAdmin):
     list_display = ['identifier', 'title', 'retrieved']
@@ -74,10 +224,67 @@ class PaperAdmin(admin.ModelAdmin):
     readonly_fields = ['identifier', 'title', 'published_in', 'pubdate',
                        'source', 'mesh_headings', 'abstract', 'authors',
                        'funding', 'retrieved']
+    search_fields = ['title']
+    paginator = ApproximatePaginator
+    show_full_result_count = False
     actions = [retrieve]
 
+    def get_search_results(self, request, queryset, search_term):
+        # Uses the full-text index where there is one; see query.search.
+        # Matches are ranked unless the list is sorted by a column. A search
+        # with no words matches nothing, and has no rank to order by.
+        if search_term:
+            matching = search.matching(queryset, search_term)
+            if matching is not None:
+                if ('search_rank' in matching.query.extra_select
+                        and ORDER_VAR not in request.GET):
+                    matching = matching.order_by('search_rank', '-pk')
+                return matching, False
+        return super(PaperAdmin, self).get_search_results(request, queryset,
+                                                          search_term)
+
+    def get_object(self, request, object_id, from_field=None):
+        # Fetches the related rows shown as read-only fields up front,
+        # rather than with a query per field and per MeSH heading.
+        queryset = self.get_queryset(request).select_related('published_in') \
+            .prefetch_related(
+                'authors',
+                Prefetch('mesh_headings', queryset=MeSHHeading.objects
+                         .select_related('descriptor', 'qualifier')),
+                Prefetch('funding', queryset=Grant.objects
+                         .select_related('awarded_by')))
+        field = Paper._meta.pk if from_field is None \
+                else Paper._meta.get_field(from_field)
+        try:
+            object_id = field.to_python(object_id)
+            return queryset.get(**{field.name: object_id})
+        except (Paper.DoesNotExist, ValidationError, ValueError):
+            return None
+
+
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['__unicode__', 'query', 'source', 'status', 'progress',
+                    'created_by', 'created_on', 'started_on', 'finished_on']
+    list_filter = ['status', 'kind', 'source']
+    list_select_related = ['query', 'created_by']
+    readonly_fields = ['kind', 'status', 'query', 'source', 'identifiers',
+                       'created_by', 'created_on', 'started_on', 'updated_on',
+                       'finished_on', 'worker', 'fetched', 'total', 'progress',
+                       'error']
+    change_list_template = 'admin/query/job/change_list.html'
+
+    def has_add_permission(self, request):
+        return False
 
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['refresh'] = Job.objects.filter(
+            status__in=[Job.PENDING, Job.RUNNING]).exists()
+        return super(JobAdmin, self).changelist_view(request, extra_context)
 
 
 admin.site.register(Query, QueryAdmin)
 admin.site.register(Paper, PaperAdmin)
+admin.site.register(Job, JobAdmin)
@@ -0,0 +1,390 @@
+"""
+Read-only JSON API over queries, papers, authors, MeSH headings and grants.
+
+Each resource is listed at ``/api/<resource>`` and served one at a time at
+``/api/<resource>/<id>``; the papers in the results of a query are listed at
+``/api/queries/<id>/papers``. Lists take these parameters:
+
+``after``
+    The ``next`` cursor of the previous page. Lists are ordered by ID, and
+    each page is the next ``limit`` rows after the cursor, so every page
+    costs the same index range scan however deep it is, unlike an offset.
+``limit``
+    Rows per page, at most :data:`MAX_LIMIT`.
+``fields``
+    Comma-separated names of the fields to include (``id`` always is).
+    Only the columns and related rows behind those fields are loaded;
+    related rows are prefetched with one query per relation per page.
+    Papers with all of their fields are read through :mod:`query.cache`.
+
+Responses carry an ``ETag``; a request whose ``If-None-Match`` matches gets
+``304 Not Modified`` without a body.
+
+Like the admin, the API is for active staff users only; other requests are
+redirected to the admin login.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.views.decorators.http import require_safe
+
+from . import cache
+from .ingest import chunked
+from .models import Grant, MeSHHeading, Paper, Person, Query
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Resource(object):
+    """
+    How a model is exposed: ``fields`` maps each field name to a function of
+    an instance, in output order; ``columns``, ``select`` and ``prefetch``
+    map field names to the columns, ``select_related`` paths and
+    ``prefetch_related`` lookups that the field needs. Fields that are not
+    in ``columns`` need the column of the same name.
+
+    Objects of a ``cached`` resource are read through :mod:`query.cache`
+    when all of their fields are wanted.
+    """
+    model = None
+    fields = OrderedDict()
+    columns = {}
+    select = {}
+    prefetch = {}
+    cached = False
+
+    def get_queryset(self):
+        return self.model.objects.all()
+
+    def parse_fields(self, value):
+        if not value:
+            return self.fields.keys()
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise BadRequest('Unknown fields: {0}; expected some of {1}'
+                             .format(', '.join(unknown),
+                                     ', '.join(self.fields)))
+        # In the order of the resource, with id first.
+        return [name for name in self.fields
+                if name == 'id' or name in names]
+
+    def restrict(self, queryset, fields):
+        """
+        Loads only what ``fields`` need.
+        """
+        columns, select, prefetch = ['pk'], [], []
+        for name in fields:
+            columns.extend(self.columns.get(name, [name]))
+            select.extend(self.select.get(name, []))
+            prefetch.extend(self.prefetch.get(name, []))
+        queryset = queryset.only(*columns)
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+    def serialize(self, obj, fields):
+        return OrderedDict([(name, self.fields[name](obj)) for name in fields])
+
+    def load(self, pks):
+        """
+        Returns a dict mapping each of ``pks`` that exists to its object,
+        serialized with all of its fields.
+        """
+        fields = self.fields.keys()
+        queryset = self.restrict(self.get_queryset(), fields)
+        records = {}
+        for chunk in chunked(pks):
+            for obj in queryset.filter(pk__in=chunk):
+                records[obj.pk] = self.serialize(obj, fields)
+        return records
+
+    def read_through(self, fields):
+        return self.cached and fields == self.fields.keys()
+
+
+def _journal(paper):
+    journal = paper.published_in
+    if journal is None:
+        return None
+    return OrderedDict([('id', journal.pk), ('title', journal.title),
+                        ('issn', journal.issn)])
+
+
+def _person(person):
+    return OrderedDict([('id', person.pk), ('fore_name', person.fore_name),
+                        ('last_name', person.last_name),
+                        ('initials', person.initials)])
+
+
+def _heading(heading):
+    return OrderedDict([
+        ('id', heading.pk),
+        ('descriptor', heading.descriptor.descriptor),
+        ('ui', heading.descriptor.ui),
+        ('qualifier', heading.qualifier.subheading if heading.qualifier
+                      else None),
+    ])
+
+
+def _grant(grant):
+    agency = grant.awarded_by
+    return OrderedDict([('id', grant.pk), ('grant_id', grant.grant_id),
+                        ('acronym', grant.acronym), ('agency', agency.name),
+                        ('country', agency.country.name)])
+
+
+class QueryResource(Resource):
+    model = Query
+    fields = OrderedDict([
+        ('id', lambda query: query.pk),
+        ('database', lambda query: query.database),
+        ('querystring', lambda query: query.querystring),
+        ('created_by', lambda query: query.created_by_id),
+        ('created_on', lambda query: query.created_on),
+        ('executed', lambda query: query.executed),
+        ('executed_on', lambda query: query.executed_on),
+        ('result_count', lambda query: query.result_count),
+    ])
+    columns = {'created_by': ['created_by_id']}
+
+
+class PaperResource(Resource):
+    model = Paper
+    cached = True
+    fields = OrderedDict([
+        ('id', lambda paper: paper.pk),
+        ('identifier', lambda paper: paper.identifier),
+        ('source', lambda paper: paper.source),
+        ('retrieved', lambda paper: paper.retrieved),
+        ('title', lambda paper: paper.title),
+        ('abstract', lambda paper: paper.abstract),
+        ('pubdate', lambda paper: paper.pubdate),
+        ('journal', _journal),
+        ('authors', lambda paper: [_person(person)
+                                   for person in paper.authors.all()]),
+        ('mesh_headings', lambda paper: [_heading(heading) for heading
+                                         in paper.mesh_headings.all()]),
+        ('grants', lambda paper: [_grant(grant)
+                                  for grant in paper.funding.all()]),
+    ])
+    columns = {
+        'journal': ['published_in__title', 'published_in__issn'],
+        'authors': [],
+        'mesh_headings': [],
+        'grants': [],
+    }
+    select = {'journal': ['published_in']}
+    prefetch = {
+        'authors': ['authors'],
+        'mesh_headings': [Prefetch('mesh_headings',
+                                   queryset=MeSHHeading.objects.select_related(
+                                       'descriptor', 'qualifier'))],
+        'grants': [Prefetch('funding', queryset=Grant.objects.select_related(
+            'awarded_by__country'))],
+    }
+
+
+class PersonResource(Resource):
+    model = Person
+    fields = OrderedDict([
+        ('id', lambda person: person.pk),
+        ('fore_name', lambda person: person.fore_name),
+        ('last_name', lambda person: person.last_name),
+        ('initials', lambda person: person.initials),
+    ])
+
+
+class HeadingResource(Resource):
+    model = MeSHHeading
+    fields = OrderedDict([
+        ('id', lambda heading: heading.pk),
+        ('descriptor', lambda heading: heading.descriptor.descriptor),
+        ('ui', lambda heading: heading.descriptor.ui),
+        ('qualifier', lambda heading: heading.qualifier.subheading
+                                      if heading.qualifier else None),
+    ])
+    columns = {
+        'descriptor': ['descriptor__descriptor'],
+        'ui': ['descriptor__ui'],
+        'qualifier': ['qualifier__subheading'],
+    }
+    select = {
+        'descriptor': ['descriptor'],
+        'ui': ['descriptor'],
+        'qualifier': ['qualifier'],
+    }
+
+
+class GrantResource(Resource):
+    model = Grant
+    fields = OrderedDict([
+        ('id', lambda grant: grant.pk),
+        ('grant_id', lambda grant: grant.grant_id),
+        ('acronym', lambda grant: grant.acronym),
+        ('agency', lambda grant: grant.awarded_by.name),
+        ('country', lambda grant: grant.awarded_by.country.name),
+    ])
+    columns = {
+        'agency': ['awarded_by__name'],
+        'country': ['awarded_by__country__name'],
+    }
+    select = {
+        'agency': ['awarded_by'],
+        'country': ['awarded_by__country'],
+    }
+
+
+RESOURCES = OrderedDict([
+    ('queries', QueryResource()),
+    ('papers', PaperResource()),
+    ('authors', PersonResource()),
+    ('headings', HeadingResource()),
+    ('grants', GrantResource()),
+])
+
+
+def json_response(request, data, status=200):
+    """
+    Returns ``data`` as JSON with an ``ETag`` of its content, or
+    ``304 Not Modified`` if the request already has it.
+    """
+    content = json.dumps(data, cls=DjangoJSONEncoder)
+    etag = '"{0}"'.format(hashlib.md5(content).hexdigest())
+    if status == 200:
+        matches = [tag.strip() for tag
+                   in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if etag in matches or '*' in matches:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+    response = HttpResponse(content, content_type='application/json',
+                            status=status)
+    response['ETag'] = etag
+    return response
+
+
+def _get_resource(name):
+    resource = RESOURCES.get(name)
+    if resource is None:
+        raise Http404('No such resource')
+    return resource
+
+
+def _page_parameters(request):
+    try:
+        after = int(request.GET.get('after', 0))
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise BadRequest('after and limit must be integers')
+    if limit < 1:
+        raise BadRequest('limit must be positive')
+    return after, min(limit, MAX_LIMIT)
+
+
+def _page(request, resource, queryset, fields, after, limit):
+    # One row more than the page, to tell whether there is a next page.
+    queryset = queryset.filter(pk__gt=after).order_by('pk')
+    if resource.read_through(fields):
+        ids = list(queryset.values_list('pk', flat=True)[:limit + 1])
+        return _cached_page(request, resource, ids, limit)
+    objects = list(resource.restrict(queryset, fields)[:limit + 1])
+    return json_response(request, OrderedDict([
+        ('results', [resource.serialize(obj, fields)
+                     for obj in objects[:limit]]),
+        ('next', objects[limit - 1].pk if len(objects) > limit else None),
+    ]))
+
+
+def _cached_page(request, resource, ids, limit):
+    """
+    The page of the papers ``ids``, up to ``limit`` and one more if there is
+    a next page, read through :mod:`query.cache`.
+    """
+    records = cache.papers(ids[:limit], resource.load)
+    return json_response(request, OrderedDict([
+        ('results', [records[pk] for pk in ids[:limit] if pk in records]),
+        ('next', ids[limit - 1] if len(ids) > limit else None),
+    ]))
+
+
+def _bad_request(request, error):
+    return json_response(request, {'error': unicode(error)}, status=400)
+
+
+@staff_member_required
+@require_safe
+def listing(request, resource):
+    """
+    A page of ``resource``; papers may be filtered by ``source`` and
+    ``retrieved`` (``true`` or ``false``).
+    """
+    resource = _get_resource(resource)
+    try:
+        after, limit = _page_parameters(request)
+        fields = resource.parse_fields(request.GET.get('fields'))
+    except BadRequest as error:
+        return _bad_request(request, error)
+    queryset = resource.get_queryset()
+    if resource.model is Paper:
+        if 'source' in request.GET:
+            queryset = queryset.filter(source=request.GET['source'])
+        if 'retrieved' in request.GET:
+            queryset = queryset.filter(
+                retrieved=request.GET['retrieved'].lower() == 'true')
+    return _page(request, resource, queryset, fields, after, limit)
+
+
+@staff_member_required
+@require_safe
+def detail(request, resource, pk):
+    resource = _get_resource(resource)
+    try:
+        fields = resource.parse_fields(request.GET.get('fields'))
+    except BadRequest as error:
+        return _bad_request(request, error)
+    if resource.read_through(fields):
+        record = cache.papers([int(pk)], resource.load).get(int(pk))
+    else:
+        obj = resource.restrict(resource.get_queryset(), fields) \
+                      .filter(pk=pk).first()
+        record = resource.serialize(obj, fields) if obj is not None else None
+    if record is None:
+        raise Http404('No such {0}'.format(resource.model._meta.verbose_name))
+    return json_response(request, record)
+
+
+@staff_member_required
+@require_safe
+def query_papers(request, pk):
+    """
+    A page of the papers in the results of query ``pk``. The IDs on the page
+    are read through :mod:`query.cache`, and so are the papers when all of
+    their fields are wanted.
+    """
+    if not Query.objects.filter(pk=pk).exists():
+        raise Http404('No such query')
+    resource = RESOURCES['papers']
+    try:
+        after, limit = _page_parameters(request)
+        fields = resource.parse_fields(request.GET.get('fields'))
+    except BadRequest as error:
+        return _bad_request(request, error)
+    ids = cache.result_ids(int(pk), after, limit + 1)
+    if resource.read_through(fields):
+        return _cached_page(request, resource, ids, limit)
+    queryset = resource.get_queryset().filter(pk__in=ids)
+    return _page(request, resource, queryset, fields, after, limit)
@@ -0,0 +1,83 @@
+"""
+Content-addressed archive of raw E-utilities responses.
+
+When ``NCBI_ARCHIVE_ROOT`` is set, each record retrieved with EFetch, and
+each ESearch page, is written to the archive as a gzip-compressed blob named
+by the SHA-1 digest of its content::
+
+    <root>/ab/cdef0123...gz
+
+so that identical responses are stored only once. :class:`.ArchivedRecord`
+rows index the blobs by database, identifier and retrieval date. Archived
+EFetch records younger than ``NCBI_ARCHIVE_TTL`` days are served by
+:meth:`NCBIManager.fetch_many` instead of the network, and the ``reprocess``
+management command rebuilds papers from the archive without any network
+access.
+"""
+
+import datetime
+import errno
+import gzip
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+
+
+class ResponseArchive(object):
+    def __init__(self, root, ttl=None):
+        self.root = root
+        self.ttl = ttl
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:] + '.gz')
+
+    def put(self, data):
+        """
+        Stores ``data`` unless it is already present, and returns its digest.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as E:
+            if E.errno != errno.EEXIST:
+                raise
+        # Written under a temporary name and renamed, so that concurrent
+        # writers and readers never see a partial blob.
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                gz.write(data)
+        os.rename(tmp, path)
+        return digest
+
+    def open(self, digest):
+        """
+        Returns a file-like object that decompresses the blob as it is read.
+        """
+        return gzip.open(self.path(digest), 'rb')
+
+    def fresh_since(self):
+        """
+        Earliest retrieval date of records that may be used instead of the
+        network, or None if the archive is not used as a cache.
+        """
+        if self.ttl is None:
+            return None
+        return datetime.date.today() - datetime.timedelta(days=self.ttl)
+
+
+def get_archive():
+    """
+    Returns the archive configured by settings, or None.
+    """
+    root = getattr(settings, 'NCBI_ARCHIVE_ROOT', None)
+    if not root:
+        return None
+    return ResponseArchive(root, getattr(settings, 'NCBI_ARCHIVE_TTL', None))
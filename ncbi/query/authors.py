@@ -0,0 +1,272 @@
+"""
+Author disambiguation.
+
+:class:`.Person` rows are keyed on the name as printed, so one Person may
+stand for several researchers, and one researcher may appear as several
+Persons ("J Smith", "John Smith"). :func:`disambiguate` attributes each
+:class:`.Authorship` to an :class:`.Author`.
+
+Candidates are blocked on surname and first initial (``Person.block``, see
+:func:`query.ingest.blocking_key`), so
+only authorships within a block are ever compared. Within a block, each
+authorship is described by sparse features of its paper: the blocks of its
+co-authors, the institutions its Person was affiliated with at the time,
+its MeSH descriptors and its journal. Pairwise scores are accumulated for
+the whole block at once from an inverted index of those features (i.e. as
+the sparse product of the block's feature matrix with its transpose), so
+that only pairs that share a feature are ever scored. Pairs are then merged,
+best first, as long as their forenames are compatible.
+
+Runs are incremental: only blocks with unattributed authorships are
+clustered, with existing attributions kept and new authorships either
+joining an existing Author or forming new ones.
+"""
+
+from collections import defaultdict
+
+from django.db import transaction
+
+from .models import Author, Authorship, Paper, Person
+from .ingest import (affiliated_institutions, blocking_key, chunked,
+                     normalize_name)
+
+# Weight of one shared feature of each kind. A shared co-author or
+# institution is enough to merge two authorships on its own; a journal and
+# MeSH descriptors need to agree together.
+WEIGHTS = {
+    'coauthor': 1.0,
+    'affiliation': 1.0,
+    'journal': 0.5,
+    'mesh': 0.2,
+}
+THRESHOLD = 1.0
+
+# Features shared by more authorships than this in a block (e.g. the MeSH
+# descriptor "Humans") say little, and would make scoring quadratic.
+MAX_POSTINGS = 200
+
+BLOCKS_PER_BATCH = 200
+
+
+def _compatible(a, b):
+    for x, y in zip(a, b):
+        if len(x) > 1 and len(y) > 1:
+            if x != y:
+                return False
+        elif x[0] != y[0]:
+            return False
+    return True
+
+
+def compatible(a, b):
+    """
+    Whether the forenames ``a`` and ``b`` can belong to the same person:
+    "J" and "John A" are compatible, "John" and "James" are not.
+    """
+    return _compatible(normalize_name(a).split(), normalize_name(b).split())
+
+
+def fill_blocks(batch_size=1000):
+    """
+    Sets ``block`` on Persons saved before it existed, with one UPDATE per
+    block and chunk of each batch. Blocking keys are never empty, so every
+    batch leaves the next one.
+    """
+    while True:
+        people = list(Person.objects.filter(block='').values_list(
+            'pk', 'fore_name', 'last_name', 'initials')[:batch_size])
+        if not people:
+            return
+        blocks = defaultdict(list)
+        for pk, fore_name, last_name, initials in people:
+            blocks[blocking_key(fore_name, last_name, initials)].append(pk)
+        with transaction.atomic():
+            for block, pks in blocks.iteritems():
+                for chunk in chunked(pks):
+                    Person.objects.filter(pk__in=chunk).update(block=block)
+
+
+class _Clusters(object):
+    """
+    Union-find over the authorships of one block, keeping the forenames and
+    existing Author of each cluster. Clusters of two different Authors are
+    never merged, so that attributions are stable across runs.
+    """
+    def __init__(self, mentions):
+        self.parent = range(len(mentions))
+        self.names = [set([tuple(normalize_name(m['fore_name']).split())])
+                      for m in mentions]
+        self.author = [m['author_id'] for m in mentions]
+        # Authorships already attributed to the same Author stay together.
+        first = {}
+        for i, m in enumerate(mentions):
+            if m['author_id'] is not None:
+                if m['author_id'] in first:
+                    self.union(first[m['author_id']], i)
+                else:
+                    first[m['author_id']] = i
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return False
+        if None not in (self.author[i], self.author[j]):
+            return False
+        if not all(_compatible(a, b) for a in self.names[i]
+                   for b in self.names[j]):
+            return False
+        self.parent[j] = i
+        self.names[i] |= self.names[j]
+        if self.author[i] is None:
+            self.author[i] = self.author[j]
+        return True
+
+
+def score_block(mentions):
+    """
+    Returns ``{(i, j): score}`` for the pairs of ``mentions`` that share at
+    least one feature.
+    """
+    postings = defaultdict(list)
+    for i, m in enumerate(mentions):
+        for feature in m['features']:
+            postings[feature].append(i)
+    scores = defaultdict(float)
+    for (kind, value), indices in postings.iteritems():
+        if len(indices) < 2 or len(indices) > MAX_POSTINGS:
+            continue
+        weight = WEIGHTS[kind]
+        for n, i in enumerate(indices):
+            for j in indices[n + 1:]:
+                scores[(i, j)] += weight
+    return scores
+
+
+def cluster_block(mentions, threshold=THRESHOLD):
+    """
+    Returns a list of clusters, each a list of indices into ``mentions``.
+    """
+    clusters = _Clusters(mentions)
+    # Allows for rounding in sums of weights.
+    threshold -= 1e-9
+    pairs = sorted([(-score, i, j) for (i, j), score
+                    in score_block(mentions).iteritems() if score >= threshold])
+    for score, i, j in pairs:
+        clusters.union(i, j)
+    groups = defaultdict(list)
+    for i in xrange(len(mentions)):
+        groups[clusters.find(i)].append(i)
+    return [groups[root] for root in sorted(groups)]
+
+
+def _values(queryset, field, ids, *fields):
+    rows = []
+    for chunk in chunked(ids):
+        rows.extend(queryset.filter(**{field + '__in': chunk})
+                            .values_list(*fields))
+    return rows
+
+
+def load_mentions(blocks):
+    """
+    Returns a dict mapping each of ``blocks`` to the authorships in it, as
+    dicts with the Authorship ``pk``, ``author_id``, ``fore_name``,
+    ``last_name`` and sparse ``features``.
+    """
+    rows = _values(Authorship.objects, 'person__block', blocks,
+                   'pk', 'paper_id', 'person_id', 'author_id',
+                   'person__fore_name', 'person__last_name', 'person__block')
+    papers = set([row[1] for row in rows])
+
+    coauthors = defaultdict(set)
+    for paper, block in _values(Authorship.objects, 'paper_id', papers,
+                                'paper_id', 'person__block'):
+        coauthors[paper].add(block)
+    descriptors = defaultdict(set)
+    for paper, descriptor in _values(Paper.mesh_headings.through.objects,
+                                     'paper_id', papers, 'paper_id',
+                                     'meshheading__descriptor_id'):
+        descriptors[paper].add(descriptor)
+    journals, pubdates = {}, {}
+    for pk, journal, pubdate in _values(Paper.objects, 'pk', papers, 'pk',
+                                        'published_in_id', 'pubdate'):
+        journals[pk] = journal
+        pubdates[pk] = pubdate
+    institutions = affiliated_institutions([(row[1], row[2]) for row in rows],
+                                           pubdates)
+
+    mentions = defaultdict(list)
+    for pk, paper, person, author, fore_name, last_name, block in rows:
+        features = [('coauthor', b) for b in coauthors[paper] if b != block]
+        features += [('mesh', d) for d in descriptors[paper]]
+        features += [('affiliation', i) for i
+                     in institutions[(paper, person)]]
+        if journals[paper] is not None:
+            features.append(('journal', journals[paper]))
+        mentions[block].append({'pk': pk, 'author_id': author,
+                                'fore_name': fore_name,
+                                'last_name': last_name,
+                                'features': features})
+    for block in mentions:
+        mentions[block].sort(key=lambda m: m['pk'])
+    return mentions
+
+
+def _attribute(block, mentions, clusters):
+    created = 0
+    for cluster in clusters:
+        members = [mentions[i] for i in cluster]
+        new = [m['pk'] for m in members if m['author_id'] is None]
+        if not new:
+            continue
+        existing = [m['author_id'] for m in members
+                    if m['author_id'] is not None]
+        if existing:
+            author_id = existing[0]
+        else:
+            # Named after the fullest form of the name in the cluster.
+            named = max(members, key=lambda m: (len(m['fore_name']), -m['pk']))
+            author_id = Author.objects.create(
+                block=block, fore_name=named['fore_name'],
+                last_name=named['last_name']).pk
+            created += 1
+        for chunk in chunked(new):
+            Authorship.objects.filter(pk__in=chunk).update(author=author_id)
+    return created
+
+
+def disambiguate(rebuild=False, threshold=THRESHOLD,
+                 blocks_per_batch=BLOCKS_PER_BATCH):
+    """
+    Attributes new authorships, or all of them if ``rebuild``, to Authors.
+    Returns the number of blocks clustered and of Authors created.
+    """
+    fill_blocks()
+    if rebuild:
+        Authorship.objects.update(author=None)
+        Author.objects.all().delete()
+
+    pending = Authorship.objects.filter(author=None) \
+                                .order_by('person__block') \
+                                .values_list('person__block', flat=True) \
+                                .distinct()
+    blocks = created = 0
+    last = None
+    while True:
+        page = pending if last is None else \
+               pending.filter(person__block__gt=last)
+        batch = list(page[:blocks_per_batch])
+        if not batch:
+            return blocks, created
+        with transaction.atomic():
+            for block, mentions in load_mentions(batch).iteritems():
+                clusters = cluster_block(mentions, threshold)
+                created += _attribute(block, mentions, clusters)
+        blocks += len(batch)
+        last = batch[-1]
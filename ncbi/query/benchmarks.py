@@ -0,0 +1,560 @@
+"""
+Benchmarks for the ingestion hot paths.
+
+:func:`lookup_benchmark` fills the tables behind the natural-key lookups in
+:mod:`query.ingest` and times them with and without their indexes.
+:func:`decode_benchmark` times loading MeSH descriptors with their tree
+numbers stored as JSON, against the Python literals that ``ListField``
+used to store. :func:`ingest_benchmark` measures the connector and
+ingestion paths end to end against a local stand-in for E-utilities. The
+``benchmarklookups``, ``benchmarkdecode`` and ``benchmarkingest`` management
+commands run them in a :func:`scratch_database`.
+
+:func:`extract_benchmark` compares the compiled schemas of
+:mod:`query.extract` with the ``handle_*`` methods that they replaced, kept
+here as :class:`LegacyPubMedParser` and :class:`LegacyPMCParser`; the
+``benchmarkextract`` command runs it, without a database.
+"""
+
+import ast
+from collections import OrderedDict
+from contextlib import contextmanager
+import datetime
+import json
+import os
+import random
+import re
+import resource
+from StringIO import StringIO
+import time
+import xml.etree.ElementTree as ET
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+from unidecode import unidecode
+
+from .models import MeSHDescriptor, Paper, Person, Query
+from .connector import get_manager, get_smart
+from .extract import ElementTreeBackend, LxmlBackend, lxml_etree
+from .ingest import _lookup, chunked
+from .lookup import get_lookup_cache
+from .metrics import count_queries
+from .pipeline import Harvester
+from .testing import FakeEutilsServer, FixtureCorpus
+from .transport import HTTPTransport, RateLimiter
+
+
+@contextmanager
+def scratch_database():
+    """
+    Runs the enclosed code in a new test database, so that benchmarks never
+    touch the configured database.
+    """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                       serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+# Each table is filled with rows whose natural key is a function of the row
+# number. Few distinct forenames, as in PubMed, so that a lookup on the
+# forename alone matches many rows.
+TABLES = [
+    (Person, ('fore_name', 'last_name'),
+     lambda i: (u'Fore{0}'.format(i % 1000), u'Last{0}'.format(i)),
+     {'initials': u'F'}),
+    (MeSHDescriptor, ('descriptor',),
+     lambda i: (u'D{0:07d}'.format(i),),
+     {'tree_numbers': []}),
+    (Paper, ('identifier', 'source'),
+     lambda i: (unicode(i), u'PubMed'),
+     {'abstract': u''}),
+]
+
+
+def _populate(model, fields, key, defaults, rows, batch_size=5000):
+    for chunk in chunked(xrange(rows), batch_size):
+        instances = []
+        for i in chunk:
+            values = dict(zip(fields, key(i)))
+            values.update(defaults)
+            instances.append(model(**values))
+        model.objects.bulk_create(instances)
+
+
+def _set_indexed(model, fields, indexed):
+    """
+    Creates or drops the index that :mod:`query.ingest` relies on to look up
+    ``model`` by ``fields``.
+    """
+    opts = model._meta
+    with connection.schema_editor() as editor:
+        if len(fields) == 1:
+            field = opts.get_field(fields[0])
+            name, path, args, kwargs = field.deconstruct()
+            kwargs['unique'] = False
+            plain = field.__class__(*args, **kwargs)
+            plain.set_attributes_from_name(name)
+            plain.model = model
+            if indexed:
+                editor.alter_field(model, plain, field)
+            else:
+                editor.alter_field(model, field, plain)
+            return
+        for together, alter in [
+                (opts.unique_together, editor.alter_unique_together),
+                (opts.index_together, editor.alter_index_together)]:
+            if together:
+                if indexed:
+                    alter(model, [], together)
+                else:
+                    alter(model, together, [])
+
+
+def _time_lookups(model, fields, keys, batch_size):
+    start = time.time()
+    for key in keys:
+        model.objects.get(**dict(zip(fields, key)))
+    single = (time.time() - start) / len(keys)
+
+    start = time.time()
+    batches = 0
+    for chunk in chunked(keys, batch_size):
+        _lookup(model, set(chunk), fields)
+        batches += 1
+    batch = (time.time() - start) / batches
+    return single, batch
+
+
+def lookup_benchmark(rows=10 ** 6, lookups=1000, batch_size=200, seed=0):
+    """
+    Returns a list of ``(model name, single, batch)`` tuples, where
+    ``single`` is the mean time in seconds of one ``get``, and ``batch`` of
+    resolving ``batch_size`` keys the way :func:`query.ingest.resolve` does,
+    each as an ``(indexed, unindexed)`` pair.
+    """
+    rng = random.Random(seed)
+    results = []
+    for model, fields, key, defaults in TABLES:
+        _populate(model, fields, key, defaults, rows)
+        keys = [key(i) for i in rng.sample(xrange(rows), min(lookups, rows))]
+
+        indexed = _time_lookups(model, fields, keys, batch_size)
+        _set_indexed(model, fields, False)
+        try:
+            unindexed = _time_lookups(model, fields, keys, batch_size)
+        finally:
+            _set_indexed(model, fields, True)
+        results.append((model.__name__, (indexed[0], unindexed[0]),
+                        (indexed[1], unindexed[1])))
+    return results
+
+
+def _timed(function):
+    start = time.time()
+    result = function()
+    return time.time() - start, result
+
+
+def decode_benchmark(rows=100000, tree_numbers=4):
+    """
+    Returns a list of ``(label, seconds)`` timings for loading ``rows``
+    descriptors with ``tree_numbers`` tree numbers each.
+    """
+    numbers = [u'D12.776.{0:03d}.{1:03d}'.format(n, n * 7)
+               for n in xrange(tree_numbers)]
+    _populate(MeSHDescriptor, ('descriptor',),
+              lambda i: (u'D{0:07d}'.format(i),), {'tree_numbers': numbers},
+              rows)
+    descriptors = MeSHDescriptor.objects.all()
+    load, loaded = _timed(lambda: list(descriptors))
+    access, decoded = _timed(lambda: [d.tree_numbers for d in loaded])
+
+    encoded = list(descriptors.values_list('tree_numbers', flat=True))
+    literals = [unicode(json.loads(value)) for value in encoded]
+    literal_eval, decoded = _timed(lambda: [ast.literal_eval(value)
+                                            for value in literals])
+    json_loads, decoded = _timed(lambda: [json.loads(value)
+                                          for value in encoded])
+    return [
+        ('load, tree numbers not read', load),
+        ('load and read tree numbers', load + access),
+        ('load with ListField (literal_eval)', load + literal_eval),
+        ('decode only, ast.literal_eval', literal_eval),
+        ('decode only, json.loads', json_loads),
+    ]
+
+
+def peak_memory():
+    """
+    Peak resident set size of the process, in KiB on Linux.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Each path is called with a manager, the corpus served to it, the
+# identifiers to ingest and a query, and returns the number of records saved.
+def _process_resource(manager, corpus, identifiers, query):
+    for batch in chunked(identifiers, manager.batch_size):
+        stream = StringIO(corpus.fetch(batch))
+        for identifier, record in manager.iter_records(stream):
+            manager.process_resource(record, identifier)
+    return len(identifiers)
+
+
+def _process_searchresults(manager, corpus, identifiers, query):
+    processed = [0]
+    manager.search(query, callback=lambda done, total: processed.append(done))
+    return processed[-1]
+
+
+def _fetch_many(manager, corpus, identifiers, query):
+    return len(manager.fetch_many(identifiers))
+
+
+def _fetch_history(manager, corpus, identifiers, query):
+    query.webenv, query.query_key = 'NCID_benchmark', '1'
+    query.result_count = len(identifiers)
+    return sum(1 for paper in manager.fetch_history(query))
+
+
+def _harvester(manager, corpus, identifiers, query):
+    return Harvester(manager).run(identifiers)['write'].records
+
+
+PATHS = OrderedDict([
+    ('process_resource', _process_resource),
+    ('process_searchresults', _process_searchresults),
+    ('fetch_many', _fetch_many),
+    ('fetch_history', _fetch_history),
+    ('harvester', _harvester),
+])
+
+FIXTURES = {
+    'PubMed': ('pubmed_efetch.xml', 'pubmed_esearch.xml'),
+    'PMC': ('pmc_efetch.xml', 'pmc_esearch.xml'),
+}
+
+SCALES = [1, 100, 10000, 100000]
+
+
+def _measure(path, source, scale, run):
+    memory = peak_memory()
+    with count_queries() as queries:
+        seconds, records = _timed(run)
+    return OrderedDict([
+        ('path', path),
+        ('source', source),
+        ('scale', scale),
+        ('records', records),
+        ('seconds', seconds),
+        ('rate', records / seconds if seconds else 0.),
+        ('queries', queries.count),
+        ('queries_per_record',
+         float(queries.count) / records if records else 0.),
+        ('memory', peak_memory() - memory),
+    ])
+
+
+def ingest_benchmark(source='PubMed', scales=SCALES, paths=None):
+    """
+    Ingests ``scale`` records from database ``source`` through each of
+    ``paths`` (by default, all of :data:`PATHS`), served by a
+    :class:`.FakeEutilsServer` from the recorded responses in ``testdata``.
+
+    Returns a result dict for each path and scale, with the records saved,
+    the time taken, the rate in records per second, the number of database
+    queries in total and per record, and the growth of the peak resident set
+    size of the process, in KiB. The peak only ever grows, so memory is most
+    meaningful with scales in increasing order.
+    """
+    manager = get_manager(source)(transport=HTTPTransport(
+        rate_limiter=RateLimiter(10 ** 6), max_retries=0))
+    manager.archive = None
+    efetch, esearch = FIXTURES[source]
+    corpus = FixtureCorpus(manager, efetch, esearch)
+    user = User.objects.get_or_create(username='benchmark')[0]
+
+    results = []
+    offset = 1
+    with FakeEutilsServer(corpus.handle) as server:
+        manager.eutils = server.url
+        for path in paths or PATHS.keys():
+            for scale in scales:
+                # New identifiers for every run, so that each one creates its
+                # papers rather than updating those of the last.
+                identifiers = [unicode(i)
+                               for i in xrange(offset, offset + scale)]
+                offset += scale
+                corpus.identifiers = identifiers
+                query = Query.objects.create(created_by=user, database=source,
+                                             querystring='benchmark')
+                get_lookup_cache().clear()
+                run = lambda: PATHS[path](manager, corpus, identifiers, query)
+                results.append(_measure(path, source, scale, run))
+    return results
+
+
+def _result_key(result):
+    return result['path'], result['source'], result['scale']
+
+
+def save_results(filename, results):
+    """
+    Appends ``results`` to ``filename``, one JSON object per line.
+    """
+    date = timezone.now().isoformat()
+    with open(filename, 'a') as f:
+        for result in results:
+            f.write(json.dumps(OrderedDict(result, date=date)) + '\n')
+
+
+def load_results(filename):
+    """
+    Returns the most recent result stored in ``filename`` for each path,
+    source and scale.
+    """
+    latest = {}
+    if not os.path.exists(filename):
+        return latest
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                latest[_result_key(result)] = result
+    return latest
+
+
+# The peak resident set size is coarse, so memory growth of less than this
+# many KiB more than the baseline is not reported.
+MEMORY_SLACK = 1024
+
+
+def regressions(baseline, results, tolerance=0.2):
+    """
+    Returns ``(result, metric, before, after)`` for each metric of
+    ``results`` that is worse than in ``baseline`` (see
+    :func:`load_results`) by more than ``tolerance``: a lower rate, or more
+    queries per record or memory.
+    """
+    found = []
+    for result in results:
+        before = baseline.get(_result_key(result))
+        if before is None:
+            continue
+        for metric, worse in [
+                ('rate', lambda old, new: new < old * (1 - tolerance)),
+                ('queries_per_record',
+                 lambda old, new: new > old * (1 + tolerance)),
+                ('memory',
+                 lambda old, new: new > old * (1 + tolerance) + MEMORY_SLACK)]:
+            if worse(before[metric], result[metric]):
+                found.append((result, metric, before[metric], result[metric]))
+    return found
+
+
+class LegacyPubMedParser(object):
+    """
+    The record parsing of :class:`.PubMedManager` before :mod:`query.extract`,
+    kept as the baseline of :func:`extract_benchmark`.
+    """
+    authorlist_path = 'PubmedArticle/MedlineCitation/Article/AuthorList'
+    authorname_path = './/Author'
+    author_forename = 'ForeName'
+    author_surname = 'LastName'
+    author_initials = 'Initials'
+    date_path = 'PubmedArticle/MedlineCitation/DateCreated'
+    date_year_path = 'Year'
+    date_month_path = 'Month'
+    date_day_path = 'Day'
+    journal_path = './/Journal'
+    journal_issn_path = './/ISSN'
+    journal_title_path = './/Title'
+    affiliation_path = 'AffiliationInfo'
+    affiliation_instance_path = 'Affiliation'
+    abstract_path = './/Abstract'
+    abstract_section_path = './/AbstractText'
+
+    def handle_date(self, e):
+        date_created = e.find(self.date_path)
+        asInt = lambda dpart: 1 if dpart == '' else int(dpart)
+        y = asInt(get_smart(date_created, self.date_year_path))
+        m = asInt(get_smart(date_created, self.date_month_path))
+        d = asInt(get_smart(date_created, self.date_day_path))
+        return datetime.date(y, m, d)
+
+    def handle_affiliations(self, root, e):
+        affiliations = []
+        aff_parent = e.find(self.affiliation_path)
+        if aff_parent is not None:
+            for aff in aff_parent.findall(self.affiliation_instance_path):
+                if aff.text is not None:
+                    affiliations.append(unidecode(unicode(aff.text)))
+        return affiliations
+
+    def handle_authors(self, e):
+        authors = []
+        authorList = e.find(self.authorlist_path)
+        if authorList is not None:
+            for author in authorList.findall(self.authorname_path):
+                authors.append({
+                    'fore_name': get_smart(author, self.author_forename),
+                    'last_name': get_smart(author, self.author_surname),
+                    'initials': get_smart(author, self.author_initials),
+                    'affiliations': self.handle_affiliations(e, author),
+                })
+        return authors
+
+    def handle_headings(self, e):
+        headings = []
+        mh = e.find('PubmedArticle/MedlineCitation/MeshHeadingList')
+        if mh is not None:
+            for heading in mh.getchildren():
+                descriptor_name = get_smart(heading, 'DescriptorName')
+                if descriptor_name != '':
+                    qualifiers = [q.text for q
+                                  in heading.findall('QualifierName')
+                                  if q.text is not None]
+                    if len(qualifiers) > 0:
+                        for qual_name in qualifiers:
+                            headings.append((descriptor_name, qual_name))
+                    else:
+                        headings.append((descriptor_name, None))
+        return headings
+
+    def handle_grants(self, e):
+        grants = []
+        gl = e.find('PubmedArticle/MedlineCitation/Article/GrantList')
+        if gl is not None:
+            for grant in gl.getchildren():
+                grants.append({
+                    'grant_id': get_smart(grant, 'GrantID'),
+                    'acronym': get_smart(grant, 'Acronym'),
+                    'agency': get_smart(grant, 'Agency'),
+                    'country': get_smart(grant, 'Country'),
+                })
+        return grants
+
+    def handle_journal(self, e):
+        jnl = e.find(self.journal_path)
+        if jnl is not None:
+            issn = get_smart(jnl, self.journal_issn_path)
+            title = get_smart(jnl, self.journal_title_path)
+            if title == '':
+                return
+            return issn, title
+
+    def handle_abstract(self, e):
+        absElement = e.find(self.abstract_path)
+        if absElement is None:
+            return ''
+        return ' '.join([re.sub(r'<[^>]*?>', '', ET.tostring(elem)) for elem
+                         in absElement.findall(self.abstract_section_path)])
+
+    def parse_resource(self, e, identifier):
+        return {
+            'identifier': identifier,
+            'pubdate': self.handle_date(e),
+            'title': get_smart(e, './/ArticleTitle'),
+            'abstract': self.handle_abstract(e),
+            'grants': self.handle_grants(e),
+            'authors': self.handle_authors(e),
+            'headings': self.handle_headings(e),
+            'journal': self.handle_journal(e),
+        }
+
+
+class LegacyPMCParser(LegacyPubMedParser):
+    """
+    The record parsing of :class:`.PMCManager` before :mod:`query.extract`.
+    """
+    authorlist_path = './/contrib-group'
+    authorname_path = './/contrib[@contrib-type="author"]'
+    author_surname = './/name/surname'
+    author_forename = './/name/given-names'
+    author_initials = ''
+    date_path = './/article-meta/pub-date'
+    date_year_path = 'year'
+    date_month_path = 'month'
+    date_day_path = 'day'
+    journal_path = './/journal-meta'
+    journal_issn_path = './/issn'
+    journal_title_path = './/journal-title'
+    affiliation_path = './/article-meta'
+    affiliation_instance_path = 'aff'
+    abstract_path = './/article-meta/abstract'
+    abstract_section_path = './/sec/p'
+
+    def handle_affiliations(self, root, e):
+        affiliations = []
+        rids = [x.attrib['rid'] for x in e.findall("xref[@ref-type='aff']")]
+        aff_parent = root.find(self.affiliation_path)
+        if aff_parent is not None:
+            for rid in rids:
+                aff = aff_parent.find("aff[@id='{0}']".format(rid))
+                addr = aff.find('.//addr-line')
+                if addr is not None:
+                    affiliations.append(unidecode(unicode(addr.text)))
+        return affiliations
+
+
+LEGACY_PARSERS = {
+    'PubMed': LegacyPubMedParser,
+    'PMC': LegacyPMCParser,
+}
+
+
+def _parse_body(manager, body, parse):
+    return len([parse(record, identifier) for identifier, record
+                in manager.iter_records(StringIO(body))])
+
+
+def _wrapped_records(manager, body):
+    # Records as iter_records yields them, but all held at once.
+    root = manager.backend.parse(StringIO(body)).getroot()
+    records = []
+    for record in root.findall(manager.record_path):
+        wrapper = manager.backend.element(root.tag, root.attrib)
+        wrapper.append(record)
+        records.append((get_smart(record, manager.record_id_path), wrapper))
+    return records
+
+
+def extract_benchmark(source='PubMed', records=10000):
+    """
+    Returns a list of ``(label, parse, extract)`` rates, in records per
+    second, for the legacy parser and for the compiled schema of the
+    ``source`` manager with each available backend: ``parse`` for parsing
+    an EFetch response of ``records`` records and extracting their fields,
+    and ``extract`` for the extraction alone.
+    """
+    manager = get_manager(source)(archive=None,
+                                  backend=ElementTreeBackend())
+    efetch, esearch = FIXTURES[source]
+    corpus = FixtureCorpus(manager, efetch, esearch)
+    body = corpus.fetch([unicode(i) for i in xrange(1, records + 1)])
+
+    candidates = [('legacy handle_* methods', manager,
+                   LEGACY_PARSERS[source]().parse_resource),
+                  ('compiled schema, etree', manager, manager.parse_resource)]
+    if lxml_etree is not None:
+        lxml_manager = get_manager(source)(archive=None,
+                                           backend=LxmlBackend())
+        candidates.append(('compiled schema, lxml', lxml_manager,
+                           lxml_manager.parse_resource))
+
+    results = []
+    for label, parser, parse in candidates:
+        # Compile outside of the timings.
+        parser.get_extractor()
+        seconds, parsed = _timed(lambda: _parse_body(parser, body, parse))
+        wrapped = _wrapped_records(parser, body)
+        extract, parsed = _timed(lambda: [parse(record, identifier)
+                                          for identifier, record in wrapped])
+        results.append((label, records / seconds if seconds else 0.,
+                        records / extract if extract else 0.))
+    return results
@@ -0,0 +1,136 @@
+"""
+Read-through cache of serialized papers and query result pages, behind the
+papers of :mod:`query.api`.
+
+Papers are cached as serialized by the API with all of their fields, one
+entry per paper. The results of a query are cached a page of paper IDs at a
+time, in primary-key order, under the current version of the query, so that
+a change to its results retires every cached page at once.
+
+The managers in :mod:`query.connector` invalidate entries as they change the
+rows behind them: :meth:`NCBIManager.process_records` drops the papers that it
+saved, and :meth:`PubMedManager.process_searchresults` moves the query on to
+a new version. Bulk updates of papers, such as marking them retrieved in
+:mod:`query.pipeline` or stale in :meth:`NCBIManager.refresh`, drop them too,
+since ``update()`` sends no signals. Deleted papers and queries are
+invalidated as well.
+
+Entries are stored in the Django cache named by the ``NCBI_CACHE`` setting,
+for ``NCBI_CACHE_TIMEOUT`` seconds. Any backend will do; the local-memory and
+file-based backends need no external service, but the local-memory backend is
+per-process, so a web server does not see the invalidations made by
+``runjobs`` workers in other processes before entries time out.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete
+
+from .models import Paper, Query
+from . import metrics
+
+PREFIX = 'ncbi'
+DEFAULT_TIMEOUT = 3600
+PAGE_SIZE = 100
+
+
+def get_cache():
+    return caches[getattr(settings, 'NCBI_CACHE', 'default')]
+
+
+def _timeout():
+    return getattr(settings, 'NCBI_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def _paper_key(pk):
+    return '{0}:paper:{1}'.format(PREFIX, pk)
+
+
+def _version_key(query_id):
+    return '{0}:query:{1}:version'.format(PREFIX, query_id)
+
+
+def query_version(query_id):
+    """
+    Returns the current version of the cached results of query ``query_id``.
+    """
+    cache = get_cache()
+    key = _version_key(query_id)
+    version = cache.get(key)
+    if version is None:
+        # Versions start from the clock, so that a version that was evicted
+        # never comes back to serve the pages cached under it.
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_query(query_id):
+    """
+    Retires the cached result pages of query ``query_id``.
+    """
+    try:
+        get_cache().incr(_version_key(query_id))
+    except ValueError:
+        # No version yet, so nothing has been cached under one.
+        pass
+
+
+def invalidate_papers(pks):
+    get_cache().delete_many([_paper_key(pk) for pk in pks])
+
+
+def result_ids(query_id, after=0, limit=PAGE_SIZE):
+    """
+    Returns up to ``limit`` IDs of the papers in the results of query
+    ``query_id``, in order, starting after the ID ``after``.
+    """
+    cache = get_cache()
+    key = '{0}:query:{1}:{2}:results:{3}:{4}'.format(
+        PREFIX, query_id, query_version(query_id), after, limit)
+    ids = cache.get(key)
+    if ids is None:
+        through = Query.results.through
+        ids = list(through.objects.filter(query_id=query_id,
+                                          paper_id__gt=after)
+                                  .order_by('paper_id')
+                                  .values_list('paper_id', flat=True)[:limit])
+        cache.set(key, ids, _timeout())
+    return ids
+
+
+def papers(pks, load):
+    """
+    Returns a dict mapping each of the paper IDs ``pks`` that exists to its
+    serialized record, from the cache where possible. ``load`` is called
+    with the IDs of the papers that are not cached, and returns a dict of
+    their records, which are cached.
+
+    Hits and misses are recorded as the ``paper_cache`` stage; see
+    :mod:`query.metrics`.
+    """
+    cache = get_cache()
+    pks = list(pks)
+    with metrics.stage('paper_cache') as counts:
+        cached = cache.get_many([_paper_key(pk) for pk in pks])
+        records = dict([(pk, cached[_paper_key(pk)]) for pk in pks
+                        if _paper_key(pk) in cached])
+        missing = [pk for pk in pks if pk not in records]
+        loaded = load(set(missing)) if missing else {}
+        if loaded:
+            cache.set_many(dict([(_paper_key(pk), record) for pk, record
+                                 in loaded.iteritems()]), _timeout())
+        records.update(loaded)
+        counts.update(hits=len(pks) - len(missing), misses=len(missing))
+    return records
+
+
+def invalidate_deleted(sender, instance, **kwargs):
+    if sender is Paper:
+        invalidate_papers([instance.pk])
+    elif sender is Query:
+        invalidate_query(instance.pk)
+
+post_delete.connect(invalidate_deleted)
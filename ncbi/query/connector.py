@@ -1,10 +1,15 @@
 import urllib2
 import datetime
-import xml.etree.ElementTree as ET
 from unidecode import unidecode
-import re
+import time
 
 from .models import *
+from . import cache, extract, ingest, metrics
+from .extract import (Call, Const, Content, Date, Each, In, Scope, Text, Texts,
+                      Tuple)
+from .lookup import get_lookup_cache
+from .transport import get_transport
+from .archive import get_archive
 
 def get_smart(e, element):
     elem = e.find(element)
@@ -17,242 +22,463 @@ def get_smart(e, element):
     return text
 
 
+_extractors = {}
+
+
 class NCBIManager(object):
-    endpoint = ''.join(['http://eutils.ncbi.nlm.nih.gov/entrez/eutils',
-                             '/efetch.fcgi?db={db}&id={term}&rettype=xml'])
-    searchpoint = ''.join(['http://eutils.ncbi.nlm.nih.gov/entrez/eutils',
-                           '/esearch.fcgi?db={db}&term={term}&rettype=xml',
-                           '&retmax={retmax}'])
+    eutils = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+    endpoint = '{eutils}/efetch.fcgi?db={db}&id={term}&rettype=xml'
+    searchpoint = ''.join(['{eutils}/esearch.fcgi?db={db}&term={term}',
+                           '&rettype=xml&retmax={retmax}&retstart={retstart}',
+                           '&usehistory={usehistory}{dates}'])
+    historypoint = ''.join(['{eutils}/efetch.fcgi?db={db}&rettype=xml',
+                            '&WebEnv={webenv}&query_key={query_key}',
+                            '&retmax={retmax}&retstart={retstart}'])
+
+    batch_size = 200
+
+    schema = []
+
+    def __init__(self, transport=None, archive=None, backend=None):
+        if transport is None:
+            transport = get_transport()
+        if archive is None:
+            archive = get_archive()
+        if backend is None:
+            backend = extract.get_backend()
+        self.transport = transport
+        self.archive = archive
+        self.backend = backend
+
+    def open_resource(self, endpoint, **kwargs):
+        resource = endpoint.format(eutils=self.eutils, db=self.db, **kwargs)
+        with metrics.stage('request'):
+            stream = self.transport.open(resource)
+        return metrics.CountingStream(stream)
 
     def get_resource(self, endpoint, **kwargs):
-        resource = endpoint.format(db=self.db, **kwargs)
-        response_content = urllib2.urlopen(resource).read()
-        return ET.fromstring(response_content)
+        stream = self.open_resource(endpoint, **kwargs)
+        try:
+            with metrics.stage('parse'):
+                return self.backend.parse(stream).getroot()
+        finally:
+            stream.close()
 
     def fetch(self, identifier):
         result = self.get_resource(self.endpoint, term=identifier)
         return self.process_resource(result, identifier)
 
-    def search(self, query):
-        results = self.get_resource(self.searchpoint,
-                                    term=urllib2.quote(query.querystring),
-                                    retmax=query.retmax)
-        return self.process_searchresults(results, query)
-
-class PubMedManager(NCBIManager):
-    db = 'PubMed'
-    authorlist_path = 'PubmedArticle/MedlineCitation/Article/AuthorList'
-    authorname_path = './/Author'
-    author_forename = 'ForeName'
-    author_surname = 'LastName'
-    author_initials = 'Initials'
-    date_path = 'PubmedArticle/MedlineCitation/DateCreated'
-    date_year_path = 'Year'
-    date_month_path = 'Month'
-    date_day_path = 'Day'
-    journal_path = './/Journal'
-    journal_issn_path = './/ISSN'
-    journal_title_path = './/Title'
-    affiliation_path = 'AffiliationInfo'
-    affiliation_instance_path = 'Affiliation'
-    abstract_path = './/Abstract'
-    abstract_section_path = './/AbstractText'
-
-    def handle_date(self, e):
-        date_created = e.find(self.date_path)
-        asInt = lambda dpart: 1 if dpart == '' else int(dpart)
-        y = asInt(get_smart(date_created, self.date_year_path))
-        m = asInt(get_smart(date_created, self.date_month_path))
-        d = asInt(get_smart(date_created, self.date_month_path))
-        date = datetime.date(y, m, d)
-
-        return date
-
-    def handle_affiliations(self, root, e):
-        affiliations = []
-        aff_parent = e.find(self.affiliation_path)
-        if aff_parent is not None:
-            for aff in aff_parent.findall(self.affiliation_instance_path):
-                if aff.text is not None:
-                    aff_safe = unidecode(unicode(aff.text))
-                    i = Institution.objects.get_or_create(name=aff_safe)[0]
-                    affiliations.append(i)
-        return affiliations
-
-    def handle_authors(self, e, date):
-        authors = []
-        authorList = e.find(self.authorlist_path)
-        if authorList is not None:
-            authorNames = authorList.findall(self.authorname_path)
-            if authorNames is not None:
-                for author in authorNames:
-                    a = Person.objects.get_or_create(
-                        fore_name = get_smart(author, self.author_forename),
-                        last_name = get_smart(author, self.author_surname),
-                        defaults={'initials': get_smart(author,
-                                                        self.author_initials)}
-                    )[0]
-
-                    for inst in self.handle_affiliations(e, author):
-                        affiliation = Affiliation(person=a,
-                                                  institution=inst,
-                                                  date=date)
-                        affiliation.save()
-                    authors.append(a)
-        return authors
-
-    def handle_headings(self, e):
-        def g_o_c(model, **kwargs):
-            return model.objects.get_or_create(**kwargs)
-
-        mh_path = 'PubmedArticle/MedlineCitation/MeshHeadingList'
-
-        headings = []
-        mh = e.find(mh_path)
-        if mh is not None:
-            for heading in mh.getchildren():
-                descriptor_name = get_smart(heading, 'DescriptorName')
-                if descriptor_name != '':
-                    descriptor, created = g_o_c(MeSHDescriptor,
-                                                descriptor=descriptor_name)
-
-                    if len(heading.findall('QualifierName')) > 0:
-                        for qualifier_elem in heading.findall('QualifierName'):
-                            qual_name = qualifier_elem.text
-                            qualifier, created = g_o_c(MeSHQualifier,
-                                                       subheading=qual_name)
-                            heading, created = g_o_c(MeSHHeading,
-                                                     descriptor=descriptor,
-                                                     qualifier=qualifier)
-                            headings.append(heading)
-                    else:
-                        heading, created = g_o_c(MeSHHeading,
-                                                 descriptor=descriptor,
-                                                 qualifier=None)
-                        headings.append(heading)
-        return headings
-
-    def handle_grants(self, e):
-        gl_path = 'PubmedArticle/MedlineCitation/Article/GrantList'
-
-        grants = []
-        gl = e.find(gl_path)
-
-        if gl is not None:
-            for grant in gl.getchildren():
-                grant_id = get_smart(grant, 'GrantID')
-                acronym = get_smart(grant, 'Acronym')
-                agency = get_smart(grant, 'Agency')
-                country = get_smart(grant, 'Country')
-
-                if agency != '':
-                    c, created = Country.objects.get_or_create(name=country)
-                    a, created = Agency.objects.get_or_create(name=agency,
-                                                      defaults={'country': c})
-
-                if grant_id != '':
-                    g, created = Grant.objects.get_or_create(grant_id=grant_id,
-                                                     acronym=acronym,
-                                                     defaults={'awarded_by': a})
-                    grants.append(g)
-
-        return grants
-
-    def handle_journal(self, e):
-        jnl = e.find(self.journal_path)
-        if jnl is not None:
-            issn = get_smart(jnl, self.journal_issn_path)
-            title = get_smart(jnl, self.journal_title_path)
-            if title == '':
-                return
-            return Journal.objects.get_or_create(issn=issn, title=title)[0]
-
-    def handle_abstract(self, e):
-        absElement = e.find(self.abstract_path)
-        if absElement is None:
-            return ''
-        return ' '.join([re.sub(r'<[^>]*?>', '', ET.tostring(elem)) for elem
-                         in absElement.findall(self.abstract_section_path)])
+    def get_extractor(self):
+        """
+        Returns the compiled :attr:`.schema`, compiled once per manager class
+        and backend; see :mod:`query.extract`.
+        """
+        key = (type(self), self.backend.name)
+        if key not in _extractors:
+            _extractors[key] = extract.compile_schema(self.schema, self.backend)
+        return _extractors[key]
 
-    def process_searchresults(self, results, query):
-        for entry in results.findall('.//IdList/Id'):
-            identifier = entry.text
-            paper = Paper.objects.get_or_create(identifier=identifier,
-                                                source=self.db)[0]
-            # result = Result(paper=paper, query=query)
-            # result.save()
-            query.results.add(paper)
-        query.save()
+    def parse_resource(self, e, identifier):
+        """
+        Extracts a plain record from a single-record EFetch response, or from
+        the record element itself; see :func:`query.ingest.process_records`.
+        """
+        record = e if e.tag == self.record_path else e.find(self.record_path)
+        if record is None:
+            raise ValueError('No {0} element in the response'
+                             .format(self.record_path))
+        with metrics.stage('extract'):
+            values = self.get_extractor()(record)
+        values['identifier'] = identifier
+        return values
 
     def process_resource(self, e, identifier):
-        date = self.handle_date(e)
-        title = get_smart(e, './/ArticleTitle')
-        abstract = self.handle_abstract(e)
+        return self.process_records([self.parse_resource(e, identifier)])[0]
+
+    def process_records(self, records):
+        lookups = get_lookup_cache()
+        before = lookups.info()
+        with metrics.stage('process_records', queries=True) as counts:
+            papers = ingest.process_records(records, self.db)
+            after = lookups.info()
+            counts.update(records=len(papers),
+                          cache_hits=after['hits'] - before['hits'],
+                          cache_misses=after['misses'] - before['misses'])
+        cache.invalidate_papers([paper.pk for paper in papers])
+        return papers
+
+    def normalize_identifier(self, identifier):
+        return unicode(identifier).strip()
+
+    def iter_records(self, stream):
+        """
+        Incrementally parses a batched EFetch response from ``stream``,
+        yielding (identifier, element) pairs for each record as soon as it has
+        been read. Each record is wrapped in an empty copy of the response
+        root, so that :meth:`.parse_resource` sees the same structure as it
+        would for a single-record response.
 
-        p, created = Paper.objects.get_or_create(identifier=identifier,
-                                        source=self.db)
-        p.pubdate = date
-        p.title = title
-        p.abstract = abstract
+        Records are cleared once the caller asks for the next one, so only
+        one record is held in memory at a time.
 
-        grants = self.handle_grants(e)
-        for grant in grants:
-            p.funding.add(grant)
+        The time spent parsing, excluding the caller's, is recorded as the
+        ``iter_records`` stage.
+        """
+        root, depth = None, 0
+        elements, records = 0, 0
+        busy, resumed = 0., time.time()
+        try:
+            for event, elem in self.backend.iterparse(stream,
+                                                      ('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+
+                elements += 1
+                depth -= 1
+                if depth != 1:
+                    continue
+                root.remove(elem)
+                if elem.tag == self.record_path:
+                    wrapper = self.backend.element(root.tag, root.attrib)
+                    wrapper.append(elem)
+                    records += 1
+                    busy, resumed = busy + time.time() - resumed, None
+                    yield get_smart(elem, self.record_id_path), wrapper
+                    resumed = time.time()
+                elem.clear()
+        finally:
+            stream.close()
+            if resumed is not None:
+                busy += time.time() - resumed
+            metrics.record('iter_records', busy, {'elements': elements,
+                                                  'records': records})
+
+    def parse_records(self, stream, identifiers=None, archive=True):
+        """
+        Parses a batched EFetch response into records for
+        :meth:`.process_records`. If ``identifiers`` is given, only records
+        for those identifiers are kept, under the identifiers as given.
 
-        authors = self.handle_authors(e, date)
-        for author in authors:
-            p.authors.add(author)
+        If the manager has an archive, each record is also written to it,
+        unless ``archive`` is False.
+        """
+        if identifiers is not None:
+            requested = dict([(self.normalize_identifier(identifier), identifier)
+                              for identifier in identifiers])
+
+        records = []
+        for record_id, record in self.iter_records(stream):
+            if identifiers is not None:
+                record_id = requested.get(self.normalize_identifier(record_id))
+                if record_id is None:
+                    continue
+            parsed = self.parse_resource(record, record_id)
+            if archive and self.archive is not None:
+                parsed['digest'] = self.archive.put(
+                    self.backend.tostring(record))
+            records.append(parsed)
+        return records
+
+    def archived(self, identifiers, since=None):
+        """
+        Returns a dict of the digests of the most recently archived EFetch
+        records for ``identifiers``, retrieved on or after ``since`` if given.
+        """
+        digests = {}
+        for chunk in ingest.chunked(identifiers):
+            entries = ArchivedRecord.objects.filter(
+                source=self.db, kind=ArchivedRecord.EFETCH,
+                identifier__in=chunk)
+            if since is not None:
+                entries = entries.filter(retrieved_on__gte=since)
+            digests.update(entries.order_by('retrieved_on', 'pk')
+                                  .values_list('identifier', 'digest'))
+        return digests
+
+    def fresh(self, identifiers):
+        """
+        Returns a dict of the digests of the archived EFetch records for
+        ``identifiers`` that are younger than the archive's TTL, which are
+        read from the archive rather than from the network.
+        """
+        if self.archive is None or self.archive.fresh_since() is None:
+            return {}
+        return self.archived(identifiers, self.archive.fresh_since())
 
-        headings = self.handle_headings(e)
-        for heading in headings:
-            p.mesh_headings.add(heading)
+    def open_history(self, query, retstart, retmax):
+        """
+        Opens an EFetch response for ``retmax`` records of the result set of
+        ``query`` on the history server, starting at ``retstart``.
+        """
+        if not query.webenv or not query.query_key:
+            raise ValueError('Query has no history server session; execute it'
+                             ' first.')
+        return self.open_resource(self.historypoint,
+                                  webenv=urllib2.quote(query.webenv),
+                                  query_key=query.query_key,
+                                  retstart=retstart, retmax=retmax)
+
+    def fetch_many(self, identifiers, batch_size=None):
+        """
+        Retrieves many records using one EFetch request per ``batch_size``
+        identifiers. Identifiers that are not present in the response are
+        skipped.
 
-        journal = self.handle_journal(e)
-        if journal is not None:
-            p.published_in = journal
+        Records in the archive that are younger than its TTL are read from
+        the archive instead.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        identifiers = [unicode(identifier) for identifier in identifiers]
+        fresh = self.fresh(identifiers)
+
+        papers = []
+        for start in xrange(0, len(identifiers), batch_size):
+            batch = identifiers[start:start + batch_size]
+            records = []
+            for identifier in batch:
+                if identifier in fresh:
+                    stream = self.archive.open(fresh[identifier])
+                    records.extend(self.parse_records(stream, [identifier],
+                                                      archive=False))
+            batch = [identifier for identifier in batch
+                     if identifier not in fresh]
+            if batch:
+                stream = self.open_resource(self.endpoint, term=','.join(batch))
+                records.extend(self.parse_records(stream, batch))
+            papers.extend(self.process_records(records))
+        return papers
+
+    def fetch_history(self, query, batch_size=None):
+        """
+        Retrieves the full result set of an executed query from the Entrez
+        history server, ``batch_size`` records per EFetch request. Papers are
+        yielded as each batch is processed, so memory use does not grow with
+        the size of the result set.
 
-        p.save()
-        return p
+        NCBI expires history sessions after a few hours of inactivity; re-run
+        :meth:`.search` to obtain a fresh ``WebEnv``.
+        """
+        if not query.webenv or not query.query_key:
+            raise ValueError('Query has no history server session; execute it'
+                             ' first.')
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        for retstart in xrange(0, query.result_count, batch_size):
+            stream = self.open_history(query, retstart, batch_size)
+            for paper in self.process_records(self.parse_records(stream)):
+                yield paper
+
+    def search_pages(self, query, since=None, datetype='edat'):
+        """
+        Pages through the result set of ``query``, ``query.retmax`` IDs per
+        ESearch request, yielding (results, processed, total) for each page.
+
+        If ``since`` (a date) is given, only records whose ``datetype`` date
+        (``edat``, when the record was added to Entrez, or ``mdat``, when it
+        was last modified) falls on or after it are returned. Otherwise, the
+        first request is posted to the history server, and the resulting
+        ``WebEnv``, ``query_key`` and count are stored on ``query`` for use by
+        :meth:`.fetch_history`.
+        """
+        dates = ''
+        if since is not None:
+            dates = '&datetype={0}&mindate={1:%Y/%m/%d}&maxdate={2:%Y/%m/%d}' \
+                    .format(datetype, since, datetime.date.today())
+        usehistory = since is None
+
+        retstart = 0
+        while True:
+            results = self.get_resource(self.searchpoint,
+                                        term=urllib2.quote(query.querystring),
+                                        retmax=query.retmax,
+                                        retstart=retstart,
+                                        usehistory='y' if usehistory else 'n',
+                                        dates=dates)
+            count = get_smart(results, 'Count')
+            count = int(count) if count else 0
+            if self.archive is not None:
+                key = '{0}:{1}:{2}'.format(query.pk,
+                                           datetype if since else 'all',
+                                           retstart)
+                ingest.archive(self.db, ArchivedRecord.ESEARCH,
+                               [(key, self.archive.put(
+                                   self.backend.tostring(results)))])
+            if usehistory:
+                query.result_count = count
+                query.webenv = get_smart(results, 'WebEnv')
+                query.query_key = get_smart(results, 'QueryKey')
+                usehistory = False
+
+            retstart += query.retmax
+            yield results, min(retstart, count), count
+            if query.retmax < 1 or retstart >= count:
+                break
+
+    def search(self, query, callback=None, since=None):
+        """
+        Adds the IDs in the result set of ``query`` to its results; see
+        :meth:`.search_pages`.
 
+        If given, ``callback`` is called after each page with the number of
+        IDs processed so far and the total.
+        """
+        for results, processed, total in self.search_pages(query, since):
+            self.process_searchresults(results, query)
+            if callback is not None:
+                callback(processed, total)
 
-class PMCManager(PubMedManager):
-    db = 'PMC'
+    def refresh(self, query, callback=None):
+        """
+        Brings the results of an executed query up to date without repeating
+        the full search: only IDs added to Entrez since the query was last
+        executed are added, and results whose records were modified since then
+        are marked as not retrieved, so that the next retrieval fetches them
+        again. Queries that have never been executed are searched in full.
+
+        Entrez dates have a resolution of one day, so the window starts the day
+        before ``query.executed_on``.
+        """
+        if query.executed_on is None:
+            return self.search(query, callback)
+
+        since = (query.executed_on - datetime.timedelta(days=1)).date()
+        for results, processed, total in self.search_pages(query, since,
+                                                           'mdat'):
+            identifiers = [e.text for e in results.findall('.//IdList/Id')]
+            for chunk in ingest.chunked(identifiers):
+                changed = query.results.filter(source=self.db,
+                                               identifier__in=chunk)
+                pks = list(changed.values_list('pk', flat=True))
+                Paper.objects.filter(pk__in=pks).update(retrieved=False)
+                cache.invalidate_papers(pks)
+        self.search(query, callback, since=since)
+
+def mesh_headings(heading_list, record):
+    """
+    Returns (descriptor, qualifier) pairs; qualifier is None for headings
+    without subheadings.
+    """
+    headings = []
+    for heading in heading_list:
+        descriptor = heading.find('DescriptorName')
+        if descriptor is None or not descriptor.text:
+            continue
+        descriptor = extract.fold(descriptor.text)
+        qualifiers = [q.text for q in heading.findall('QualifierName')
+                      if q.text is not None]
+        if qualifiers:
+            headings.extend([(descriptor, q) for q in qualifiers])
+        else:
+            headings.append((descriptor, None))
+    return headings
+
+
+def pmc_affiliations(contrib, article):
+    """
+    PMC uses xrefs, rather than including affiliation info in the author
+    element itself.
+    """
+    affiliations = []
+    meta = article.find('front/article-meta')
+    for xref in contrib.findall("xref[@ref-type='aff']"):
+        aff = meta.find("aff[@id='{0}']".format(xref.get('rid')))
+        if aff is None:
+            continue
+        addr = aff.find('.//addr-line')
+        if addr is not None and addr.text is not None:
+            affiliations.append(extract.fold(addr.text))
+    return affiliations
 
-    authorlist_path = './/contrib-group'
-    authorname_path = './/contrib[@contrib-type="author"]'
-    author_surname = './/name/surname'
-    author_forename = './/name/given-names'
-    author_initials = ''
 
-    date_path = './/article-meta/pub-date'
-    date_year_path = 'year'
-    date_month_path = 'month'
-    date_day_path = 'day'
-    journal_path = './/journal-meta'
-    journal_issn_path = './/issn'
-    journal_title_path = './/journal-title'
+class PubMedManager(NCBIManager):
+    db = 'PubMed'
+    record_path = 'PubmedArticle'
+    record_id_path = 'MedlineCitation/PMID'
+
+    schema = [
+        Scope('MedlineCitation', [
+            ('pubdate', Date('DateCreated', 'Year', 'Month', 'Day')),
+            ('headings', In('MeshHeadingList', Call(mesh_headings), list)),
+            Scope('Article', [
+                ('title', Text('ArticleTitle', fold=True)),
+                ('abstract', In('Abstract', Content('AbstractText'), u'')),
+                ('journal', Tuple('Journal', [
+                    Text('ISSN', fold=True),
+                    Text('Title', fold=True),
+                ], required=(1,))),
+                ('authors', In('AuthorList', Each('Author', [
+                    ('fore_name', Text('ForeName', fold=True)),
+                    ('last_name', Text('LastName', fold=True)),
+                    ('initials', Text('Initials', fold=True)),
+                    ('affiliations', In('AffiliationInfo',
+                                        Texts('Affiliation', fold=True),
+                                        list)),
+                ]), list)),
+                ('grants', In('GrantList', Each('*', [
+                    ('grant_id', Text('GrantID', fold=True)),
+                    ('acronym', Text('Acronym', fold=True)),
+                    ('agency', Text('Agency', fold=True)),
+                    ('country', Text('Country', fold=True)),
+                ]), list)),
+            ]),
+        ]),
+    ]
 
-    affiliation_path = './/article-meta'
-    affiliation_instance_path = 'aff'
+    def process_searchresults(self, results, query):
+        identifiers = [entry.text for entry in results.findall('.//IdList/Id')]
+        with metrics.stage('process_searchresults', queries=True) as counts:
+            papers = ingest.resolve_papers(identifiers, self.db)
+            ingest.link(Query._meta.get_field('results'),
+                        [(query.pk, paper.pk) for paper in papers])
+            query.save()
+            counts['records'] = len(papers)
+        cache.invalidate_query(query.pk)
 
-    abstract_path = './/article-meta/abstract'
-    abstract_section_path = './/sec/p'
 
-    def handle_affiliations(self, root, e):
+class PMCManager(PubMedManager):
+    db = 'PMC'
+    record_path = 'article'
+    record_id_path = './/article-meta/article-id[@pub-id-type="pmc"]'
+
+    schema = [
+        Scope('front/article-meta', [
+            ('pubdate', Date('pub-date', 'year', 'month', 'day')),
+            ('title', Text('title-group/article-title', fold=True)),
+            ('abstract', In('abstract', Content('.//sec/p'), u'')),
+            ('authors', In('contrib-group', Each(
+                'contrib[@contrib-type="author"]', [
+                    ('fore_name', Text('name/given-names', fold=True)),
+                    ('last_name', Text('name/surname', fold=True)),
+                    ('initials', Const('')),
+                    ('affiliations', Call(pmc_affiliations)),
+                ]), list)),
+        ]),
+        ('journal', Tuple('front/journal-meta', [
+            Text('issn', fold=True),
+            Text('.//journal-title', fold=True),
+        ], required=(1,))),
+        ('grants', Const(list)),
+        ('headings', Const(list)),
+    ]
+
+    def normalize_identifier(self, identifier):
         """
-        PMC uses xrefs, rather than including affiliation info in the author
-        element itself.
+        PMC identifiers may be given with or without the ``PMC`` prefix.
         """
-
-        affiliations = []
-        rids = [x.attrib['rid'] for x in e.findall("xref[@ref-type='aff']")]
-        aff_parent = root.find(self.affiliation_path)
-        if aff_parent is not None:
-            for rid in rids:
-                aff = aff_parent.find("aff[@id='{0}']".format(rid))
-                addr = aff.find('.//addr-line')
-                if addr is not None:
-                    aff_safe = unidecode(unicode(addr.text))
-                    i = Institution.objects.get_or_create(name=aff_safe)[0]
-                    affiliations.append(i)
-        return affiliations
+        identifier = unicode(identifier).strip()
+        if identifier.upper().startswith('PMC'):
+            identifier = identifier[3:]
+        return identifier
+
+
+def get_manager(dbname):
+    dbManagers = [
+        ('PubMed', PubMedManager),
+        ('PMC', PMCManager),
+    ]
+    return dict(dbManagers)[dbname]
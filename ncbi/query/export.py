@@ -0,0 +1,123 @@
+"""
+Streaming export of papers.
+
+Papers are read in primary-key order, ``chunk_size`` at a time, with their
+journal, authors, MeSH headings and grants prefetched for each chunk, so that
+exporting a result set takes a constant number of queries per chunk and
+constant memory regardless of its size. Each format is a generator of
+encoded text chunks, suitable for a file or a
+:class:`django.http.StreamingHttpResponse`.
+
+Formats:
+
+``csv``
+    One row per paper; list-valued columns are joined with ``'; '``.
+``jsonl``
+    One JSON object per line.
+``columnar``
+    Column-oriented row groups, one JSON object per line of the form
+    ``{"rows": n, "columns": {"title": [...], ...}}``, in the manner of
+    Parquet row groups. Each row group holds one chunk of papers.
+"""
+
+from collections import OrderedDict
+import csv
+import json
+
+COLUMNS = ['identifier', 'source', 'title', 'abstract', 'pubdate', 'journal',
+           'issn', 'authors', 'mesh_headings', 'grants']
+LIST_SEPARATOR = u'; '
+CHUNK_SIZE = 1000
+
+
+def iter_chunks(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Yields lists of papers from ``queryset`` with related rows prefetched,
+    paging on primary key.
+    """
+    queryset = queryset.order_by('pk').select_related('published_in') \
+                       .prefetch_related('authors',
+                                         'mesh_headings__descriptor',
+                                         'mesh_headings__qualifier',
+                                         'funding__awarded_by')
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1].pk
+
+
+def serialize(paper):
+    journal = paper.published_in
+    return OrderedDict([
+        ('identifier', paper.identifier),
+        ('source', paper.source),
+        ('title', paper.title),
+        ('abstract', paper.abstract),
+        ('pubdate', paper.pubdate.isoformat() if paper.pubdate else None),
+        ('journal', journal.title if journal else None),
+        ('issn', journal.issn if journal else None),
+        ('authors', [unicode(author) for author in paper.authors.all()]),
+        ('mesh_headings', [unicode(heading)
+                           for heading in paper.mesh_headings.all()]),
+        ('grants', [u'{0} ({1})'.format(grant.grant_id,
+                                        grant.awarded_by.name)
+                    for grant in paper.funding.all()]),
+    ])
+
+
+class Echo(object):
+    """
+    File-like object for :mod:`csv` that returns what is written to it.
+    """
+    def write(self, value):
+        return value
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = LIST_SEPARATOR.join(value)
+    return unicode(value).encode('utf-8')
+
+
+def write_csv(chunks):
+    writer = csv.writer(Echo())
+    yield writer.writerow(COLUMNS)
+    for chunk in chunks:
+        yield ''.join([writer.writerow([_encode(value) for value
+                                        in serialize(paper).values()])
+                       for paper in chunk])
+
+
+def write_jsonl(chunks):
+    for chunk in chunks:
+        yield ''.join([json.dumps(serialize(paper)) + '\n' for paper in chunk])
+
+
+def write_columnar(chunks):
+    for chunk in chunks:
+        columns = OrderedDict([(column, []) for column in COLUMNS])
+        for paper in chunk:
+            for column, value in serialize(paper).iteritems():
+                columns[column].append(value)
+        yield json.dumps({'rows': len(chunk), 'columns': columns}) + '\n'
+
+
+FORMATS = OrderedDict([
+    ('csv', ('text/csv', write_csv)),
+    ('jsonl', ('application/x-ndjson', write_jsonl)),
+    ('columnar', ('application/x-ndjson', write_columnar)),
+])
+
+
+def export(queryset, format='csv', chunk_size=CHUNK_SIZE):
+    """
+    Returns a generator of encoded chunks of the papers in ``queryset``.
+    """
+    content_type, writer = FORMATS[format]
+    return writer(iter_chunks(queryset, chunk_size))
@@ -0,0 +1,352 @@
+"""
+Table-driven extraction of fields from EFetch records.
+
+Each manager in :mod:`query.connector` describes its records with a
+``schema``: a list of ``(field, spec)`` pairs and :class:`Scope` entries. A
+spec says where a value is, relative to the element that contains it, and
+how to convert it. :func:`compile_schema` turns a schema into one function
+of a record element, once per manager class and backend. A :class:`Scope`
+finds an element once for all of the fields under it, so no field is looked
+up by scanning the whole record.
+
+Text is folded to ASCII with ``unidecode`` only for fields declared with
+``fold=True``, which are those that name people, institutions, journals,
+grants and MeSH terms, and the title, as before; and only when the text is
+not ASCII already.
+
+Records are parsed with ElementTree, or, when the ``NCBI_XML_PARSER``
+setting is ``'lxml'``, with lxml, and paths are evaluated with precompiled
+XPath expressions.
+"""
+
+import datetime
+import operator
+import xml.etree.ElementTree as ET
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from unidecode import unidecode
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+class ElementTreeBackend(object):
+    name = 'etree'
+    parse = staticmethod(ET.parse)
+    iterparse = staticmethod(ET.iterparse)
+    tostring = staticmethod(ET.tostring)
+
+    def element(self, tag, attrib):
+        return ET.Element(tag, attrib)
+
+    def find(self, path):
+        return operator.methodcaller('find', path)
+
+    def findall(self, path):
+        return operator.methodcaller('findall', path)
+
+
+class LxmlBackend(object):
+    name = 'lxml'
+
+    def parse(self, source):
+        return lxml_etree.parse(source)
+
+    def iterparse(self, source, events):
+        return lxml_etree.iterparse(source, events=events)
+
+    def tostring(self, element):
+        return lxml_etree.tostring(element)
+
+    def element(self, tag, attrib):
+        return lxml_etree.Element(tag, dict(attrib))
+
+    def find(self, path):
+        xpath = lxml_etree.XPath(path)
+
+        def find(element):
+            found = xpath(element)
+            return found[0] if found else None
+        return find
+
+    def findall(self, path):
+        return lxml_etree.XPath(path)
+
+
+def get_backend():
+    """
+    Returns the parser backend configured by the ``NCBI_XML_PARSER``
+    setting.
+    """
+    name = getattr(settings, 'NCBI_XML_PARSER', 'etree')
+    if name == 'lxml':
+        if lxml_etree is None:
+            raise ImproperlyConfigured('NCBI_XML_PARSER is lxml, but lxml is '
+                                       'not installed.')
+        return LxmlBackend()
+    return ElementTreeBackend()
+
+
+def fold(text):
+    """
+    Folds ``text`` to ASCII, skipping the work for text that already is.
+    """
+    if text is None or isinstance(text, str):
+        return text
+    try:
+        return text.encode('ascii')
+    except UnicodeEncodeError:
+        return unidecode(text)
+
+
+class Text(object):
+    """
+    Text of the first element at ``path``; ``''`` if there is none, and None
+    if it is empty.
+    """
+
+    def __init__(self, path, fold=False):
+        self.path = path
+        self.fold = fold
+
+    def compile(self, backend):
+        find = backend.find(self.path)
+        convert = fold if self.fold else None
+
+        def extract(element, record):
+            found = find(element)
+            if found is None:
+                return ''
+            if convert is None:
+                return found.text
+            return convert(found.text)
+        return extract
+
+
+class Texts(object):
+    """
+    Non-empty texts of all elements at ``path``.
+    """
+
+    def __init__(self, path, fold=False):
+        self.path = path
+        self.fold = fold
+
+    def compile(self, backend):
+        findall = backend.findall(self.path)
+        if self.fold:
+            return lambda element, record: [fold(found.text) for found
+                                            in findall(element)
+                                            if found.text is not None]
+        return lambda element, record: [found.text for found
+                                        in findall(element)
+                                        if found.text is not None]
+
+
+class Content(object):
+    """
+    Text content, markup removed, of the elements at ``path``, joined by
+    spaces.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def compile(self, backend):
+        findall = backend.findall(self.path)
+        return lambda element, record: u' '.join([
+            u''.join(found.itertext()) for found in findall(element)])
+
+
+MONTHS = dict((name, number) for number, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct',
+     'nov', 'dec'], 1))
+
+
+def _date_part(element):
+    """
+    The number in ``element``, or the month that it names (e.g. ``Nov`` or
+    ``November``); None if it is missing or neither.
+    """
+    if element is None or not element.text:
+        return None
+    text = element.text.strip()
+    if text.isdigit():
+        return int(text)
+    return MONTHS.get(text[:3].lower())
+
+
+class Date(object):
+    """
+    A date from the ``year``, ``month`` and ``day`` children of the element
+    at ``path``. Months may be numbers or names; a month or day that is
+    missing or invalid defaults to 1. None if there is no such element, or
+    no valid year.
+    """
+
+    def __init__(self, path, year, month, day):
+        self.path = path
+        self.parts = (year, month, day)
+
+    def compile(self, backend):
+        find = backend.find(self.path)
+        parts = [backend.find(part) for part in self.parts]
+
+        def extract(element, record):
+            found = find(element)
+            if found is None:
+                return None
+            year, month, day = [_date_part(part(found)) for part in parts]
+            if not year:
+                return None
+            if month is None or not 1 <= month <= 12:
+                month = 1
+            try:
+                return datetime.date(year, month, day or 1)
+            except ValueError:
+                return datetime.date(year, month, 1)
+        return extract
+
+
+class Tuple(object):
+    """
+    Tuple of the values of ``specs`` within the first element at ``path``;
+    None if there is no such element, or if any of the values at the indices
+    in ``required`` is ``''``.
+    """
+
+    def __init__(self, path, specs, required=()):
+        self.path = path
+        self.specs = specs
+        self.required = required
+
+    def compile(self, backend):
+        find = backend.find(self.path)
+        specs = [spec.compile(backend) for spec in self.specs]
+        required = self.required
+
+        def extract(element, record):
+            found = find(element)
+            if found is None:
+                return None
+            values = tuple([spec(found, record) for spec in specs])
+            for index in required:
+                if values[index] == '':
+                    return None
+            return values
+        return extract
+
+
+class Each(object):
+    """
+    A dict of the fields of ``schema`` for each element at ``path``.
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+
+    def compile(self, backend):
+        findall = backend.findall(self.path)
+        fields = _compile_fields(self.schema, backend)
+        return lambda element, record: [fields(found, record, {})
+                                        for found in findall(element)]
+
+
+class In(object):
+    """
+    The value of ``spec`` within the first element at ``path``, or
+    ``default`` if there is none.
+    """
+
+    def __init__(self, path, spec, default=None):
+        self.path = path
+        self.spec = spec
+        self.default = default
+
+    def compile(self, backend):
+        find = backend.find(self.path)
+        spec = self.spec.compile(backend)
+        default = self.default
+
+        def extract(element, record):
+            found = find(element)
+            if found is None:
+                return default() if callable(default) else default
+            return spec(found, record)
+        return extract
+
+
+class Const(object):
+    """
+    A constant; if ``value`` is callable, the result of calling it.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def compile(self, backend):
+        value = self.value
+        if callable(value):
+            return lambda element, record: value()
+        return lambda element, record: value
+
+
+class Call(object):
+    """
+    The result of calling ``function`` with the element and the record, for
+    fields that do not fit the other specs.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def compile(self, backend):
+        return self.function
+
+
+class Scope(object):
+    """
+    The fields of ``schema`` within the first element at ``path``, added to
+    the enclosing dict. If there is no such element, the fields are
+    extracted from an empty element.
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+
+
+def _compile_fields(schema, backend):
+    steps = []
+    for entry in schema:
+        if isinstance(entry, Scope):
+            steps.append((None, backend.find(entry.path),
+                          _compile_fields(entry.schema, backend)))
+        else:
+            field, spec = entry
+            steps.append((field, None, spec.compile(backend)))
+    empty = backend.element('empty', {})
+
+    def extract(element, record, values):
+        for field, find, spec in steps:
+            if find is None:
+                values[field] = spec(element, record)
+            else:
+                found = find(element)
+                spec(found if found is not None else empty, record, values)
+        return values
+    return extract
+
+
+def compile_schema(schema, backend):
+    """
+    Returns a function of a record element that returns a dict of the
+    fields of ``schema``.
+    """
+    fields = _compile_fields(schema, backend)
+    return lambda record: fields(record, record, {})
+
@@ -0,0 +1,293 @@
+"""
+Co-occurrence graphs over the results of a query.
+
+Each graph is built from ``(paper, item)`` incidence pairs read from the
+through tables in primary-key order, ``chunk_size`` rows at a time, with
+``values_list``:
+
+* :func:`coauthorship`: people (or disambiguated authors) who wrote a paper
+  together;
+* :func:`mesh_cooccurrence`: MeSH descriptors that head the same paper;
+* :func:`funder_institution`: funding agencies and the institutions of the
+  authors of the papers they funded (a bipartite graph).
+
+Edge weights count the papers that two nodes share. With SciPy installed
+they are computed as the sparse product of the paper-item incidence matrix
+with its transpose; otherwise, by counting the pairs of items on each
+paper. Papers with more than ``max_items`` items (e.g. consortium papers
+with thousands of authors) are left out of the edge counts, since they
+would add a clique of that size. In a bipartite graph, the edges only link
+the two sides, and each side is held to ``max_items`` on its own.
+"""
+
+from collections import defaultdict, OrderedDict
+from itertools import combinations
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+from .models import (Agency, Author, Authorship, Institution, MeSHDescriptor,
+                     Paper, Person)
+from .ingest import affiliated_institutions, chunked
+
+CHUNK_SIZE = 10000
+MAX_ITEMS = 200
+
+
+class Graph(object):
+    """
+    Weighted undirected graph. ``nodes`` maps node ids such as
+    ``'person-12'`` to labels; ``edges`` is a list of ``(source, target,
+    weight)`` tuples.
+    """
+    def __init__(self, nodes, edges):
+        self.nodes = nodes
+        self.edges = edges
+
+    def write_edgelist(self, output):
+        output.write('source\tsource_label\ttarget\ttarget_label\tweight\n')
+        for source, target, weight in self.edges:
+            output.write(u'{0}\t{1}\t{2}\t{3}\t{4}\n'.format(
+                source, self.nodes[source], target, self.nodes[target],
+                weight).encode('utf-8'))
+
+    def write_graphml(self, output):
+        output.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+            '<key id="label" for="node" attr.name="label" '
+            'attr.type="string"/>\n'
+            '<key id="kind" for="node" attr.name="kind" '
+            'attr.type="string"/>\n'
+            '<key id="weight" for="edge" attr.name="weight" '
+            'attr.type="int"/>\n'
+            '<graph edgedefault="undirected">\n')
+        for node, label in self.nodes.iteritems():
+            output.write(
+                u'<node id={0}><data key="label">{1}</data>'
+                u'<data key="kind">{2}</data></node>\n'.format(
+                    quoteattr(node), escape(label),
+                    node.split('-', 1)[0]).encode('utf-8'))
+        for source, target, weight in self.edges:
+            output.write(
+                u'<edge source={0} target={1}><data key="weight">{2}</data>'
+                u'</edge>\n'.format(quoteattr(source), quoteattr(target),
+                                    weight).encode('utf-8'))
+        output.write('</graph>\n</graphml>\n')
+
+
+def incidence(queryset, item, chunk_size=CHUNK_SIZE):
+    """
+    Yields ``(paper id, item)`` pairs from a queryset over a through table,
+    paging on its primary key. Pairs with no item are skipped.
+    """
+    queryset = queryset.order_by('pk').values_list('pk', 'paper_id', item)
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(pk__gt=last)
+        rows = list(page[:chunk_size])
+        if not rows:
+            return
+        for pk, paper, value in rows:
+            if value is not None:
+                yield paper, value
+        last = rows[-1][0]
+
+
+def _papers(pairs, max_items):
+    """
+    Returns a dict mapping each paper with at most ``max_items`` items to
+    the set of its items.
+    """
+    items = defaultdict(set)
+    for paper, item in pairs:
+        items[paper].add(item)
+    return dict((paper, group) for paper, group in items.iteritems()
+                if max_items is None or len(group) <= max_items)
+
+
+def _index(groups):
+    """
+    Returns the sorted distinct items of ``groups``, and for each group, the
+    sorted indices of its items among them.
+    """
+    values = sorted(set().union(*groups))
+    index = dict((value, i) for i, value in enumerate(values))
+    return values, [sorted([index[item] for item in group])
+                    for group in groups]
+
+
+def _group(pairs, max_items):
+    return _index(_papers(pairs, max_items).values())
+
+
+def _incidence_matrix(groups, columns):
+    rows, cols = [], []
+    for row, group in enumerate(groups):
+        rows.extend([row] * len(group))
+        cols.extend(group)
+    return scipy.sparse.csr_matrix(
+        (numpy.ones(len(rows), dtype=numpy.int32), (rows, cols)),
+        shape=(len(groups), columns))
+
+
+def cooccurrence(pairs, max_items=MAX_ITEMS):
+    """
+    Returns ``(a, b, count)`` for each pair of items that share ``count``
+    papers, with ``a < b``, in order.
+    """
+    values, groups = _group(pairs, max_items)
+    n = len(values)
+    if scipy is not None:
+        incidence = _incidence_matrix(groups, n)
+        counts = scipy.sparse.triu(incidence.T * incidence, k=1).tocsr()
+        counts.sort_indices()
+        counts = counts.tocoo()
+        return [(values[i], values[j], int(count)) for i, j, count
+                in zip(counts.row.tolist(), counts.col.tolist(),
+                       counts.data.tolist())]
+
+    # Pairs of item indices are keyed as single integers, which hash and
+    # sort much faster than tuples.
+    counts = defaultdict(int)
+    for group in groups:
+        for i, j in combinations(group, 2):
+            counts[i * n + j] += 1
+    return [(values[key // n], values[key % n], counts[key])
+            for key in sorted(counts)]
+
+
+def bipartite(left, right, max_items=MAX_ITEMS):
+    """
+    Returns ``(a, b, count)`` for each item ``a`` of ``left`` and ``b`` of
+    ``right`` that share ``count`` papers, from ``(paper, item)`` pairs,
+    ordered in ``a``, then ``b``.
+    """
+    lpapers = _papers(left, max_items)
+    rpapers = _papers(right, max_items)
+    papers = [paper for paper in lpapers if paper in rpapers]
+    if not papers:
+        return []
+    lvalues, lgroups = _index([lpapers[paper] for paper in papers])
+    rvalues, rgroups = _index([rpapers[paper] for paper in papers])
+    if scipy is not None:
+        # Rows of both incidence matrices are the same papers, so their
+        # product counts the papers shared across the sides only.
+        counts = (_incidence_matrix(lgroups, len(lvalues)).T *
+                  _incidence_matrix(rgroups, len(rvalues))).tocsr()
+        counts.sort_indices()
+        counts = counts.tocoo()
+        return [(lvalues[i], rvalues[j], int(count)) for i, j, count
+                in zip(counts.row.tolist(), counts.col.tolist(),
+                       counts.data.tolist())]
+
+    m = len(rvalues)
+    counts = defaultdict(int)
+    for lgroup, rgroup in zip(lgroups, rgroups):
+        for i in lgroup:
+            for j in rgroup:
+                counts[i * m + j] += 1
+    return [(lvalues[key // m], rvalues[key % m], counts[key])
+            for key in sorted(counts)]
+
+
+def _labels(model, ids, fields):
+    labels = {}
+    for chunk in chunked(ids):
+        for row in model.objects.filter(pk__in=chunk) \
+                                .values_list('pk', *fields):
+            labels[row[0]] = u' '.join([value for value in row[1:] if value])
+    return labels
+
+
+def _graph(edges, left, right=None):
+    """
+    Labels the nodes of ``edges``; ``left`` and ``right`` are ``(kind,
+    model, label fields)`` for the two ends of the edges.
+    """
+    sources = set([a for a, b, count in edges])
+    targets = set([b for a, b, count in edges])
+    lkind, model, fields = left
+    if right is None:
+        # Both ends are the same kind of node, labelled in one pass.
+        rkind = lkind
+        llabels = rlabels = _labels(model, sources | targets, fields)
+    else:
+        llabels = _labels(model, sources, fields)
+        rkind, model, fields = right
+        rlabels = _labels(model, targets, fields)
+
+    nodes = OrderedDict()
+    named = []
+    for a, b, count in edges:
+        source = u'{0}-{1}'.format(lkind, a)
+        target = u'{0}-{1}'.format(rkind, b)
+        nodes.setdefault(source, llabels.get(a, u''))
+        nodes.setdefault(target, rlabels.get(b, u''))
+        named.append((source, target, count))
+    return Graph(nodes, named)
+
+
+def _results(query):
+    return Paper.objects.filter(query=query).values('pk')
+
+
+def coauthorship(query, disambiguated=False, max_items=MAX_ITEMS,
+                 chunk_size=CHUNK_SIZE):
+    """
+    Collaboration graph of the people, or with ``disambiguated`` the
+    Authors, who wrote the results of ``query``.
+    """
+    authorships = Authorship.objects.filter(paper__in=_results(query))
+    if disambiguated:
+        item, node = 'author_id', ('author', Author, ('fore_name', 'last_name'))
+    else:
+        item, node = 'person_id', ('person', Person, ('fore_name', 'last_name'))
+    edges = cooccurrence(incidence(authorships, item, chunk_size), max_items)
+    return _graph(edges, node)
+
+
+def mesh_cooccurrence(query, max_items=MAX_ITEMS, chunk_size=CHUNK_SIZE):
+    """
+    Co-occurrence graph of the MeSH descriptors heading the results of
+    ``query``, regardless of qualifier.
+    """
+    headings = Paper.mesh_headings.through.objects.filter(
+        paper__in=_results(query))
+    edges = cooccurrence(incidence(headings, 'meshheading__descriptor_id',
+                                   chunk_size), max_items)
+    return _graph(edges, ('descriptor', MeSHDescriptor, ('descriptor',)))
+
+
+def funder_institution(query, max_items=MAX_ITEMS, chunk_size=CHUNK_SIZE):
+    """
+    Bipartite graph linking the agencies that funded the results of
+    ``query`` to the institutions their authors were affiliated with.
+    """
+    fundings = Paper.funding.through.objects.filter(paper__in=_results(query))
+    agencies = list(incidence(fundings, 'grant__awarded_by_id', chunk_size))
+
+    # An author's institutions for a paper are those of their affiliations
+    # recorded with it or, for older rows, dated with its publication date.
+    authorships = Authorship.objects.filter(paper__in=_results(query))
+    written = list(incidence(authorships, 'person_id', chunk_size))
+    pubdates = dict(Paper.objects.filter(query=query)
+                                 .values_list('pk', 'pubdate'))
+    affiliations = affiliated_institutions(written, pubdates)
+    institutions = [(paper, institution) for paper, person in written
+                    for institution in affiliations[(paper, person)]]
+
+    edges = bipartite(agencies, institutions, max_items)
+    return _graph(edges, ('agency', Agency, ('name',)),
+                  ('institution', Institution, ('name',)))
+
+
+GRAPHS = OrderedDict([
+    ('coauthorship', coauthorship),
+    ('mesh', mesh_cooccurrence),
+    ('funder-institution', funder_institution),
+])
@@ -0,0 +1,453 @@
+"""
+Bulk resolution of parsed records into model instances.
+
+The managers in :mod:`query.connector` parse each article into a plain
+record (see :meth:`PubMedManager.parse_resource`). :func:`process_records`
+then resolves every entity type in a batch of records with one lookup and
+one ``bulk_create``, so the number of queries per batch does not grow with
+the number of authors, headings or grants in it.
+
+Workers may save records that share rows at the same time. Each insert runs
+in a savepoint; when one fails on a unique constraint because another worker
+created some of the same rows after they were looked up, those rows are
+looked up again and the rest inserted (see :func:`insert`).
+"""
+
+from collections import defaultdict
+import datetime
+import operator
+import re
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from unidecode import unidecode
+
+from .models import *
+from .lookup import get_lookup_cache
+from . import search
+
+# Keeps ``__in`` lookups under SQLite's limit on query parameters.
+CHUNK_SIZE = 500
+# Inserts of rows that other workers keep creating meanwhile.
+INSERT_ATTEMPTS = 3
+
+
+def chunked(items, size=CHUNK_SIZE):
+    items = list(items)
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def normalize_name(name):
+    """
+    Lowercase ASCII letters and spaces of ``name``.
+    """
+    return re.sub(r'[^a-z ]', '', unidecode(unicode(name or u'')).lower())
+
+
+def blocking_key(fore_name, last_name, initials=u''):
+    """
+    Surname and first initial, e.g. ``u'smith j'`` for "John Smith", which
+    groups the candidates compared by :mod:`query.authors`.
+    """
+    surname = normalize_name(last_name).replace(u' ', u'')
+    first = (normalize_name(fore_name) or normalize_name(initials)).strip()
+    return u'{0} {1}'.format(surname, first[:1])
+
+
+def insert(model, rows, build, existing):
+    """
+    Creates ``build(row)`` for each of ``rows`` with one ``bulk_create``, in
+    a savepoint. If another transaction created some of the rows since they
+    were found missing, the insert fails on a unique constraint and rolls
+    back to the savepoint; the rows in ``existing(rows)``, a set, are then
+    dropped and the rest inserted again.
+    """
+    rows = set(rows)
+    for attempt in xrange(INSERT_ATTEMPTS):
+        if not rows:
+            return
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([build(row) for row in rows])
+            return
+        except IntegrityError:
+            if attempt == INSERT_ATTEMPTS - 1:
+                raise
+            rows -= existing(rows)
+
+
+def _lookup(model, keys, fields):
+    """
+    Fetches the instances of ``model`` with the given natural keys. Composite
+    keys are matched as a whole, so that each lookup is answered by the
+    index on ``fields`` rather than by every row sharing the first field.
+    """
+    found = {}
+    if len(fields) == 1:
+        first = sorted(set([key[0] for key in keys]))
+        queries = [Q(**{fields[0] + '__in': chunk}) for chunk in chunked(first)]
+    else:
+        queries = [reduce(operator.or_, [Q(**dict(zip(fields, key)))
+                                         for key in chunk])
+                   for chunk in chunked(sorted(keys),
+                                        CHUNK_SIZE // len(fields))]
+    for query in queries:
+        for obj in model.objects.filter(query).order_by('pk'):
+            key = tuple([getattr(obj, field) for field in fields])
+            if key in keys:
+                found.setdefault(key, obj)
+    return found
+
+
+def resolve(model, keys, fields, defaults=None, cache=None):
+    """
+    Returns a dict mapping each natural key in ``keys`` to an instance of
+    ``model``, creating any that do not exist yet.
+
+    Parameters
+    ----------
+    model : :class:`django.db.models.Model`
+    keys : iterable
+        Tuples of field values, in the order given by ``fields``.
+    fields : tuple
+        Field attribute names (e.g. ``descriptor_id``) that make up the key.
+    defaults : callable
+        Called with a missing key; returns extra field values for the new
+        instance.
+    cache : :class:`query.lookup.LRUCache`
+        If given, consulted before the database and filled with the result.
+    """
+    keys = set(keys)
+    if not keys:
+        return {}
+
+    cached = {}
+    if cache is not None:
+        for key in keys:
+            obj = cache.get(model, key)
+            if obj is not None:
+                cached[key] = obj
+        keys -= set(cached)
+        if not keys:
+            return cached
+
+    found = _lookup(model, keys, fields)
+    missing = set([key for key in keys if key not in found])
+    if missing:
+        def build(key):
+            values = dict(zip(fields, key))
+            if defaults is not None:
+                values.update(defaults(key))
+            return model(**values)
+        insert(model, missing, build,
+               lambda keys: set(_lookup(model, keys, fields)))
+        found.update(_lookup(model, missing, fields))
+
+    if cache is not None:
+        for key, obj in found.iteritems():
+            cache.set(model, key, obj)
+    found.update(cached)
+    return found
+
+
+def link(field, pairs):
+    """
+    Adds ``(source_id, target_id)`` rows to the through table of the
+    many-to-many ``field``, skipping rows that already exist.
+    """
+    through = field.rel.through
+    source = field.m2m_field_name() + '_id'
+    target = field.m2m_reverse_field_name() + '_id'
+
+    def existing(pairs):
+        linked = set()
+        for chunk in chunked(set([pair[0] for pair in pairs])):
+            linked.update(through.objects.filter(**{source + '__in': chunk})
+                                         .values_list(source, target))
+        return linked & pairs
+
+    pairs = set(pairs)
+    if not pairs:
+        return
+    insert(through, pairs - existing(pairs),
+           lambda pair: through(**{source: pair[0], target: pair[1]}),
+           existing)
+
+
+def append(model, fields, rows, by):
+    """
+    Adds the ``rows``, tuples of values of ``fields``, that ``model`` does
+    not have yet, with one ``bulk_create``. Existing rows are looked up on
+    the field ``by``, one of ``fields``, which should be indexed.
+    """
+    index = fields.index(by)
+
+    def existing(rows):
+        found = set()
+        for chunk in chunked(set([row[index] for row in rows])):
+            found.update(model.objects.filter(**{by + '__in': chunk})
+                                      .values_list(*fields))
+        return found & rows
+
+    rows = set(rows)
+    if not rows:
+        return
+    insert(model, rows - existing(rows),
+           lambda row: model(**dict(zip(fields, row))), existing)
+
+
+def affiliated_institutions(pairs, pubdates):
+    """
+    Returns a dict mapping each ``(paper_id, person_id)`` pair to the IDs of
+    the institutions that the person was affiliated with on the paper: those
+    recorded with the paper, and those of affiliations without a paper whose
+    dates cover its publication date, in ``pubdates``.
+    """
+    pairs = set(pairs)
+    found = defaultdict(set)
+    ranges = defaultdict(list)
+    for chunk in chunked(set([person for paper, person in pairs])):
+        for paper, person, institution, start, end in \
+                Affiliation.objects.filter(person__in=chunk).values_list(
+                    'paper_id', 'person_id', 'institution_id', 'date',
+                    'end_date'):
+            if paper is not None:
+                if (paper, person) in pairs:
+                    found[(paper, person)].add(institution)
+            elif start is not None:
+                ranges[person].append((start, end or start, institution))
+    for paper, person in pairs:
+        date = pubdates.get(paper)
+        if date is None:
+            continue
+        for start, end, institution in ranges[person]:
+            if start <= date <= end:
+                found[(paper, person)].add(institution)
+    return found
+
+
+def _elsewhere(spans, institution, after, before):
+    """
+    Whether ``spans``, the ``(start, end, institution)`` of a person's
+    affiliations, put them at another institution between the dates
+    ``after`` and ``before``.
+    """
+    return any(other != institution and start < before and end > after
+               for start, end, other in spans)
+
+
+def compact_affiliations(max_gap=0):
+    """
+    Collapses the affiliations saved without a paper, which were duplicated
+    on every fetch, into one row per person, institution and range of dates
+    from ``date`` to ``end_date`` (None for a single date). A new range
+    starts where consecutive dates are more than ``max_gap`` days apart, so
+    by default only repeats of the same date are merged, and wherever the
+    person was affiliated with another institution in between. Returns the
+    number of those rows before and after.
+    """
+    legacy = Affiliation.objects.filter(paper__isnull=True)
+    before = legacy.count()
+    people = sorted(set(legacy.values_list('person_id', flat=True)))
+    for chunk in chunked(people):
+        dates = defaultdict(list)
+        spans = defaultdict(list)
+        undated = set()
+        rows = legacy.filter(person__in=chunk).values_list(
+            'person_id', 'institution_id', 'date', 'end_date')
+        for person, institution, start, end in rows:
+            if start is None:
+                undated.add((person, institution))
+                continue
+            dates[(person, institution)].append((start, end or start))
+            spans[person].append((start, end or start, institution))
+
+        ranges = [(person, institution, None, None)
+                  for person, institution in undated]
+        for (person, institution), found in dates.iteritems():
+            found.sort()
+            start, end = found[0]
+            for next_start, next_end in found[1:]:
+                if (next_start - end).days > max_gap or _elsewhere(
+                        spans[person], institution, end, next_start):
+                    ranges.append((person, institution, start, end))
+                    start, end = next_start, next_end
+                else:
+                    end = max(end, next_end)
+            ranges.append((person, institution, start, end))
+
+        with transaction.atomic():
+            legacy.filter(person__in=chunk).delete()
+            Affiliation.objects.bulk_create([
+                Affiliation(person_id=person, institution_id=institution,
+                            date=start, end_date=end if end != start else None)
+                for person, institution, start, end in ranges])
+    return before, legacy.count()
+
+
+def journal_key(journal):
+    """
+    The (issn, title) of a parsed journal, with None for a missing ISSN;
+    journals without an ISSN are keyed on both.
+    """
+    issn, title = journal
+    return issn or None, title
+
+
+def resolve_papers(identifiers, source):
+    papers = resolve(Paper, [(identifier, source) for identifier in identifiers],
+                     ('identifier', 'source'))
+    return [papers[(identifier, source)] for identifier in identifiers]
+
+
+def process_records(records, source):
+    """
+    Saves a batch of parsed records from database ``source``, returning the
+    corresponding :class:`.Paper` instances in the same order.
+    """
+    records = list(records)
+    cache = get_lookup_cache()
+    try:
+        papers = _process_records(records, source, cache)
+    except Exception:
+        cache.rollback()
+        raise
+    cache.commit()
+    return papers
+
+
+def _process_records(records, source, cache):
+    with transaction.atomic():
+        papers = resolve_papers([r['identifier'] for r in records], source)
+
+        # Journal.issn is unique, so it alone identifies a journal; journals
+        # without one are identified by their title.
+        titles, without_issn = {}, set()
+        for r in records:
+            if r['journal']:
+                key = journal_key(r['journal'])
+                if key[0] is None:
+                    without_issn.add(key)
+                else:
+                    titles.setdefault(*key)
+        journals = resolve(Journal, [(issn,) for issn in titles], ('issn',),
+                           defaults=lambda key: {'title': titles[key[0]]},
+                           cache=cache)
+        journals.update(resolve(Journal, without_issn, ('issn', 'title'),
+                                cache=cache))
+
+        countries = resolve(Country,
+                            [(g['country'],) for r in records
+                             for g in r['grants'] if g['agency']],
+                            ('name',), cache=cache)
+        agency_country = {}
+        for r in records:
+            for g in r['grants']:
+                if g['agency']:
+                    agency_country.setdefault(g['agency'], g['country'])
+        agencies = resolve(Agency, [(name,) for name in agency_country],
+                           ('name',),
+                           defaults=lambda key: {
+                               'country': countries[(agency_country[key[0]],)]},
+                           cache=cache)
+
+        grant_agency = {}
+        for r in records:
+            for g in r['grants']:
+                if g['agency'] and g['grant_id']:
+                    grant_agency.setdefault((g['grant_id'], g['acronym']),
+                                            g['agency'])
+        grants = resolve(Grant, grant_agency.keys(), ('grant_id', 'acronym'),
+                         defaults=lambda key: {
+                             'awarded_by': agencies[(grant_agency[key],)]})
+
+        initials = {}
+        for r in records:
+            for a in r['authors']:
+                initials.setdefault((a['fore_name'], a['last_name']),
+                                    a['initials'])
+        people = resolve(Person, initials.keys(), ('fore_name', 'last_name'),
+                         defaults=lambda key: {
+                             'initials': initials[key],
+                             'block': blocking_key(key[0], key[1],
+                                                   initials[key])})
+        institutions = resolve(Institution,
+                               [(name,) for r in records for a in r['authors']
+                                for name in a['affiliations']],
+                               ('name',))
+
+        descriptors = resolve(MeSHDescriptor,
+                              [(d,) for r in records for d, q in r['headings']],
+                              ('descriptor',), cache=cache)
+        qualifiers = resolve(MeSHQualifier,
+                             [(q,) for r in records for d, q in r['headings']
+                              if q is not None],
+                             ('subheading',), cache=cache)
+
+        def heading_key(heading):
+            descriptor, qualifier = heading
+            return (descriptors[(descriptor,)].pk,
+                    qualifiers[(qualifier,)].pk if qualifier is not None
+                    else None)
+        headings = resolve(MeSHHeading,
+                           [heading_key(h) for r in records
+                            for h in r['headings']],
+                           ('descriptor_id', 'qualifier_id'), cache=cache)
+
+        affiliations = []
+        authorships, fundings, subjects = [], [], []
+        for paper, r in zip(papers, records):
+            for a in r['authors']:
+                person = people[(a['fore_name'], a['last_name'])]
+                authorships.append((paper.pk, person.pk))
+                for name in a['affiliations']:
+                    affiliations.append((person.pk, institutions[(name,)].pk,
+                                         r['pubdate'], paper.pk))
+            for g in r['grants']:
+                key = (g['grant_id'], g['acronym'])
+                if key in grants:
+                    fundings.append((paper.pk, grants[key].pk))
+            for h in r['headings']:
+                subjects.append((paper.pk, headings[heading_key(h)].pk))
+
+            paper.pubdate = r['pubdate']
+            paper.title = r['title']
+            paper.abstract = r['abstract']
+            if r['journal']:
+                key = journal_key(r['journal'])
+                paper.published_in = journals[key if key[0] is None
+                                              else key[:1]]
+            paper.save()
+
+        append(Affiliation, ('person_id', 'institution_id', 'date',
+                             'paper_id'), affiliations, 'paper_id')
+        link(Paper._meta.get_field('authors'), authorships)
+        link(Paper._meta.get_field('funding'), fundings)
+        link(Paper._meta.get_field('mesh_headings'), subjects)
+        search.index([(paper.pk, paper.title, paper.abstract,
+                       search.heading_text(r['headings']))
+                      for paper, r in zip(papers, records)])
+
+        archived = [r for r in records if r.get('digest')]
+        if archived:
+            archive(source, ArchivedRecord.EFETCH,
+                    [(r['identifier'], r['digest']) for r in archived])
+    return papers
+
+
+def archive(source, kind, entries):
+    """
+    Indexes archived responses, given as (identifier, digest) pairs, under
+    today's date. Entries from earlier today are replaced.
+    """
+    today = datetime.date.today()
+    entries = dict(entries)
+    for chunk in chunked(entries.keys()):
+        ArchivedRecord.objects.filter(source=source, kind=kind,
+                                      retrieved_on=today,
+                                      identifier__in=chunk).delete()
+    ArchivedRecord.objects.bulk_create([
+        ArchivedRecord(source=source, kind=kind, identifier=identifier,
+                       retrieved_on=today, digest=digest)
+        for identifier, digest in entries.iteritems()])
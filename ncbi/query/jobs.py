@@ -0,0 +1,181 @@
+"""
+Database-backed job queue for searches and retrievals.
+
+The admin actions enqueue :class:`.Job` rows instead of talking to NCBI
+inside the request; the ``runjobs`` management command claims and runs them,
+recording progress on the job as it goes.
+
+Each progress report renews the worker's lease on its job. A running job
+whose worker has not reported for ``lease`` seconds is presumed abandoned by
+a worker that died, like a stale paper claim (see
+:func:`query.pipeline.release_stale`), and is returned to the queue by the
+next :func:`claim`. A worker that lost its lease no longer records progress
+or an outcome on the job.
+"""
+
+import datetime
+import os
+import socket
+import traceback
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .connector import get_manager
+from .models import Job
+from .pipeline import Harvester
+
+# Seconds without a progress report after which a running job is requeued.
+LEASE = 3600
+
+
+def worker_name():
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+def enqueue(kind, source, query=None, identifiers=None, user=None):
+    return Job.objects.create(kind=kind, source=source, query=query,
+                              identifiers=list(identifiers or []),
+                              created_by=user)
+
+
+def claim_job(job, worker=None):
+    """
+    Marks ``job`` as running, if it is still pending. The status check in the
+    UPDATE ensures that a job is only ever claimed by one worker.
+    """
+    now = timezone.now()
+    worker = worker or worker_name()
+    claimed = Job.objects.filter(pk=job.pk, status=Job.PENDING).update(
+        status=Job.RUNNING, worker=worker, started_on=now, updated_on=now)
+    if claimed:
+        job.status = Job.RUNNING
+        job.worker = worker
+        job.started_on = job.updated_on = now
+    return bool(claimed)
+
+
+def requeue_stale(lease=LEASE):
+    """
+    Returns running jobs whose worker has not reported for ``lease`` seconds
+    to the queue, and returns how many there were.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=lease)
+    return Job.objects.filter(status=Job.RUNNING, updated_on__lt=cutoff) \
+                      .update(status=Job.PENDING, worker='', started_on=None,
+                              updated_on=None)
+
+
+def claim(worker=None, lease=LEASE):
+    """
+    Claims the oldest pending job and returns it, or returns None if there is
+    nothing to do. Abandoned jobs are requeued first.
+    """
+    requeue_stale(lease)
+    for job in Job.objects.filter(status=Job.PENDING).order_by('pk')[:10]:
+        if claim_job(job, worker):
+            return job
+
+
+def report(job, fetched, total=None):
+    job.fetched = fetched
+    if total is not None:
+        job.total = total
+    job.updated_on = timezone.now()
+    Job.objects.filter(pk=job.pk, worker=job.worker).update(
+        fetched=job.fetched, total=job.total, updated_on=job.updated_on)
+
+
+def execute(job, manager):
+    query = job.query
+    manager.search(query, callback=lambda fetched, total: report(job, fetched,
+                                                                 total))
+    query.executed = True
+    query.executed_on = timezone.now()
+    query.save()
+
+
+def refresh(job, manager):
+    """
+    Adds records that are new since the query was last executed, then
+    retrieves its new and modified papers.
+    """
+    query = job.query
+    started = timezone.now()
+    manager.refresh(query)
+    retrieve(job, manager)
+    query.executed = True
+    query.executed_on = started
+    query.save()
+
+
+def _unretrieved(query, source):
+    papers = query.results.filter(source=source, retrieved=False)
+    return list(papers.order_by('pk').values_list('identifier', flat=True))
+
+
+def retrieve(job, manager):
+    """
+    Retrieves the papers of a job. When none of the results of the query are
+    retrieved yet and its history server session is known, they are fetched
+    from the session, which needs no list of identifiers; whatever that does
+    not retrieve is then fetched by identifier.
+    """
+    query = job.query
+    if query is not None:
+        identifiers = _unretrieved(query, job.source)
+    else:
+        identifiers = job.identifiers
+    report(job, 0, len(identifiers))
+
+    harvester = Harvester(manager, callback=lambda harvester: report(
+        job, harvester.stats['write'].records))
+    if (query is not None and query.webenv and query.query_key
+            and len(identifiers) == query.result_count):
+        harvester.run_history(query)
+        identifiers = _unretrieved(query, job.source)
+    harvester.run(identifiers)
+    if harvester.failed:
+        raise RuntimeError('{0} papers could not be retrieved: {1}'.format(
+            len(harvester.failed), ', '.join(harvester.failed[:20])))
+
+
+RUNNERS = {
+    Job.EXECUTE: execute,
+    Job.REFRESH: refresh,
+    Job.RETRIEVE: retrieve,
+}
+
+
+def _run(job, manager, profile_dir):
+    if not profile_dir:
+        return RUNNERS[job.kind](job, manager)
+    path = os.path.join(profile_dir, 'job-{0}.prof'.format(job.pk))
+    with metrics.profiled(path):
+        RUNNERS[job.kind](job, manager)
+
+
+def run(job, manager=None, profile_dir=None):
+    """
+    Runs a claimed job, recording its outcome.
+
+    If ``profile_dir`` (by default, the ``NCBI_PROFILE_DIR`` setting) is set,
+    the job is profiled, and its stats are dumped to ``job-<id>.prof`` in
+    that directory.
+    """
+    if manager is None:
+        manager = get_manager(job.source)()
+    if profile_dir is None:
+        profile_dir = getattr(settings, 'NCBI_PROFILE_DIR', None)
+    try:
+        _run(job, manager, profile_dir)
+    except Exception:
+        job.status = Job.FAILED
+        job.error = traceback.format_exc()
+    else:
+        job.status = Job.DONE
+    job.finished_on = timezone.now()
+    Job.objects.filter(pk=job.pk, worker=job.worker).update(
+        status=job.status, error=job.error, finished_on=job.finished_on)
+    return job
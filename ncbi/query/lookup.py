@@ -0,0 +1,176 @@
+"""
+Process-local cache for controlled-vocabulary lookups.
+
+:func:`query.ingest.resolve` consults the cache before going to the database
+for journals, countries, agencies and MeSH terms, which recur across most of
+the articles in a harvest. The cache class and its size are configurable with
+the ``NCBI_LOOKUP_CACHE`` and ``NCBI_LOOKUP_CACHE_SIZE`` settings.
+
+Instances resolved inside a transaction are held back as pending until the
+transaction is known to have committed, so that rows created in a transaction
+that is later rolled back are never served from the cache.
+"""
+
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.utils.module_loading import import_string
+
+DEFAULT_SIZE = 10000
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache of model instances, keyed on natural keys.
+    """
+
+    def __init__(self, maxsize=DEFAULT_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tables = set()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    @property
+    def _pending(self):
+        if not hasattr(self._local, 'pending'):
+            self._local.pending = {}
+        return self._local.pending
+
+    def _key(self, model, key):
+        return (model._meta.db_table, key)
+
+    def get(self, model, key):
+        """
+        Returns the cached instance of ``model`` for natural ``key``, or None.
+        """
+        self.sync()
+        with self._lock:
+            obj = self._entries.pop(self._key(model, key), None)
+            if obj is None:
+                self.misses += 1
+                return None
+            self._entries[self._key(model, key)] = obj
+            self.hits += 1
+            return obj
+
+    def set(self, model, key, obj):
+        if transaction.get_connection().in_atomic_block:
+            self._pending[self._key(model, key)] = obj
+        else:
+            self._store(self._key(model, key), obj)
+
+    def _store(self, key, obj):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = obj
+            self._tables.add(key[0])
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def commit(self):
+        """
+        Promotes pending entries, if the outermost transaction has committed.
+        """
+        if transaction.get_connection().in_atomic_block:
+            return
+        pending, self._local.pending = self._pending, {}
+        for key, obj in pending.iteritems():
+            self._store(key, obj)
+
+    def rollback(self):
+        """
+        Discards pending entries after a transaction or savepoint rollback.
+        """
+        self._local.pending = {}
+
+    def sync(self):
+        """
+        Settles entries left pending by a transaction whose outcome was not
+        observed, by checking that their rows exist.
+        """
+        if not self._pending or transaction.get_connection().in_atomic_block:
+            return
+        pending, self._local.pending = self._pending, {}
+
+        models = {}
+        for key, obj in pending.iteritems():
+            models.setdefault(type(obj), []).append((key, obj))
+        for model, entries in models.iteritems():
+            pks = [obj.pk for key, obj in entries]
+            existing = set(model.objects.filter(pk__in=pks)
+                                        .values_list('pk', flat=True))
+            for key, obj in entries:
+                if obj.pk in existing:
+                    self._store(key, obj)
+
+    def evict(self, instance):
+        label = instance._meta.db_table
+        if label not in self._tables:
+            return
+        with self._lock:
+            for key, obj in self._entries.items():
+                if key[0] == label and obj.pk == instance.pk:
+                    del self._entries[key]
+        for key, obj in self._pending.items():
+            if key[0] == label and obj.pk == instance.pk:
+                del self._pending[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tables.clear()
+            self.hits = 0
+            self.misses = 0
+        self._local.pending = {}
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'maxsize': self.maxsize,
+            'currsize': len(self._entries),
+        }
+
+
+class NullCache(LRUCache):
+    """
+    Disables lookup caching; every lookup is a miss.
+    """
+
+    def __init__(self, maxsize=0):
+        super(NullCache, self).__init__(maxsize=0)
+
+    def _store(self, key, obj):
+        pass
+
+    def set(self, model, key, obj):
+        pass
+
+
+_cache = None
+
+
+def get_lookup_cache():
+    """
+    Returns the process-wide lookup cache, configured by settings.
+    """
+    global _cache
+    if _cache is None:
+        cache_class = import_string(getattr(settings, 'NCBI_LOOKUP_CACHE',
+                                            'query.lookup.LRUCache'))
+        _cache = cache_class(maxsize=getattr(settings, 'NCBI_LOOKUP_CACHE_SIZE',
+                                             DEFAULT_SIZE))
+    return _cache
+
+
+def evict_deleted(sender, instance, **kwargs):
+    if _cache is not None:
+        _cache.evict(instance)
+
+post_delete.connect(evict_deleted)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from query.benchmarks import decode_benchmark, scratch_database
+
+
+class Command(BaseCommand):
+    help = ('Times loading MeSH descriptors with JSON-encoded tree numbers, '
+            'in a scratch test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--tree-numbers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            results = decode_benchmark(options['rows'], options['tree_numbers'])
+        self.stdout.write('%i descriptors with %i tree numbers each, in ms'
+                          % (options['rows'], options['tree_numbers']))
+        for label, seconds in results:
+            self.stdout.write('%-40s %10.1f' % (label, seconds * 1000))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from query.benchmarks import extract_benchmark
+from query.models import DBCHOICES
+
+
+class Command(BaseCommand):
+    help = ('Compares the rate at which EFetch records are parsed by the '
+            'compiled schemas and by the legacy parser, with each available '
+            'XML backend.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', choices=[db for db, label in DBCHOICES],
+                            default='PubMed')
+        parser.add_argument('--records', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        results = extract_benchmark(options['source'], options['records'])
+        self.stdout.write('%i %s records, in records/s'
+                          % (options['records'], options['source']))
+        self.stdout.write('%-28s %12s %12s' % ('parser', 'parse', 'extract'))
+        for label, parse, extract in results:
+            self.stdout.write('%-28s %12.1f %12.1f' % (label, parse, extract))
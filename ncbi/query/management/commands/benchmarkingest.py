@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from query.benchmarks import (PATHS, SCALES, ingest_benchmark, load_results,
+                              regressions, save_results, scratch_database)
+from query.models import DBCHOICES
+
+
+class Command(BaseCommand):
+    help = ('Measures records/s, queries per record and memory of the '
+            'ingestion paths against recorded E-utilities responses, in a '
+            'scratch test database, and compares them with the last run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', action='append',
+                            choices=[db for db, label in DBCHOICES],
+                            help='Defaults to every database.')
+        parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+        parser.add_argument('--paths', nargs='+', choices=PATHS.keys(),
+                            help='Defaults to every path.')
+        parser.add_argument('--results', default='ingest_benchmarks.jsonl',
+                            help='Results are compared with, and appended '
+                                 'to, this file.')
+        parser.add_argument('--tolerance', type=float, default=0.2)
+        parser.add_argument('--no-save', action='store_true')
+
+    def handle(self, *args, **options):
+        sources = options['source'] or [db for db, label in DBCHOICES]
+        scales = sorted(options['scales'])
+        results = []
+        with scratch_database():
+            for source in sources:
+                results.extend(ingest_benchmark(source, scales,
+                                                options['paths']))
+
+        self.stdout.write('%-22s %-7s %7s %12s %12s %12s %10s'
+                          % ('path', 'source', 'scale', 'records/s',
+                             'queries/rec', 'memory KiB', 'seconds'))
+        for result in results:
+            self.stdout.write('%-22s %-7s %7i %12.1f %12.2f %12i %10.2f'
+                              % (result['path'], result['source'],
+                                 result['scale'], result['rate'],
+                                 result['queries_per_record'],
+                                 result['memory'], result['seconds']))
+
+        found = regressions(load_results(options['results']), results,
+                            options['tolerance'])
+        if not options['no_save']:
+            save_results(options['results'], results)
+        for result, metric, before, after in found:
+            self.stderr.write('%s %s %i: %s was %.2f, now %.2f'
+                              % (result['path'], result['source'],
+                                 result['scale'], metric, before, after))
+        if found:
+            raise CommandError('%i regressions' % len(found))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from query.benchmarks import lookup_benchmark, scratch_database
+
+
+class Command(BaseCommand):
+    help = ('Times natural-key lookups with and without their indexes, in a '
+            'scratch test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10 ** 6)
+        parser.add_argument('--lookups', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            results = lookup_benchmark(options['rows'], options['lookups'],
+                                       options['batch_size'])
+
+        self.stdout.write('%i rows; mean latency in ms, indexed / unindexed'
+                          % options['rows'])
+        self.stdout.write('%-16s %20s %20s' % ('model', 'get',
+                          'batch of %i' % options['batch_size']))
+        for name, single, batch in results:
+            self.stdout.write('%-16s %9.3f / %8.3f %9.3f / %8.3f'
+                              % ((name,) + tuple(t * 1000 for t in single)
+                                 + tuple(t * 1000 for t in batch)))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from query.ingest import compact_affiliations
+
+
+class Command(BaseCommand):
+    help = ('Collapses duplicate affiliations saved without a paper into one '
+            'row per person, institution and range of dates.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-gap', type=int, default=0,
+                            help='Start a new range where dates are more '
+                                 'than this many days apart (default: 0, '
+                                 'merging only repeats of a date).')
+
+    def handle(self, *args, **options):
+        before, after = compact_affiliations(options['max_gap'])
+        self.stdout.write('Compacted %i affiliations into %i'
+                          % (before, after))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from query import authors
+
+
+class Command(BaseCommand):
+    help = 'Attributes new authorships to disambiguated authors.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Discard all attributions and start over.')
+        parser.add_argument('--threshold', type=float,
+                            default=authors.THRESHOLD)
+        parser.add_argument('--blocks-per-batch', type=int,
+                            default=authors.BLOCKS_PER_BATCH)
+
+    def handle(self, *args, **options):
+        blocks, created = authors.disambiguate(
+            rebuild=options['rebuild'], threshold=options['threshold'],
+            blocks_per_batch=options['blocks_per_batch'])
+        self.stdout.write('Clustered %i blocks, creating %i authors'
+                          % (blocks, created))
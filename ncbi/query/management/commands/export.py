@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from query.export import CHUNK_SIZE, FORMATS, export
+from query.models import Query
+
+
+class Command(BaseCommand):
+    help = 'Exports the results of a query.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('query', type=int)
+        parser.add_argument('--format', choices=FORMATS.keys(), default='csv')
+        parser.add_argument('--output', help='Defaults to standard output.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            query = Query.objects.get(pk=options['query'])
+        except Query.DoesNotExist:
+            raise CommandError('No such query: %s' % options['query'])
+
+        chunks = export(query.results.all(), options['format'],
+                        options['chunk_size'])
+        if not options['output']:
+            for data in chunks:
+                self.stdout.write(data, ending='')
+            return
+        with open(options['output'], 'wb') as output:
+            for data in chunks:
+                output.write(data)
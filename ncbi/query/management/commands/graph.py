@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from query import graphs
+from query.models import Query
+
+WRITERS = {
+    'edgelist': graphs.Graph.write_edgelist,
+    'graphml': graphs.Graph.write_graphml,
+}
+
+
+class Command(BaseCommand):
+    help = ('Builds a co-authorship, MeSH co-occurrence or '
+            'funder-institution graph over the results of a query.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('query', type=int)
+        parser.add_argument('--kind', choices=graphs.GRAPHS.keys(),
+                            default='coauthorship')
+        parser.add_argument('--format', choices=WRITERS.keys(),
+                            default='edgelist')
+        parser.add_argument('--output', help='Defaults to standard output.')
+        parser.add_argument('--max-items', type=int, default=graphs.MAX_ITEMS,
+                            help='Leave out papers with more items than this.')
+        parser.add_argument('--disambiguated', action='store_true',
+                            help='Link disambiguated authors, rather than '
+                                 'names as printed.')
+
+    def handle(self, *args, **options):
+        try:
+            query = Query.objects.get(pk=options['query'])
+        except Query.DoesNotExist:
+            raise CommandError('No such query: %s' % options['query'])
+
+        kwargs = {'max_items': options['max_items']}
+        if options['kind'] == 'coauthorship':
+            kwargs['disambiguated'] = options['disambiguated']
+        graph = graphs.GRAPHS[options['kind']](query, **kwargs)
+        write = WRITERS[options['format']]
+        if not options['output']:
+            write(graph, self.stdout)
+            return
+        with open(options['output'], 'wb') as output:
+            write(graph, output)
@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from query.connector import get_manager
+from query.jobs import worker_name
+from query.models import DBCHOICES, Paper, Query
+from query.pipeline import harvest_claimed, release_stale
+from query.transport import build_transport, get_rate_limiter
+
+
+def close_connections():
+    for connection in connections.all():
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = ('Retrieves unretrieved papers with a concurrent fetch pipeline, '
+            'in one or more worker processes. Workers claim papers in '
+            'chunks, so that several may run at once, on several hosts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', choices=[db for db, label in DBCHOICES],
+                            default='PubMed')
+        parser.add_argument('--query', type=int,
+                            help='Only retrieve results of this query.')
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--downloaders', type=int, default=3)
+        parser.add_argument('--parsers', type=int, default=2)
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--write-size', type=int, default=1000)
+        parser.add_argument('--claim-size', type=int, default=1000,
+                            help='Papers claimed by a worker at a time.')
+        parser.add_argument('--claim-timeout', type=int, default=3600,
+                            help='Release claims older than this many '
+                                 'seconds, left by workers that died.')
+
+    def handle(self, *args, **options):
+        if options['query'] is not None and \
+                not Query.objects.filter(pk=options['query']).exists():
+            raise CommandError('No such query: %s' % options['query'])
+
+        released = release_stale(options['source'], options['claim_timeout'])
+        if released:
+            self.stdout.write('Released %i stale claims' % released)
+
+        if options['processes'] < 2:
+            self.work(options)
+            return
+
+        # The processes share one rate limit, through a file.
+        path = getattr(settings, 'NCBI_RATE_LIMIT_FILE', None)
+        temporary = not path
+        if temporary:
+            fd, path = tempfile.mkstemp(prefix='ncbi-rate-')
+            os.close(fd)
+        # Each process opens its own database connections.
+        close_connections()
+        workers = [multiprocessing.Process(target=self.work_process,
+                                           args=(options, path))
+                   for i in xrange(options['processes'])]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            if temporary:
+                os.remove(path)
+        failed = len([worker for worker in workers if worker.exitcode])
+        if failed:
+            raise CommandError('%i worker processes failed' % failed)
+
+    def work_process(self, options, rate_limit_file):
+        try:
+            self.work(options, rate_limit_file)
+        finally:
+            close_connections()
+
+    def work(self, options, rate_limit_file=None):
+        transport = None
+        if rate_limit_file is not None:
+            transport = build_transport(get_rate_limiter(rate_limit_file))
+        manager = get_manager(options['source'])(transport=transport)
+
+        papers = None
+        if options['query'] is not None:
+            papers = Paper.objects.filter(query=options['query'])
+
+        worker = worker_name()
+        retrieved, failed = harvest_claimed(
+            manager, worker, papers, options['claim_size'],
+            downloaders=options['downloaders'], parsers=options['parsers'],
+            batch_size=options['batch_size'],
+            write_size=options['write_size'])
+        self.stdout.write('%s: retrieved %i papers' % (worker, retrieved))
+        if failed:
+            self.stderr.write('%s: %i papers could not be retrieved'
+                              % (worker, len(failed)))
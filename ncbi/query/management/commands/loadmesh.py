@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from query import mesh
+
+
+class Command(BaseCommand):
+    help = ('Imports MeSH descriptors and tree numbers from a descriptor XML '
+            'file, e.g. desc2024.xml or desc2024.xml.gz.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=mesh.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        with mesh.open_descriptors(options['path']) as stream:
+            count = mesh.load(stream, options['batch_size'])
+        self.stdout.write('Loaded %i descriptors' % count)
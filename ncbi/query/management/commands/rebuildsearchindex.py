@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from query import search
+
+
+class Command(BaseCommand):
+    help = 'Adds every fetched paper to the full-text search index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int,
+                            default=search.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if search.get_backend() is None:
+            raise CommandError('The database has no full-text search index.')
+        count = search.rebuild(chunk_size=options['chunk_size'])
+        self.stdout.write('Indexed %i papers' % count)
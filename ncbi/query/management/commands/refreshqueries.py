@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from query import jobs
+from query.models import Job, Query
+
+
+class Command(BaseCommand):
+    help = ('Adds new records to executed queries and retrieves new and '
+            'modified papers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', type=int,
+                            help='Query IDs; defaults to all executed queries.')
+        parser.add_argument('--enqueue', action='store_true',
+                            help='Queue jobs for runjobs instead of running '
+                                 'them here.')
+
+    def handle(self, *args, **options):
+        queries = Query.objects.filter(executed=True).order_by('pk')
+        if options['queries']:
+            queries = queries.filter(pk__in=options['queries'])
+
+        for query in queries:
+            job = jobs.enqueue(Job.REFRESH, query.database, query=query)
+            if options['enqueue']:
+                continue
+            jobs.claim_job(job)
+            jobs.run(job)
+            self.stdout.write('%s: %s' % (query.querystring, job.progress()))
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from query.archive import get_archive
+from query.connector import get_manager
+from query.models import DBCHOICES, ArchivedRecord, Query
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds papers from the most recent archived EFetch records, '
+            'without network access.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', choices=[db for db, label in DBCHOICES],
+                            default='PubMed')
+        parser.add_argument('--query', type=int,
+                            help='Only reprocess results of this query.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        archive = get_archive()
+        if archive is None:
+            raise CommandError('NCBI_ARCHIVE_ROOT is not set.')
+        source = options['source']
+        manager = get_manager(source)(archive=archive)
+        batch_size = options['batch_size']
+
+        entries = ArchivedRecord.objects.filter(source=source,
+                                                kind=ArchivedRecord.EFETCH)
+        if options['query'] is not None:
+            try:
+                query = Query.objects.get(pk=options['query'])
+            except Query.DoesNotExist:
+                raise CommandError('No such query: %s' % options['query'])
+            entries = entries.filter(identifier__in=query.results.filter(
+                source=source).values('identifier'))
+        entries = entries.order_by('identifier', '-retrieved_on', '-pk')
+
+        # Pages through the index by identifier, so that only one page is held
+        # in memory. The newest entry for each identifier comes first.
+        count, last, records = 0, None, []
+        while True:
+            page = entries
+            if last is not None:
+                page = page.filter(identifier__gt=last)
+            page = list(page.values_list('identifier', 'digest')[:batch_size])
+            if not page:
+                break
+
+            for identifier, digest in page:
+                if identifier == last:
+                    continue
+                last = identifier
+                records.extend(manager.parse_records(archive.open(digest),
+                                                     [identifier],
+                                                     archive=False))
+            if len(records) >= batch_size:
+                count += len(manager.process_records(records))
+                records = []
+        if records:
+            count += len(manager.process_records(records))
+        self.stdout.write('Reprocessed %i papers' % count)
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from query import jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs searches and retrievals queued from the admin.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when there are no pending jobs.')
+        parser.add_argument('--sleep', type=float, default=5.,
+                            help='Seconds to wait between polls.')
+        parser.add_argument('--lease', type=int, default=jobs.LEASE,
+                            help='Requeue running jobs that have not '
+                                 'reported progress for this many seconds.')
+        parser.add_argument('--profile-dir',
+                            help='Dump the cProfile stats of each job to '
+                                 'this directory.')
+
+    def handle(self, *args, **options):
+        worker = jobs.worker_name()
+        while True:
+            job = jobs.claim(worker, options['lease'])
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+
+            self.stdout.write('Running %s' % job)
+            jobs.run(job, profile_dir=options['profile_dir'])
+            self.stdout.write('%s: %s' % (job, job.progress()))
@@ -0,0 +1,139 @@
+"""
+MeSH vocabulary and tree index.
+
+:func:`load` imports a MeSH descriptor file (e.g. ``desc2024.xml`` from
+https://www.nlm.nih.gov/mesh/), recording each descriptor's tree numbers as
+:class:`.MeSHTreeNumber` rows. The tree numbers under ``D12.776`` are
+``D12.776`` itself and those starting with ``D12.776.``, so
+:func:`papers_under` finds the papers under a branch with one prefix match on
+tree numbers, rather than by walking the hierarchy. On PostgreSQL, prefix
+matches use a ``varchar_pattern_ops`` index, whatever the collation of the
+database.
+"""
+
+import gzip
+import xml.etree.ElementTree as ET
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import MeSHDescriptor, MeSHTreeNumber, Paper
+from .ingest import chunked, resolve
+
+BATCH_SIZE = 1000
+
+
+def subtree(tree_number, field='number'):
+    """
+    A lookup on ``field`` for tree numbers at or under ``tree_number``.
+    """
+    tree_number = tree_number.strip().rstrip('.')
+    return Q(**{field: tree_number}) | \
+        Q(**{field + '__startswith': tree_number + '.'})
+
+
+def descriptors_under(tree_number):
+    return MeSHDescriptor.objects.filter(
+        subtree(tree_number, 'tree_nodes__number')).distinct()
+
+
+def papers_under(tree_number, queryset=None):
+    """
+    Papers with a MeSH heading at or under ``tree_number``, e.g. ``D12.776``.
+    """
+    if queryset is None:
+        queryset = Paper.objects.all()
+    return queryset.filter(subtree(
+        tree_number, 'mesh_headings__descriptor__tree_nodes__number')).distinct()
+
+
+def iter_descriptors(stream):
+    """
+    Yields a dict for each ``DescriptorRecord`` in a descriptor file, with
+    keys ``ui``, ``name`` and ``tree_numbers``.
+    """
+    for event, element in ET.iterparse(stream):
+        if element.tag != 'DescriptorRecord':
+            continue
+        yield {
+            'ui': element.findtext('DescriptorUI', u'').strip(),
+            'name': element.findtext('DescriptorName/String', u'').strip(),
+            'tree_numbers': [number.text.strip() for number
+                             in element.findall('TreeNumberList/TreeNumber')],
+        }
+        element.clear()
+
+
+def _update(descriptors):
+    """
+    Sets ``ui`` and ``tree_numbers`` on ``descriptors``, pairs of an instance
+    and a parsed descriptor, with one statement run over all of their
+    parameters, rather than an UPDATE call per descriptor.
+    """
+    field = MeSHDescriptor._meta.get_field('tree_numbers')
+    quote = connection.ops.quote_name
+    updates = [(d['ui'], field.get_prep_value(d['tree_numbers']), obj.pk)
+               for obj, d in descriptors]
+    if not updates:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'UPDATE {0} SET {1} = %s, {2} = %s WHERE id = %s'.format(
+                quote(MeSHDescriptor._meta.db_table), quote('ui'),
+                quote(field.column)), updates)
+
+
+def _load(descriptors):
+    with transaction.atomic():
+        parsed = dict([(d['name'], d) for d in descriptors])
+        found = resolve(MeSHDescriptor, [(d['name'],) for d in descriptors],
+                        ('descriptor',),
+                        defaults=lambda key: {
+                            'ui': parsed[key[0]]['ui'],
+                            'tree_numbers': parsed[key[0]]['tree_numbers']})
+        pks, numbers, nodes, changed = [], [], [], []
+        for d in descriptors:
+            descriptor = found[(d['name'],)]
+            # Descriptors created above, and those unchanged since the last
+            # import, need no update.
+            if (descriptor.ui != d['ui']
+                    or descriptor.tree_numbers != d['tree_numbers']):
+                changed.append((descriptor, d))
+            pks.append(descriptor.pk)
+            numbers.extend(d['tree_numbers'])
+            nodes.extend([MeSHTreeNumber(number=number, descriptor=descriptor)
+                          for number in d['tree_numbers']])
+
+        # Replaces the descriptors' tree numbers, and any of the same numbers
+        # that earlier MeSH versions gave to other descriptors.
+        _update(changed)
+
+        for chunk in chunked(pks):
+            MeSHTreeNumber.objects.filter(descriptor__in=chunk).delete()
+        for chunk in chunked(numbers):
+            MeSHTreeNumber.objects.filter(number__in=chunk).delete()
+        MeSHTreeNumber.objects.bulk_create(nodes)
+
+
+def load(stream, batch_size=BATCH_SIZE):
+    """
+    Imports descriptors and their tree numbers from a descriptor file, and
+    returns how many descriptors there were.
+    """
+    count, batch = 0, []
+    for descriptor in iter_descriptors(stream):
+        batch.append(descriptor)
+        if len(batch) == batch_size:
+            _load(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        _load(batch)
+        count += len(batch)
+    return count
+
+
+def open_descriptors(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
@@ -0,0 +1,353 @@
+"""
+Per-stage instrumentation of the connector.
+
+:class:`query.connector.NCBIManager` runs each stage of a retrieval in a
+:func:`stage`, which times it and records it with its counters:
+
+``request``
+    Sending an E-utilities request and waiting for the response headers.
+``download``
+    Reading response bodies, with the ``bytes`` read (after gzip decoding).
+``parse``
+    Parsing ESearch responses.
+``iter_records``
+    Parsing EFetch responses record by record, with the ``elements`` and
+    ``records`` parsed. Like ``parse``, this includes the time spent reading
+    the body, which is also counted under ``download``.
+``extract``
+    Extracting the fields of a record with the manager's schema; see
+    :mod:`query.extract`.
+``process_records`` and ``process_searchresults``
+    Saving records, with the database ``queries`` issued, and the
+    ``cache_hits`` and ``cache_misses`` of the lookup cache.
+``paper_cache``
+    Reading serialized papers through :mod:`query.cache`, with its ``hits``
+    and ``misses``.
+
+Each stage is sent with the :data:`stage_finished` signal, and recorded to
+the metrics sink returned by :func:`get_metrics`, which the ``metrics`` view
+exports in the Prometheus text format to staff users. The sink is configured
+by these settings:
+
+``NCBI_METRICS``
+    Dotted path of the sink class; ``query.metrics.NullMetrics`` turns
+    recording off.
+``NCBI_METRICS_FILE``
+    The file in which :class:`FileMetrics` accumulates the metrics of every
+    process on the host, so that the web server exports those of the
+    ``runjobs`` workers. Without one, :class:`FileMetrics` keeps the totals
+    of its own process, as :class:`Metrics` does.
+``NCBI_METRICS_PUBLIC``
+    Exports the metrics without a staff login.
+
+With ``NCBI_PROFILE_DIR`` set, or ``runjobs --profile-dir``, each job is run
+under :func:`profiled`, and its cProfile stats are dumped to
+``<dir>/job-<id>.prof``.
+"""
+
+import atexit
+from contextlib import contextmanager
+import cProfile
+import fcntl
+import json
+import pstats
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+stage_finished = Signal(providing_args=['stage', 'seconds', 'counts'])
+
+
+class Metrics(object):
+    """
+    Process-local totals of the calls, time and counters of each stage.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, counts):
+        with self._lock:
+            _merge(self.stages, {stage: dict(counts, calls=1,
+                                             seconds=seconds)})
+
+    def snapshot(self):
+        """
+        Returns a dict mapping each stage to a dict of its totals.
+        """
+        with self._lock:
+            return dict((stage, dict(totals))
+                        for stage, totals in self.stages.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+
+    def render(self):
+        """
+        Returns the totals in the Prometheus text exposition format.
+        """
+        stages = self.snapshot()
+        names = sorted(set([name for totals in stages.itervalues()
+                            for name in totals]))
+        lines = []
+        for name in names:
+            metric = 'ncbi_stage_{0}_total'.format(name)
+            lines.append('# TYPE {0} counter'.format(metric))
+            for stage in sorted(stages):
+                if name in stages[stage]:
+                    lines.append('{0}{{stage="{1}"}} {2}'.format(
+                        metric, stage, stages[stage][name]))
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics(Metrics):
+    """
+    Discards everything.
+    """
+
+    def record(self, stage, seconds, counts):
+        pass
+
+
+class FileMetrics(Metrics):
+    """
+    Accumulates totals in a locked JSON file, shared by every process that
+    uses the same ``path``. Totals are merged into the file at most once per
+    ``interval`` seconds, and when the process exits. Without a ``path`` or
+    ``NCBI_METRICS_FILE``, totals stay in the process.
+    """
+
+    def __init__(self, path=None, interval=1.):
+        super(FileMetrics, self).__init__()
+        self.path = path or getattr(settings, 'NCBI_METRICS_FILE', None)
+        self.interval = interval
+        self._flushed = time.time()
+        if self.path:
+            atexit.register(self.flush)
+
+    def record(self, stage, seconds, counts):
+        super(FileMetrics, self).record(stage, seconds, counts)
+        if self.path and time.time() - self._flushed >= self.interval:
+            self.flush()
+
+    def _update(self, stages=None):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    shared = json.loads(f.read())
+                except ValueError:
+                    shared = {}
+                if stages:
+                    _merge(shared, stages)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(shared))
+                    f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return shared
+
+    def flush(self):
+        """
+        Merges the totals recorded since the last flush into the file.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            stages, self.stages = self.stages, {}
+            self._flushed = time.time()
+        if stages:
+            self._update(stages)
+
+    def snapshot(self):
+        if not self.path:
+            return super(FileMetrics, self).snapshot()
+        self.flush()
+        return self._update()
+
+    def reset(self):
+        super(FileMetrics, self).reset()
+        if self.path:
+            with open(self.path, 'w'):
+                pass
+
+
+def _merge(into, stages):
+    for stage, totals in stages.iteritems():
+        merged = into.setdefault(stage, {})
+        for name, value in totals.iteritems():
+            merged[name] = merged.get(name, 0) + value
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Returns the process-wide metrics sink, configured by settings.
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = import_string(getattr(settings, 'NCBI_METRICS',
+                                             'query.metrics.Metrics'))()
+    return _metrics
+
+
+class QueryCount(object):
+    def __init__(self):
+        self.count = 0
+
+
+class CountingCursor(object):
+    """
+    Wraps a cursor, counting the statements executed through it, without
+    the SQL and timings that a debug cursor logs.
+    """
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter.count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+
+@contextmanager
+def count_queries():
+    """
+    Counts the queries run on this thread's default connection in the
+    enclosed code, whose cursors are wrapped meanwhile, and restored after.
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    # An enclosing count wraps the cursors already; this one wraps that.
+    wrapped = connection.__dict__.get('cursor')
+    cursor = connection.cursor
+    result = QueryCount()
+    connection.cursor = lambda: CountingCursor(cursor(), result)
+    try:
+        yield result
+    finally:
+        if wrapped is None:
+            del connection.cursor
+        else:
+            connection.cursor = wrapped
+
+
+@contextmanager
+def stage(name, queries=False):
+    """
+    Times the enclosed code as stage ``name``, and records it with the
+    counters that it adds to the yielded dict. With ``queries``, database
+    queries are counted too. Failed stages are recorded with ``errors``.
+    """
+    counts = {}
+    with (count_queries() if queries else _uncounted()) as queried:
+        start = time.time()
+        try:
+            yield counts
+        except Exception:
+            counts['errors'] = counts.get('errors', 0) + 1
+            raise
+        finally:
+            seconds = time.time() - start
+            if queried is not None:
+                counts['queries'] = queried.count
+            record(name, seconds, counts)
+
+
+@contextmanager
+def _uncounted():
+    yield None
+
+
+def record(name, seconds, counts):
+    get_metrics().record(name, seconds, counts)
+    stage_finished.send(sender=None, stage=name, seconds=seconds,
+                        counts=counts)
+
+
+class CountingStream(object):
+    """
+    Wraps a response body, recording the time spent reading it and the bytes
+    read as a ``download`` stage when it is closed.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+        self.seconds = 0.
+        self.closed = False
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.stream.read(size)
+        self.seconds += time.time() - start
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stream.close()
+        record('download', self.seconds, {'bytes': self.bytes})
+
+
+@contextmanager
+def profiled(path):
+    """
+    Profiles the enclosed code, and the threads that it starts, with
+    cProfile, and dumps their combined stats to ``path``.
+    """
+    profiles = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def start(frame, event, arg):
+        # Called by each new thread before its target runs.
+        profile = cProfile.Profile()
+        with lock:
+            profiles.append(profile)
+        profile.enable()
+
+    threading.setprofile(start)
+    profiles[0].enable()
+    try:
+        yield
+    finally:
+        profiles[0].disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # The thread made no calls.
+                pass
+        stats.dump_stats(path)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+import query.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Affiliation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Agency',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedRecord',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('source', models.CharField(max_length=255, choices=[(b'PubMed', b'PubMed'), (b'PMC', b'PMC')])),
+                ('identifier', models.CharField(max_length=255)),
+                ('kind', models.CharField(default=b'efetch', max_length=20, choices=[(b'efetch', b'EFetch record'), (b'esearch', b'ESearch page')])),
+                ('retrieved_on', models.DateField()),
+                ('digest', models.CharField(max_length=40)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Country',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Grant',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('grant_id', models.CharField(max_length=255)),
+                ('acronym', models.CharField(max_length=50)),
+                ('awarded_by', models.ForeignKey(related_name='grants', to='query.Agency')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Institution',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('country', models.ForeignKey(to='query.Country', null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=20, choices=[(b'execute', b'Execute query'), (b'refresh', b'Refresh query'), (b'retrieve', b'Retrieve papers')])),
+                ('status', models.CharField(default=b'pending', max_length=20, choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')])),
+                ('source', models.CharField(max_length=255, choices=[(b'PubMed', b'PubMed'), (b'PMC', b'PMC')])),
+                ('identifiers', query.models.ListField(blank=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('started_on', models.DateTimeField(null=True)),
+                ('updated_on', models.DateTimeField(null=True)),
+                ('finished_on', models.DateTimeField(null=True)),
+                ('worker', models.CharField(max_length=255, blank=True)),
+                ('fetched', models.IntegerField(default=0)),
+                ('total', models.IntegerField(null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_by', models.ForeignKey(related_name='jobs', to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Journal',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('title', models.CharField(max_length=255)),
+                ('issn', models.CharField(unique=True, max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MeSHDescriptor',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('descriptor', models.CharField(max_length=255)),
+                ('tree_numbers', query.models.ListField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MeSHHeading',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('descriptor', models.ForeignKey(to='query.MeSHDescriptor')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MeSHQualifier',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('subheading', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Paper',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('title', models.CharField(max_length=255, null=True)),
+                ('abstract', models.TextField()),
+                ('pubdate', models.DateField(null=True)),
+                ('identifier', models.CharField(unique=True, max_length=50)),
+                ('source', models.CharField(max_length=255, choices=[(b'PubMed', b'PubMed'), (b'PMC', b'PMC')])),
+                ('retrieved', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Person',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('last_name', models.CharField(max_length=255)),
+                ('fore_name', models.CharField(max_length=255)),
+                ('initials', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Query',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('executed_on', models.DateTimeField(null=True)),
+                ('executed', models.BooleanField(default=False)),
+                ('querystring', models.TextField()),
+                ('database', models.CharField(max_length=255, choices=[(b'PubMed', b'PubMed'), (b'PMC', b'PMC')])),
+                ('retmax', models.IntegerField(default=100, help_text=b'Number of IDs per ESearch request.')),
+                ('result_count', models.IntegerField(default=0)),
+                ('webenv', models.CharField(max_length=255, blank=True)),
+                ('query_key', models.CharField(max_length=50, blank=True)),
+                ('created_by', models.ForeignKey(related_name='queries', to=settings.AUTH_USER_MODEL)),
+                ('results', models.ManyToManyField(to='query.Paper', blank=True)),
+            ],
+            options={
+                'verbose_name_plural': 'queries',
+            },
+        ),
+        migrations.AddField(
+            model_name='paper',
+            name='authors',
+            field=models.ManyToManyField(to='query.Person'),
+        ),
+        migrations.AddField(
+            model_name='paper',
+            name='funding',
+            field=models.ManyToManyField(to='query.Grant'),
+        ),
+        migrations.AddField(
+            model_name='paper',
+            name='mesh_headings',
+            field=models.ManyToManyField(to='query.MeSHHeading'),
+        ),
+        migrations.AddField(
+            model_name='paper',
+            name='published_in',
+            field=models.ForeignKey(to='query.Journal', null=True),
+        ),
+        migrations.AddField(
+            model_name='meshheading',
+            name='qualifier',
+            field=models.ForeignKey(to='query.MeSHQualifier', null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='query',
+            field=models.ForeignKey(related_name='jobs', blank=True, to='query.Query', null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedrecord',
+            index_together=set([('source', 'identifier', 'retrieved_on')]),
+        ),
+        migrations.AddField(
+            model_name='agency',
+            name='country',
+            field=models.ForeignKey(to='query.Country'),
+        ),
+        migrations.AddField(
+            model_name='affiliation',
+            name='institution',
+            field=models.ForeignKey(to='query.Institution'),
+        ),
+        migrations.AddField(
+            model_name='affiliation',
+            name='person',
+            field=models.ForeignKey(to='query.Person'),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+# Natural keys that become unique in 0003, in an order such that merging a
+# model never creates new duplicates in one that has already been merged.
+KEYS = [
+    ('Country', ('name',)),
+    ('Agency', ('name',)),
+    ('Institution', ('name',)),
+    ('Grant', ('grant_id', 'acronym')),
+    ('MeSHDescriptor', ('descriptor',)),
+    ('MeSHQualifier', ('subheading',)),
+    ('MeSHHeading', ('descriptor', 'qualifier')),
+]
+
+# Rows per DELETE, under the SQLite limit on query parameters.
+CHUNK_SIZE = 500
+
+
+def repoint(model, keep, duplicates):
+    """
+    Moves every reference to ``duplicates`` over to ``keep``.
+    """
+    for related in model._meta.get_fields():
+        if not related.auto_created or related.concrete:
+            continue
+        if related.one_to_many:
+            name = related.field.name
+            related.related_model.objects.filter(
+                **{name + '__in': duplicates}).update(**{name: keep})
+        elif related.many_to_many:
+            through = related.field.rel.through
+            column = related.field.m2m_reverse_field_name()
+            other = related.field.m2m_field_name()
+            # Drops links that ``keep`` already has, and all but one of the
+            # links that several duplicates have to the same row, which
+            # would otherwise collide after the update.
+            linked = set(through.objects.filter(**{column: keep})
+                                        .values_list(other, flat=True))
+            links = through.objects.filter(**{column + '__in': duplicates}) \
+                                   .order_by('pk').values_list('pk', other)
+            redundant = []
+            for pk, target in links:
+                if target in linked:
+                    redundant.append(pk)
+                linked.add(target)
+            for start in xrange(0, len(redundant), CHUNK_SIZE):
+                through.objects.filter(
+                    pk__in=redundant[start:start + CHUNK_SIZE]).delete()
+            through.objects.filter(**{column + '__in': duplicates}) \
+                           .update(**{column: keep})
+
+
+def natural_key(fields):
+    """
+    Returns the lookups for the rows with key ``fields``. A NULL key field,
+    such as the qualifier of a heading without one, is matched with
+    ``isnull``, as it is grouped with the other NULLs.
+    """
+    lookups = {}
+    for name, value in fields.items():
+        if value is None:
+            lookups[name + '__isnull'] = True
+        else:
+            lookups[name] = value
+    return lookups
+
+
+def merge_duplicates(apps, schema_editor):
+    for name, fields in KEYS:
+        model = apps.get_model('query', name)
+        groups = model.objects.values(*fields) \
+                              .annotate(count=Count('pk'), keep=Min('pk')) \
+                              .filter(count__gt=1)
+        for group in groups:
+            keep = group.pop('keep')
+            group.pop('count')
+            duplicates = list(model.objects.filter(**natural_key(group))
+                                           .exclude(pk=keep)
+                                           .values_list('pk', flat=True))
+            repoint(model, keep, duplicates)
+            model.objects.filter(pk__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0002_merge_duplicates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='agency',
+            name='name',
+            field=models.CharField(unique=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='country',
+            name='name',
+            field=models.CharField(unique=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='institution',
+            name='name',
+            field=models.CharField(unique=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='meshdescriptor',
+            name='descriptor',
+            field=models.CharField(unique=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='meshqualifier',
+            name='subheading',
+            field=models.CharField(unique=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='paper',
+            name='identifier',
+            field=models.CharField(max_length=50),
+        ),
+        migrations.AlterUniqueTogether(
+            name='grant',
+            unique_together=set([('grant_id', 'acronym')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='meshheading',
+            unique_together=set([('descriptor', 'qualifier')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='paper',
+            unique_together=set([('identifier', 'source')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='person',
+            index_together=set([('fore_name', 'last_name')]),
+        ),
+    ]
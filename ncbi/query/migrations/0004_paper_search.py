@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# Titles weigh most, then MeSH headings, then abstracts.
+SQLITE = [
+    "CREATE VIRTUAL TABLE query_paper_fts USING fts5("
+    "title, abstract, headings, tokenize = 'porter unicode61')",
+    "INSERT INTO query_paper_fts (query_paper_fts, rank) "
+    "VALUES ('rank', 'bm25(10.0, 1.0, 5.0)')",
+]
+
+POSTGRESQL = [
+    'CREATE TABLE query_paper_search ('
+    'paper_id integer PRIMARY KEY REFERENCES query_paper (id) '
+    'ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+    'document tsvector NOT NULL)',
+    'CREATE INDEX query_paper_search_document ON query_paper_search '
+    'USING gin (document)',
+]
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            for statement in SQLITE:
+                schema_editor.execute(statement)
+        except OperationalError:
+            # This SQLite was built without FTS5; search falls back to
+            # matching titles.
+            pass
+    elif vendor == 'postgresql':
+        for statement in POSTGRESQL:
+            schema_editor.execute(statement)
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS query_paper_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP TABLE IF EXISTS query_paper_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0003_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0004_paper_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeSHTreeNumber',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('number', models.CharField(unique=True, max_length=255)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='meshdescriptor',
+            name='ui',
+            field=models.CharField(max_length=20, blank=True),
+        ),
+        migrations.AddField(
+            model_name='meshtreenumber',
+            name='descriptor',
+            field=models.ForeignKey(related_name='tree_nodes', to='query.MeSHDescriptor'),
+        ),
+    ]
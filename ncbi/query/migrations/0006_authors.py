@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0005_mesh_tree'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Author',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('last_name', models.CharField(max_length=255)),
+                ('fore_name', models.CharField(max_length=255)),
+                ('block', models.CharField(max_length=255, db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='block',
+            field=models.CharField(db_index=True, max_length=255, blank=True),
+        ),
+        # Authorship takes over the table that Django created for
+        # Paper.authors, which has the same columns and constraint.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='Authorship',
+                    fields=[
+                        ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                        ('paper', models.ForeignKey(to='query.Paper')),
+                        ('person', models.ForeignKey(to='query.Person')),
+                    ],
+                    options={
+                        'db_table': 'query_paper_authors',
+                    },
+                ),
+                migrations.AlterUniqueTogether(
+                    name='authorship',
+                    unique_together=set([('paper', 'person')]),
+                ),
+                migrations.AlterField(
+                    model_name='paper',
+                    name='authors',
+                    field=models.ManyToManyField(to='query.Person', through='query.Authorship'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='authorship',
+            name='author',
+            field=models.ForeignKey(related_name='authorships', on_delete=django.db.models.deletion.SET_NULL, to='query.Author', null=True),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import ast
+import json
+
+from django.db import migrations, models
+import query.models
+
+COLUMNS = [
+    ('query_meshdescriptor', 'tree_numbers'),
+    ('query_job', 'identifiers'),
+]
+
+
+def convert(schema_editor, encode):
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    for table, column in COLUMNS:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, {0} FROM {1}'.format(quote(column),
+                                                            quote(table)))
+            rows = cursor.fetchall()
+            updates = []
+            for pk, value in rows:
+                encoded = encode(value)
+                if encoded != value:
+                    updates.append((encoded, pk))
+            cursor.executemany('UPDATE {0} SET {1} = %s WHERE id = %s'.format(
+                quote(table), quote(column)), updates)
+
+
+def literal_to_json(value):
+    # ListField stored unicode(list), which is a Python literal.
+    if not value:
+        return '[]'
+    try:
+        json.loads(value)
+    except ValueError:
+        return json.dumps(ast.literal_eval(value))
+    return value
+
+
+def json_to_literal(value):
+    return unicode(json.loads(value)) if value else '[]'
+
+
+def forwards(apps, schema_editor):
+    convert(schema_editor, literal_to_json)
+
+
+def backwards(apps, schema_editor):
+    convert(schema_editor, json_to_literal)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0006_authors'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+        migrations.AlterField(
+            model_name='job',
+            name='identifiers',
+            field=query.models.JSONField(default=list, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='meshdescriptor',
+            name='tree_numbers',
+            field=query.models.JSONField(default=list),
+        ),
+    ]
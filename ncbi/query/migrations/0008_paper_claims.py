@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0007_json_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paper',
+            name='claimed_by',
+            field=models.CharField(max_length=255, blank=True),
+        ),
+        migrations.AddField(
+            model_name='paper',
+            name='claimed_on',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='paper',
+            index_together=set([('source', 'retrieved', 'claimed_by')]),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0008_paper_claims'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='affiliation',
+            name='date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='affiliation',
+            name='end_date',
+            field=models.DateField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='affiliation',
+            name='paper',
+            field=models.ForeignKey(related_name='affiliations', to='query.Paper', null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='affiliation',
+            unique_together=set([('person', 'institution', 'date', 'paper')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='affiliation',
+            index_together=set([('institution', 'date')]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def null_empty_issns(apps, schema_editor):
+    # Every journal without an ISSN was resolved to the one row with an
+    # empty ISSN; it keeps the title it was created with.
+    Journal = apps.get_model('query', 'Journal')
+    Journal.objects.filter(issn='').update(issn=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0009_affiliation_history'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='journal',
+            name='issn',
+            field=models.CharField(max_length=50, unique=True, null=True),
+        ),
+        migrations.RunPython(null_empty_issns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Prefix matches on tree numbers (see query.mesh.subtree) can only use a
+# btree index whose operator class compares bytes, whatever the collation.
+INDEX = 'query_meshtreenumber_number_pattern'
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX {0} ON query_meshtreenumber '
+            '(number varchar_pattern_ops)'.format(INDEX))
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS {0}'.format(INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0010_journal_issn_null'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
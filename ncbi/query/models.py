@@ -1,8 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 
 import ast
+import datetime
+import json
 
 DBCHOICES = (
     ('PubMed', 'PubMed'),
@@ -10,6 +13,10 @@ DBCHOICES = (
 )
 
 class ListField(models.TextField):
+    """
+    Superseded by :class:`JSONField`; kept for the historical models in
+    migrations.
+    """
     __metaclass__ = models.SubfieldBase
     description = "Stores a Python list of instances of built-in types"
 
@@ -35,44 +42,159 @@ class ListField(models.TextField):
         value = self._get_val_from_obj(obj)
         return self.get_db_prep_value(value)
 
+class EncodedJSON(unicode):
+    """
+    JSON text as loaded from the database, not yet decoded.
+    """
+
+class JSONDescriptor(object):
+    """
+    Decodes the JSON loaded for a :class:`JSONField` on first access, so that
+    instances whose field is never read never pay for decoding it.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.field.attname]
+        if isinstance(value, EncodedJSON):
+            value = instance.__dict__[self.field.attname] = json.loads(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+class JSONField(models.TextField):
+    """
+    Stores a JSON-serializable value, as ``jsonb`` on PostgreSQL and as text
+    elsewhere. Values loaded from text are decoded lazily; note that
+    ``values()`` and ``values_list()`` return the JSON text itself.
+    """
+    description = "Stores a JSON-serializable value"
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'jsonb'
+        return super(JSONField, self).db_type(connection)
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(JSONField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.name, JSONDescriptor(self))
+
+    def from_db_value(self, value, expression, connection, context):
+        # psycopg2 decodes jsonb itself.
+        if isinstance(value, basestring):
+            return EncodedJSON(value)
+        return value
+
+    def to_python(self, value):
+        if isinstance(value, basestring):
+            return json.loads(value)
+        return value
+
+    def pre_save(self, model_instance, add):
+        # Saves text that was loaded and never decoded as it is.
+        return model_instance.__dict__.get(self.attname)
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, EncodedJSON):
+            return value
+        return json.dumps(value)
+
+    def value_to_string(self, obj):
+        return self.get_prep_value(self._get_val_from_obj(obj))
+
 class Paper(models.Model):
     title = models.CharField(max_length=255, null=True)
     abstract = models.TextField()
     pubdate = models.DateField(null=True)
-    identifier = models.CharField(max_length=50, unique=True)
+    identifier = models.CharField(max_length=50)
     source = models.CharField(max_length=255,
                               choices=DBCHOICES)
 
     published_in = models.ForeignKey('Journal', null=True)
-    authors = models.ManyToManyField('Person')
+    authors = models.ManyToManyField('Person', through='Authorship')
     mesh_headings = models.ManyToManyField('MeSHHeading')
     funding = models.ManyToManyField('Grant')
 
     retrieved = models.BooleanField(default=False)
+    # Worker retrieving the paper, if any; see query.pipeline.claim_papers.
+    claimed_by = models.CharField(max_length=255, blank=True)
+    claimed_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [('identifier', 'source')]
+        index_together = [('source', 'retrieved', 'claimed_by')]
 
 class Journal(models.Model):
     title = models.CharField(max_length=255)
-    issn = models.CharField(max_length=50, unique=True)
+    # Null for journals without an ISSN, which are keyed on their title.
+    issn = models.CharField(max_length=50, unique=True, null=True)
 
 class Person(models.Model):
     last_name = models.CharField(max_length=255)
     fore_name = models.CharField(max_length=255)
     initials = models.CharField(max_length=255)
+    # Surname and first initial; see query.ingest.blocking_key.
+    block = models.CharField(max_length=255, blank=True, db_index=True)
+
+    class Meta:
+        index_together = [('fore_name', 'last_name')]
 
     def __unicode__(self):
         return u'{0} {1}'.format(self.fore_name, self.last_name)
 
+class Author(models.Model):
+    """
+    A researcher, as distinguished from others who publish under the same
+    name by :mod:`query.authors`.
+    """
+    last_name = models.CharField(max_length=255)
+    fore_name = models.CharField(max_length=255)
+    block = models.CharField(max_length=255, db_index=True)
+
+    def __unicode__(self):
+        return u'{0} {1}'.format(self.fore_name, self.last_name)
+
+class Authorship(models.Model):
+    """
+    A Person named as an author of a Paper, and the Author that it was
+    attributed to, if disambiguation has run since the paper was saved.
+    """
+    paper = models.ForeignKey('Paper')
+    person = models.ForeignKey('Person')
+    author = models.ForeignKey('Author', null=True, related_name='authorships',
+                               on_delete=models.SET_NULL)
+
+    class Meta:
+        db_table = 'query_paper_authors'
+        unique_together = [('paper', 'person')]
+
 class Affiliation(models.Model):
     """
     Represents an affiliation between a Person and an Institution at a
-    particular point in time.
+    particular point in time, as stated on a Paper published on ``date``.
+    Rows are only ever added, once per person, institution, date and paper;
+    see :func:`query.ingest.append`.
+
+    Rows saved before affiliations were recorded with their paper have no
+    paper, and were duplicated on every fetch; ``compactaffiliations``
+    collapses them into ranges from ``date`` to ``end_date``.
     """
     person = models.ForeignKey('Person')
     institution = models.ForeignKey('Institution')
-    date = models.DateField()
+    date = models.DateField(null=True)
+    end_date = models.DateField(null=True, blank=True)
+    paper = models.ForeignKey('Paper', null=True, related_name='affiliations')
+
+    class Meta:
+        unique_together = [('person', 'institution', 'date', 'paper')]
+        index_together = [('institution', 'date')]
 
 class Institution(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
     country = models.ForeignKey('Country', null=True)
 
 class Grant(models.Model):
@@ -80,17 +202,23 @@ class Grant(models.Model):
     acronym = models.CharField(max_length=50)
     awarded_by = models.ForeignKey('Agency', related_name='grants')
 
+    class Meta:
+        unique_together = [('grant_id', 'acronym')]
+
 class Agency(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
     country = models.ForeignKey('Country')
 
 class Country(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
 
 class MeSHHeading(models.Model):
     descriptor = models.ForeignKey('MeSHDescriptor')
     qualifier = models.ForeignKey('MeSHQualifier', null=True)
 
+    class Meta:
+        unique_together = [('descriptor', 'qualifier')]
+
     def __unicode__(self):
         if self.qualifier:
             return u'{0}/{1}'.format(self.descriptor.descriptor,
@@ -99,11 +227,41 @@ class MeSHHeading(models.Model):
             return u'{0}'.format(self.descriptor.descriptor)
 
 class MeSHDescriptor(models.Model):
-    descriptor = models.CharField(max_length=255)
-    tree_numbers = ListField()
+    descriptor = models.CharField(max_length=255, unique=True)
+    ui = models.CharField(max_length=20, blank=True)
+    tree_numbers = JSONField(default=list)
+
+class MeSHTreeNumber(models.Model):
+    """
+    A position of a descriptor in the MeSH tree, e.g. ``D12.776.124``; see
+    :mod:`query.mesh`. The subtree under ``t`` is ``t`` and the numbers
+    that start with ``t + '.'``.
+    """
+    number = models.CharField(max_length=255, unique=True)
+    descriptor = models.ForeignKey('MeSHDescriptor', related_name='tree_nodes')
 
 class MeSHQualifier(models.Model):
-    subheading = models.CharField(max_length=255)
+    subheading = models.CharField(max_length=255, unique=True)
+
+class ArchivedRecord(models.Model):
+    """
+    Index entry for a raw response in the archive; see :mod:`query.archive`.
+    """
+    EFETCH = 'efetch'
+    ESEARCH = 'esearch'
+    KINDS = (
+        (EFETCH, 'EFetch record'),
+        (ESEARCH, 'ESearch page'),
+    )
+
+    source = models.CharField(max_length=255, choices=DBCHOICES)
+    identifier = models.CharField(max_length=255)
+    kind = models.CharField(max_length=20, choices=KINDS, default=EFETCH)
+    retrieved_on = models.DateField()
+    digest = models.CharField(max_length=40)
+
+    class Meta:
+        index_together = [('source', 'identifier', 'retrieved_on')]
 
 class Query(models.Model):
     class Meta:
@@ -115,12 +273,115 @@ class Query(models.Model):
     executed = models.BooleanField(default=False)
     querystring = models.TextField()
     database = models.CharField(max_length=255, choices=DBCHOICES)
-    retmax = models.IntegerField(default=100)
+    retmax = models.IntegerField(default=100,
+                                 help_text='Number of IDs per ESearch request.')
+    result_count = models.IntegerField(default=0)
+    webenv = models.CharField(max_length=255, blank=True)
+    query_key = models.CharField(max_length=50, blank=True)
 
     results = models.ManyToManyField(Paper, blank=True)
 
+    def status(self):
+        """
+        Progress of the most recent job for this query.
+        """
+        # The admin changelist sets ``latest_job`` for a whole page at once.
+        if hasattr(self, 'latest_job'):
+            job = self.latest_job
+        else:
+            job = self.jobs.order_by('-pk').first()
+        return job.progress() if job is not None else u''
+
     def results_link(self, *args, **kwargs):
         baseurl = reverse('admin:query_paper_changelist')
         url = "{url}?query={query}".format(url=baseurl, query=self.id)
-        return '<a href="{0}">{1} results</a>'.format(url, self.results.count())
+        count = getattr(self, 'results_count', None)
+        if count is None:
+            count = self.results.count()
+        return '<a href="{0}">{1} results</a>'.format(url, count)
     results_link.allow_tags = True
+
+
+class Job(models.Model):
+    """
+    A search or retrieval queued from the admin, and run by the ``runjobs``
+    management command.
+    """
+    EXECUTE = 'execute'
+    REFRESH = 'refresh'
+    RETRIEVE = 'retrieve'
+    KINDS = (
+        (EXECUTE, 'Execute query'),
+        (REFRESH, 'Refresh query'),
+        (RETRIEVE, 'Retrieve papers'),
+    )
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    kind = models.CharField(max_length=20, choices=KINDS)
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+    query = models.ForeignKey('Query', null=True, blank=True,
+                              related_name='jobs')
+    source = models.CharField(max_length=255, choices=DBCHOICES)
+    identifiers = JSONField(default=list, blank=True)
+
+    created_by = models.ForeignKey(User, null=True, related_name='jobs')
+    created_on = models.DateTimeField(auto_now_add=True)
+    started_on = models.DateTimeField(null=True)
+    updated_on = models.DateTimeField(null=True)
+    finished_on = models.DateTimeField(null=True)
+    worker = models.CharField(max_length=255, blank=True)
+
+    fetched = models.IntegerField(default=0)
+    total = models.IntegerField(null=True)
+    error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u'{0} #{1}'.format(self.get_kind_display(), self.pk)
+
+    @property
+    def rate(self):
+        """
+        Records per second since the job started.
+        """
+        if not self.started_on or not self.updated_on or not self.fetched:
+            return None
+        elapsed = (self.updated_on - self.started_on).total_seconds()
+        return self.fetched / elapsed if elapsed > 0 else None
+
+    @property
+    def eta(self):
+        """
+        Estimated time of completion.
+        """
+        rate = self.rate
+        if rate is None or self.total is None:
+            return None
+        remaining = max(self.total - self.fetched, 0) / rate
+        return self.updated_on + datetime.timedelta(seconds=remaining)
+
+    def progress(self):
+        if self.status == self.PENDING:
+            return u'Pending'
+        if self.status == self.FAILED:
+            return u'Failed: {0}'.format(self.error.strip().splitlines()[-1]
+                                         if self.error else '')
+        progress = u'{0}/{1}'.format(self.fetched, '?' if self.total is None
+                                                   else self.total)
+        if self.status == self.RUNNING and self.rate is not None:
+            progress += u' at {0:.1f}/s'.format(self.rate)
+            if self.eta is not None:
+                progress += u', ETA {0:%Y-%m-%d %H:%M:%S}'.format(
+                    timezone.localtime(self.eta))
+        elif self.status == self.DONE:
+            progress += u' done'
+        return progress
@@ -0,0 +1,386 @@
+"""
+Pipelined harvesting.
+
+:class:`Harvester` overlaps the three stages of retrieving papers, so that
+the network is not idle while the database is written to, and vice versa:
+
+1. downloader threads request EFetch batches, by identifier or from the
+   history server session of a query, and read records that are fresh in the
+   archive from it instead (see :meth:`NCBIManager.fresh`); their combined
+   request rate is bounded by the manager's transport;
+2. parser threads turn each response into records;
+3. a single writer, running in the calling thread, saves the records in
+   batches with :meth:`NCBIManager.process_records` and marks the papers as
+   retrieved.
+
+Stages are connected by bounded queues, so a slow stage holds the others back
+rather than letting responses pile up in memory. Only the writer touches the
+database.
+
+:func:`harvest_claimed` runs harvesters over chunks of papers claimed with
+:func:`claim_papers`, so that several worker processes, on one host or many,
+can retrieve the same result set without retrieving any paper twice.
+"""
+
+from collections import OrderedDict
+import datetime
+from StringIO import StringIO
+import Queue
+import threading
+import time
+
+from django.utils import timezone
+
+from . import cache
+from .ingest import chunked
+from .models import Paper
+
+DONE = object()
+
+
+class StageStats(object):
+    """
+    Throughput counters for one stage of a :class:`Harvester`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.records = 0
+        self.bytes = 0
+        self.errors = 0
+        self.busy = 0.
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, records=0, seconds=0., bytes=0, errors=0):
+        with self._lock:
+            self.batches += 1
+            self.records += records
+            self.bytes += bytes
+            self.errors += errors
+            self.busy += seconds
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """
+        Records per second of wall-clock time.
+        """
+        elapsed = self.elapsed
+        return self.records / elapsed if elapsed else 0.
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'batches': self.batches,
+            'records': self.records,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'busy': self.busy,
+            'elapsed': self.elapsed,
+            'rate': self.rate,
+        }
+
+    def __unicode__(self):
+        return (u'{name}: {records} records in {batches} batches, '
+                u'{rate:.1f}/s, {busy:.1f}s busy, {errors} errors'
+                .format(**dict(self.as_dict(), name=self.name)))
+
+
+class Harvester(object):
+    """
+    Retrieves papers with concurrent downloaders and parsers and a single
+    batched database writer.
+
+    Parameters
+    ----------
+    manager : :class:`query.connector.NCBIManager`
+    downloaders : int
+        Number of concurrent EFetch requests.
+    parsers : int
+        Number of parser threads.
+    batch_size : int
+        Identifiers per EFetch request; defaults to ``manager.batch_size``.
+    write_size : int
+        Records per database write.
+    queue_size : int
+        Capacity of the queues between stages, in batches.
+    callback : callable
+        Called with the harvester after each database write.
+    """
+
+    def __init__(self, manager, downloaders=3, parsers=2, batch_size=None,
+                 write_size=1000, queue_size=8, callback=None):
+        self.manager = manager
+        self.downloaders = downloaders
+        self.parsers = parsers
+        self.batch_size = batch_size or manager.batch_size
+        self.write_size = write_size
+        self.queue_size = queue_size
+        self.callback = callback
+
+        self.stats = OrderedDict([(name, StageStats(name))
+                                  for name in ('download', 'parse', 'write')])
+        self.failed = []
+
+    def _start(self, target, count, *args):
+        threads = []
+        for i in xrange(count):
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _close_after(self, stage, threads, queue, count):
+        """
+        Signals the next stage once all of ``threads`` have finished.
+        """
+        def close():
+            for thread in threads:
+                thread.join()
+            self.stats[stage].finished = time.time()
+            for i in xrange(count):
+                queue.put(DONE)
+        self._start(close, 1)
+
+    # Batches are (identifiers, open) pairs, where ``open`` opens the
+    # response; identifiers are None for batches of a history session, whose
+    # records are all kept. Archived responses are not archived again.
+
+    # The feeders always signal the downloaders, even if they fail, so that
+    # no downloader waits for a batch forever.
+
+    def _feed(self, identifiers, fresh, batches):
+        try:
+            for identifier in identifiers:
+                if identifier in fresh:
+                    batches.put(([identifier], self._open_archived(
+                        fresh[identifier])))
+            batch = []
+            for identifier in identifiers:
+                if identifier in fresh:
+                    continue
+                batch.append(identifier)
+                if len(batch) == self.batch_size:
+                    batches.put((batch, self._open_batch(batch)))
+                    batch = []
+            if batch:
+                batches.put((batch, self._open_batch(batch)))
+        finally:
+            for i in xrange(self.downloaders):
+                batches.put(DONE)
+
+    def _feed_history(self, query, batches):
+        try:
+            for retstart in xrange(0, query.result_count, self.batch_size):
+                batches.put((None, self._open_history(query, retstart)))
+        finally:
+            for i in xrange(self.downloaders):
+                batches.put(DONE)
+
+    def _open_batch(self, batch):
+        return lambda: (self.manager.open_resource(self.manager.endpoint,
+                                                   term=','.join(batch)),
+                        True)
+
+    def _open_archived(self, digest):
+        return lambda: (self.manager.archive.open(digest), False)
+
+    def _open_history(self, query, retstart):
+        return lambda: (self.manager.open_history(query, retstart,
+                                                  self.batch_size), True)
+
+    def _download(self, batches, downloaded):
+        stats = self.stats['download']
+        while True:
+            item = batches.get()
+            if item is DONE:
+                return
+            batch, open_batch = item
+            start = time.time()
+            try:
+                stream, archive = open_batch()
+                try:
+                    body = stream.read()
+                finally:
+                    stream.close()
+            except Exception:
+                stats.add(seconds=time.time() - start, errors=1)
+                self.failed.extend(batch or [])
+                continue
+            stats.add(len(batch or []), time.time() - start, bytes=len(body))
+            downloaded.put((batch, body, archive))
+
+    def _parse(self, downloaded, parsed):
+        stats = self.stats['parse']
+        while True:
+            item = downloaded.get()
+            if item is DONE:
+                return
+            batch, body, archive = item
+            start = time.time()
+            try:
+                records = self.manager.parse_records(StringIO(body), batch,
+                                                     archive=archive)
+            except Exception:
+                stats.add(seconds=time.time() - start, errors=1)
+                self.failed.extend(batch or [])
+                continue
+            stats.add(len(records), time.time() - start)
+            parsed.put(records)
+
+    def _write(self, records):
+        start = time.time()
+        papers = self.manager.process_records(records)
+        for chunk in chunked([paper.pk for paper in papers]):
+            Paper.objects.filter(pk__in=chunk).update(
+                retrieved=True, claimed_by='', claimed_on=None)
+            cache.invalidate_papers(chunk)
+        self.stats['write'].add(len(papers), time.time() - start)
+        if self.callback is not None:
+            self.callback(self)
+
+    def run(self, identifiers):
+        """
+        Retrieves and saves the papers for ``identifiers``. Returns the stage
+        statistics; identifiers whose batch could not be downloaded or parsed
+        are listed in :attr:`failed`.
+        """
+        identifiers = [unicode(identifier) for identifier in identifiers]
+        # Looked up here, since only the calling thread uses the database.
+        fresh = self.manager.fresh(identifiers)
+        return self._run(self._feed, identifiers, fresh)
+
+    def run_history(self, query):
+        """
+        Retrieves and saves the whole result set of an executed ``query``
+        from its history server session, as :meth:`NCBIManager.fetch_history`
+        does. Returns the stage statistics. Batches that fail are not listed
+        in :attr:`failed`; retrieve the papers of the query that are still
+        not retrieved afterwards with :meth:`run`.
+        """
+        return self._run(self._feed_history, query)
+
+    def _run(self, feed, *args):
+        batches = Queue.Queue(maxsize=self.queue_size)
+        downloaded = Queue.Queue(maxsize=self.queue_size)
+        parsed = Queue.Queue(maxsize=self.queue_size)
+
+        # Stats accumulate over the runs of a harvester, from the first.
+        started = time.time()
+        for stage in self.stats.values():
+            if stage.started is None:
+                stage.started = started
+
+        self._start(feed, 1, *(args + (batches,)))
+        downloaders = self._start(self._download, self.downloaders, batches,
+                                  downloaded)
+        self._close_after('download', downloaders, downloaded, self.parsers)
+        parsers = self._start(self._parse, self.parsers, downloaded, parsed)
+        self._close_after('parse', parsers, parsed, 1)
+
+        buffered = []
+        while True:
+            records = parsed.get()
+            if records is DONE:
+                break
+            buffered.extend(records)
+            if len(buffered) >= self.write_size:
+                self._write(buffered)
+                buffered = []
+        if buffered:
+            self._write(buffered)
+
+        self.stats['write'].finished = time.time()
+        return self.stats
+
+
+def claim_papers(source, worker, size, papers=None):
+    """
+    Claims up to ``size`` unretrieved and unclaimed papers from database
+    ``source``, among ``papers`` if given, for ``worker``, and returns their
+    identifiers.
+
+    The claim is an UPDATE conditional on the papers being unclaimed, as in
+    :func:`query.jobs.claim_job`, so that each paper is claimed by only one
+    worker on any database backend. If other workers claim every candidate
+    first, the next candidates are tried.
+    """
+    if papers is None:
+        papers = Paper.objects.all()
+    papers = papers.filter(source=source, retrieved=False, claimed_by='')
+    while True:
+        candidates = list(papers.order_by('pk')
+                                .values_list('pk', flat=True)[:size])
+        if not candidates:
+            return []
+        now = timezone.now()
+        claimed = []
+        for chunk in chunked(candidates):
+            Paper.objects.filter(pk__in=chunk, retrieved=False,
+                                 claimed_by='').update(claimed_by=worker,
+                                                       claimed_on=now)
+            claimed.extend(Paper.objects.filter(pk__in=chunk,
+                                                claimed_by=worker)
+                                        .order_by('pk')
+                                        .values_list('identifier', flat=True))
+        if claimed:
+            return claimed
+
+
+def release_papers(worker):
+    """
+    Releases the unretrieved papers claimed by ``worker``.
+    """
+    return Paper.objects.filter(claimed_by=worker, retrieved=False) \
+                        .update(claimed_by='', claimed_on=None)
+
+
+def release_stale(source, timeout):
+    """
+    Releases unretrieved papers from ``source`` that were claimed more than
+    ``timeout`` seconds ago, by workers that are presumed dead.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=timeout)
+    return Paper.objects.filter(source=source, retrieved=False,
+                                claimed_on__lt=cutoff) \
+                        .update(claimed_by='', claimed_on=None)
+
+
+def harvest_claimed(manager, worker, papers=None, claim_size=1000,
+                    **options):
+    """
+    Retrieves the unretrieved papers from ``manager.db``, among ``papers`` if
+    given, claiming ``claim_size`` of them at a time for ``worker`` and
+    running a :class:`Harvester`, with ``options``, over each chunk. Other
+    workers may do the same at the same time.
+
+    Papers that could not be retrieved stay claimed until there is nothing
+    left to claim, so that the worker does not retry them, and are then
+    released for a later run.
+
+    Returns the number of papers retrieved, and the identifiers of those
+    that were not.
+    """
+    retrieved = 0
+    try:
+        while True:
+            identifiers = claim_papers(manager.db, worker, claim_size, papers)
+            if not identifiers:
+                break
+            stats = Harvester(manager, **options).run(identifiers)
+            retrieved += stats['write'].records
+        failed = list(Paper.objects.filter(claimed_by=worker, retrieved=False)
+                                   .order_by('pk')
+                                   .values_list('identifier', flat=True))
+    finally:
+        release_papers(worker)
+    return retrieved, failed
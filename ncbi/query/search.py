@@ -0,0 +1,232 @@
+"""
+Local full-text index over paper titles, abstracts and MeSH headings.
+
+On SQLite the index is an FTS5 table, ``query_paper_fts``, whose rowids are
+paper ids; on PostgreSQL it is a ``tsvector`` column in
+``query_paper_search`` with a GIN index. Both are created by migration
+``0004_paper_search``, and weight titles above headings above abstracts.
+:func:`query.ingest.process_records` keeps the index up to date as papers
+are saved, and the ``rebuildsearchindex`` management command indexes papers
+saved before the index existed.
+
+On other databases, or SQLite builds without FTS5, :func:`get_backend`
+returns None and :func:`search` falls back to ``icontains`` on the title.
+"""
+
+import re
+
+from django.db import connections
+from django.db.models import Prefetch
+from django.db.models.signals import post_delete
+
+from .models import MeSHHeading, Paper
+
+CHUNK_SIZE = 500
+
+
+def heading_text(headings):
+    """
+    Indexed text for ``(descriptor, qualifier)`` pairs of MeSH heading names.
+    """
+    return u'; '.join([descriptor if qualifier is None
+                       else u'{0}/{1}'.format(descriptor, qualifier)
+                       for descriptor, qualifier in headings])
+
+
+class SQLiteBackend(object):
+    table = 'query_paper_fts'
+
+    def prepare(self, text):
+        # Quotes every word, so that FTS5 query syntax in user input is
+        # matched literally; the words are implicitly ANDed.
+        words = re.findall(r'\w+', text, re.UNICODE)
+        return u' '.join([u'"{0}"'.format(word) for word in words])
+
+    def index(self, cursor, entries):
+        cursor.executemany(
+            'INSERT INTO query_paper_fts (rowid, title, abstract, headings) '
+            'VALUES (%s, %s, %s, %s)', entries)
+
+    def remove(self, cursor, ids):
+        cursor.execute('DELETE FROM query_paper_fts WHERE rowid IN (%s)'
+                       % ', '.join(['%s'] * len(ids)), ids)
+
+    def search(self, cursor, query, limit, offset):
+        cursor.execute('SELECT rowid, -rank FROM query_paper_fts '
+                       'WHERE query_paper_fts MATCH %s ORDER BY rank '
+                       'LIMIT %s OFFSET %s', [query, limit, offset])
+        return cursor.fetchall()
+
+    def matches(self):
+        return ('"query_paper"."id" IN (SELECT rowid FROM query_paper_fts '
+                'WHERE query_paper_fts MATCH %s)')
+
+    def rank(self):
+        return ('SELECT rank FROM query_paper_fts WHERE query_paper_fts '
+                'MATCH %s AND rowid = "query_paper"."id"')
+
+
+class PostgreSQLBackend(object):
+    table = 'query_paper_search'
+    document = ("setweight(to_tsvector('english', %s), 'A') || "
+                "setweight(to_tsvector('english', %s), 'C') || "
+                "setweight(to_tsvector('english', %s), 'B')")
+
+    def prepare(self, text):
+        return text.strip()
+
+    def index(self, cursor, entries):
+        cursor.executemany(
+            'INSERT INTO query_paper_search (paper_id, document) '
+            'VALUES (%s, {0})'.format(self.document), entries)
+
+    def remove(self, cursor, ids):
+        cursor.execute('DELETE FROM query_paper_search WHERE paper_id IN (%s)'
+                       % ', '.join(['%s'] * len(ids)), ids)
+
+    def search(self, cursor, query, limit, offset):
+        cursor.execute("SELECT paper_id, ts_rank_cd(document, q) "
+                       "FROM query_paper_search, "
+                       "plainto_tsquery('english', %s) q "
+                       "WHERE document @@ q ORDER BY 2 DESC "
+                       "LIMIT %s OFFSET %s", [query, limit, offset])
+        return cursor.fetchall()
+
+    def matches(self):
+        return ('"query_paper"."id" IN (SELECT paper_id FROM '
+                'query_paper_search WHERE document @@ '
+                'plainto_tsquery(\'english\', %s))')
+
+    def rank(self):
+        return ("SELECT -ts_rank_cd(document, plainto_tsquery('english', %s)) "
+                'FROM query_paper_search '
+                'WHERE paper_id = "query_paper"."id"')
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'postgresql': PostgreSQLBackend,
+}
+
+_available = {}
+
+
+def get_backend(using='default'):
+    """
+    Returns the search backend for database ``using``, or None if it has no
+    full-text index.
+    """
+    connection = connections[using]
+    backend = BACKENDS.get(connection.vendor)
+    if backend is None:
+        return None
+    key = (using, connection.settings_dict['NAME'])
+    if key not in _available:
+        with connection.cursor() as cursor:
+            tables = connection.introspection.table_names(cursor)
+        _available[key] = backend.table in tables
+    return backend() if _available[key] else None
+
+
+def index(entries, using='default'):
+    """
+    Adds or replaces index entries, given as ``(paper id, title, abstract,
+    headings)`` tuples.
+    """
+    backend = get_backend(using)
+    if backend is None:
+        return
+    entries = [(pk, title or u'', abstract or u'', headings or u'')
+               for pk, title, abstract, headings in entries]
+    with connections[using].cursor() as cursor:
+        for start in xrange(0, len(entries), CHUNK_SIZE):
+            chunk = entries[start:start + CHUNK_SIZE]
+            backend.remove(cursor, [entry[0] for entry in chunk])
+            backend.index(cursor, chunk)
+
+
+def remove(ids, using='default'):
+    backend = get_backend(using)
+    if backend is None:
+        return
+    ids = list(ids)
+    with connections[using].cursor() as cursor:
+        for start in xrange(0, len(ids), CHUNK_SIZE):
+            backend.remove(cursor, ids[start:start + CHUNK_SIZE])
+
+
+def rebuild(queryset=None, chunk_size=CHUNK_SIZE):
+    """
+    Indexes the papers in ``queryset``, or all papers that have been
+    fetched, and returns how many there were.
+    """
+    if queryset is None:
+        queryset = Paper.objects.filter(title__isnull=False)
+    queryset = queryset.order_by('pk').prefetch_related(
+        Prefetch('mesh_headings', queryset=MeSHHeading.objects
+                 .select_related('descriptor', 'qualifier')))
+    count, last = 0, None
+    while True:
+        page = queryset if last is None else queryset.filter(pk__gt=last)
+        papers = list(page[:chunk_size])
+        if not papers:
+            return count
+        index([(paper.pk, paper.title, paper.abstract, heading_text([
+                   (heading.descriptor.descriptor,
+                    heading.qualifier.subheading if heading.qualifier
+                    else None)
+                   for heading in paper.mesh_headings.all()]))
+               for paper in papers], queryset.db)
+        count += len(papers)
+        last = papers[-1].pk
+
+
+def search(text, limit=20, offset=0, using='default'):
+    """
+    Returns up to ``limit`` papers matching ``text``, best first. Each paper
+    has a ``score``; higher is better.
+    """
+    backend = get_backend(using)
+    if backend is None:
+        papers = list(Paper.objects.using(using)
+                                   .filter(title__icontains=text)
+                                   .order_by('pk')[offset:offset + limit])
+        for paper in papers:
+            paper.score = None
+        return papers
+
+    query = backend.prepare(text)
+    if not query:
+        return []
+    with connections[using].cursor() as cursor:
+        scores = backend.search(cursor, query, limit, offset)
+    papers = Paper.objects.using(using).in_bulk([pk for pk, score in scores])
+    results = []
+    for pk, score in scores:
+        if pk in papers:
+            papers[pk].score = score
+            results.append(papers[pk])
+    return results
+
+
+def matching(queryset, text):
+    """
+    Restricts a queryset of papers to those matching ``text``, and annotates
+    them with ``search_rank`` for ordering, lower being better. Returns None
+    if the database has no full-text index.
+    """
+    backend = get_backend(queryset.db)
+    if backend is None:
+        return None
+    query = backend.prepare(text)
+    if not query:
+        return queryset.none()
+    return queryset.extra(select={'search_rank': backend.rank()},
+                          select_params=[query],
+                          where=[backend.matches()], params=[query])
+
+
+def remove_deleted(sender, instance, using, **kwargs):
+    remove([instance.pk], using)
+
+post_delete.connect(remove_deleted, sender=Paper)
@@ -0,0 +1,170 @@
+"""
+Local stand-in for the E-utilities service, for tests and benchmarks.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import os
+import threading
+import urlparse
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+
+TESTDATA = os.path.join(os.path.dirname(__file__), 'testdata')
+
+
+class FakeEutilsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        utility = parts.path.rsplit('/', 1)[-1].split('.')[0]
+        params = dict(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+        with self.server.lock:
+            self.server.requests.append((utility, params))
+            status = self.server.failures.pop(0) if self.server.failures else 200
+
+        if status == 200:
+            body = self.server.handler(utility, params)
+        else:
+            body = ''
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        if status == 200 and self.server.gzip and \
+                'gzip' in self.headers.get('accept-encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeEutilsServer(object):
+    """
+    Serves E-utilities requests on a local port.
+
+    ``handler`` is called with the utility name (e.g. ``'efetch'``) and the
+    query parameters of each request, and returns the response body. Status
+    codes in ``failures`` are answered, in order, before any request is
+    handled, to exercise retries.
+
+    Use as a context manager; ``url`` can be assigned to
+    :attr:`query.connector.NCBIManager.eutils`.
+    """
+
+    def __init__(self, handler, failures=None, gzip=True):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeEutilsHandler)
+        self.httpd.handler = handler
+        self.httpd.failures = list(failures or [])
+        self.httpd.gzip = gzip
+        self.httpd.requests = []
+        self.httpd.connections = 0
+        self.httpd.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:%i/entrez/eutils' % self.httpd.server_port
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FixtureCorpus(object):
+    """
+    Answers E-utilities requests for any identifiers from recorded responses
+    in ``testdata``, so that result sets of any size can be served offline.
+
+    EFetch records are copies of the records in ``efetch``, in turn, with
+    their identifier replaced by the one requested; authors, journals,
+    headings and grants repeat, as in the results of a topical query.
+    ESearch pages list ``identifiers`` in the layout of the ``esearch``
+    response, and EFetch requests on the history server are answered from
+    ``identifiers`` too.
+
+    Use :meth:`handle` as the handler of a :class:`FakeEutilsServer`.
+    """
+    sentinel = 'FIXTURE-IDENTIFIER'
+
+    def __init__(self, manager, efetch, esearch, identifiers=()):
+        self.identifiers = list(identifiers)
+        with open(os.path.join(TESTDATA, efetch)) as f:
+            root = ET.fromstring(f.read())
+        self.root = root.tag
+        # Each record is kept serialized, split around its identifier.
+        self.templates = []
+        for record in root.findall(manager.record_path):
+            record.find(manager.record_id_path).text = self.sentinel
+            self.templates.append(ET.tostring(record).split(self.sentinel))
+        with open(os.path.join(TESTDATA, esearch)) as f:
+            self.esearch = f.read()
+
+    def fetch(self, identifiers):
+        """
+        Returns an EFetch response with a record for each of ``identifiers``.
+        """
+        parts = ['<?xml version="1.0"?>\n<{0}>\n'.format(self.root)]
+        for i, identifier in enumerate(identifiers):
+            before, after = self.templates[i % len(self.templates)]
+            parts.extend([before, escape(identifier), after])
+        parts.append('</{0}>\n'.format(self.root))
+        return ''.join(parts)
+
+    def search(self, retstart, retmax, usehistory):
+        """
+        Returns an ESearch response for a page of :attr:`identifiers`.
+        """
+        root = ET.fromstring(self.esearch)
+        root.find('Count').text = str(len(self.identifiers))
+        root.find('RetMax').text = str(retmax)
+        root.find('RetStart').text = str(retstart)
+        if not usehistory:
+            for tag in ('QueryKey', 'WebEnv'):
+                root.remove(root.find(tag))
+        idlist = root.find('IdList')
+        idlist.clear()
+        for identifier in self.identifiers[retstart:retstart + retmax]:
+            ET.SubElement(idlist, 'Id').text = identifier
+        return ET.tostring(root)
+
+    def handle(self, utility, params):
+        retstart = int(params.get('retstart', 0))
+        retmax = int(params.get('retmax', 20))
+        if utility == 'esearch':
+            return self.search(retstart, retmax,
+                               params.get('usehistory') == 'y')
+        if 'WebEnv' in params:
+            return self.fetch(self.identifiers[retstart:retstart + retmax])
+        return self.fetch(params['id'].split(','))
@@ -1,6 +1,47 @@
-from django.test import TestCase
+from collections import OrderedDict
+import csv
+import datetime
+from importlib import import_module
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import urllib2
+from StringIO import StringIO
+import xml.etree.ElementTree as ET
+
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.state import ProjectState
+from django.apps import apps
+from django.http import Http404
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
 from .models import *
 from .connector import PubMedManager, PMCManager
+from .archive import ResponseArchive
+from .benchmarks import (LEGACY_PARSERS, extract_benchmark, ingest_benchmark,
+                         load_results, lookup_benchmark, regressions,
+                         save_results)
+from .ingest import affiliated_institutions, blocking_key
+from .export import export
+from .extract import ElementTreeBackend, LxmlBackend, lxml_etree
+from .lookup import LRUCache, get_lookup_cache
+from .metrics import FileMetrics, Metrics, get_metrics
+from .pipeline import (Harvester, claim_papers, harvest_claimed,
+                       release_papers, release_stale)
+from . import (admin as query_admin, api, authors, cache, graphs, ingest,
+               jobs, mesh, metrics, search, views)
+from .admin import ApproximatePaginator, QueryAdmin, QueryListFilter
+from .testing import FakeEutilsServer, FixtureCorpus
+from .transport import HTTPTransport, RateLimiter, FileRateLimiter
 
 class TestPubMedFetch(TestCase):
     def setUp(self):
@@ -25,3 +66,1711 @@ class TestPMCFetch(TestCase):
         self.assertTrue(paper.title is not None)
         self.assertTrue(paper.published_in is not None)
         self.assertEqual(paper.authors.count(), 7)
+
+
+def testdata(filename):
+    return os.path.join(os.path.dirname(__file__), 'testdata', filename)
+
+
+class FixtureMixin(object):
+    """
+    Serves EFetch responses from a local file and ESearch responses from
+    ``search_ids``, recording request parameters.
+    """
+    fixture = None
+    search_ids = []
+
+    def __init__(self, *args, **kwargs):
+        super(FixtureMixin, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def open_resource(self, endpoint, **kwargs):
+        self.requests.append(kwargs)
+        if endpoint == self.searchpoint:
+            root = self.get_searchresults(**kwargs)
+        else:
+            with open(testdata(self.fixture)) as f:
+                root = ET.fromstring(f.read())
+        if endpoint == self.historypoint:
+            records = root.findall(self.record_path)
+            start, stop = kwargs['retstart'], kwargs['retstart'] + kwargs['retmax']
+            for record in records[:start] + records[stop:]:
+                root.remove(record)
+        return StringIO(ET.tostring(root))
+
+    def get_searchresults(self, retstart, retmax, usehistory, **kwargs):
+        root = ET.Element('eSearchResult')
+        ET.SubElement(root, 'Count').text = str(len(self.search_ids))
+        if usehistory == 'y':
+            ET.SubElement(root, 'QueryKey').text = '1'
+            ET.SubElement(root, 'WebEnv').text = 'NCID_1_1234'
+        idlist = ET.SubElement(root, 'IdList')
+        for identifier in self.search_ids[retstart:retstart + retmax]:
+            ET.SubElement(idlist, 'Id').text = identifier
+        return root
+
+
+class FixturePubMedManager(FixtureMixin, PubMedManager):
+    fixture = 'pubmed_efetch.xml'
+    search_ids = ['23144831', '22028469', '21909271']
+
+
+class FixturePMCManager(FixtureMixin, PMCManager):
+    fixture = 'pmc_efetch.xml'
+
+
+class TestPubMedFetchMany(TestCase):
+    def setUp(self):
+        self.manager = FixturePubMedManager()
+
+    def test_fetch_many(self):
+        papers = self.manager.fetch_many(['23144831', '22028469'])
+
+        self.assertEqual(len(self.manager.requests), 1)
+        self.assertEqual(self.manager.requests[0]['term'],
+                         '23144831,22028469')
+        self.assertEqual([p.identifier for p in papers],
+                         ['23144831', '22028469'])
+
+        paper = papers[0]
+        self.assertEqual(paper.funding.count(), 3)
+        self.assertEqual(paper.mesh_headings.count(), 4)
+        self.assertEqual(paper.authors.count(), 3)
+        self.assertEqual(paper.published_in.issn, '1553-7404')
+        self.assertEqual(papers[1].authors.count(), 3)
+        self.assertEqual(Person.objects.count(), 4)
+
+    def test_fetch_many_batches(self):
+        self.manager.fetch_many(['23144831', '22028469'], batch_size=1)
+        self.assertEqual([r['term'] for r in self.manager.requests],
+                         ['23144831', '22028469'])
+        self.assertEqual(Paper.objects.count(), 2)
+
+    def test_fetch_many_query_count(self):
+        def count_queries(identifiers):
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as queries:
+                    self.manager.fetch_many(identifiers)
+                transaction.set_rollback(True)
+            return len(queries)
+
+        # Only the per-paper save depends on the size of the batch.
+        self.assertEqual(count_queries(['23144831', '22028469']),
+                         count_queries(['23144831']) + 1)
+
+    def test_fetch_many_refetch(self):
+        self.manager.fetch_many(['23144831'])
+        paper = self.manager.fetch_many(['23144831'])[0]
+
+        self.assertEqual(paper.authors.count(), 3)
+        self.assertEqual(paper.mesh_headings.count(), 4)
+        self.assertEqual(MeSHHeading.objects.count(), 4)
+        self.assertEqual(Grant.objects.count(), 3)
+
+    def test_journals_without_issn(self):
+        with open(testdata('pubmed_efetch.xml')) as f:
+            records = self.manager.parse_records(f)
+        records[0]['journal'] = ('', 'Journal A')
+        records[1]['journal'] = (None, 'Journal B')
+        papers = self.manager.process_records(records)
+        self.assertEqual(sorted(Journal.objects.values_list('issn', 'title')),
+                         [(None, 'Journal A'), (None, 'Journal B')])
+        self.assertEqual(self.manager.process_records(records[:1])[0]
+                             .published_in_id, papers[0].published_in_id)
+        self.assertEqual(Journal.objects.count(), 2)
+
+    def test_fetch_many_skips_unrequested(self):
+        papers = self.manager.fetch_many(['22028469'])
+        self.assertEqual([p.identifier for p in papers], ['22028469'])
+
+
+class TestIterRecords(TestCase):
+    def test_records_are_cleared(self):
+        manager = FixturePubMedManager()
+        stream = manager.open_resource(manager.endpoint, term='')
+
+        identifiers, records = [], []
+        for identifier, record in manager.iter_records(stream):
+            self.assertEqual(record.tag, 'PubmedArticleSet')
+            self.assertEqual(len(record), 1)
+            self.assertNotEqual(manager.parse_resource(record, identifier)['title'],
+                                '')
+            identifiers.append(identifier)
+            records.append(record[0])
+
+        self.assertEqual(identifiers, ['23144831', '22028469'])
+        self.assertEqual([len(record) for record in records], [0, 0])
+        self.assertTrue(stream.closed)
+
+
+class TestPMCFetchMany(TestCase):
+    def setUp(self):
+        self.manager = FixturePMCManager()
+
+    def test_fetch_many(self):
+        papers = self.manager.fetch_many(['PMC3492385', '3197681'])
+
+        self.assertEqual([p.identifier for p in papers],
+                         ['PMC3492385', '3197681'])
+        self.assertEqual(papers[0].authors.count(), 2)
+        self.assertEqual(papers[1].authors.count(), 1)
+        self.assertTrue(papers[0].published_in is not None)
+
+
+class TestPubMedSearchHistory(TestCase):
+    def setUp(self):
+        self.manager = FixturePubMedManager()
+        user = User.objects.create(username='tester')
+        self.query = Query.objects.create(created_by=user, database='PubMed',
+                                          querystring='elegans', retmax=2)
+
+    def test_search_pages(self):
+        self.manager.search(self.query)
+
+        self.assertEqual([(r['retstart'], r['usehistory'])
+                          for r in self.manager.requests], [(0, 'y'), (2, 'n')])
+        query = Query.objects.get(pk=self.query.pk)
+        self.assertEqual(query.result_count, 3)
+        self.assertEqual(query.webenv, 'NCID_1_1234')
+        self.assertEqual(query.query_key, '1')
+        self.assertEqual(query.results.count(), 3)
+
+    def test_fetch_history(self):
+        self.manager.search(self.query)
+        self.manager.requests = []
+
+        papers = list(self.manager.fetch_history(self.query, batch_size=1))
+
+        self.assertEqual([r['retstart'] for r in self.manager.requests],
+                         [0, 1, 2])
+        self.assertEqual([p.identifier for p in papers],
+                         ['23144831', '22028469'])
+        self.assertEqual(papers[0].authors.count(), 3)
+
+    def test_fetch_history_requires_session(self):
+        with self.assertRaises(ValueError):
+            list(self.manager.fetch_history(self.query))
+
+
+class TestLookupCache(TransactionTestCase):
+    def setUp(self):
+        self.manager = FixturePubMedManager()
+        self.cache = get_lookup_cache()
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_repeated_lookups_hit(self):
+        self.manager.fetch_many(['23144831'])
+        self.assertEqual(self.cache.info()['hits'], 0)
+
+        with CaptureQueriesContext(connection) as first:
+            self.manager.fetch_many(['22028469'])
+        with CaptureQueriesContext(connection) as second:
+            self.manager.fetch_many(['22028469'])
+
+        self.assertTrue(self.cache.info()['hits'] > 0)
+        self.assertTrue(len(second) < len(first))
+        self.assertEqual(MeSHHeading.objects.count(), 5)
+
+    def test_rolled_back_rows_are_not_cached(self):
+        try:
+            with transaction.atomic():
+                self.manager.fetch_many(['23144831'])
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(MeSHDescriptor.objects.count(), 0)
+
+        paper = self.manager.fetch_many(['23144831'])[0]
+        self.assertEqual(self.cache.info()['hits'], 0)
+        self.assertEqual(paper.mesh_headings.count(), 4)
+        self.assertEqual(MeSHDescriptor.objects.count(), 3)
+
+    def test_deleted_rows_are_evicted(self):
+        self.manager.fetch_many(['23144831'])
+        Journal.objects.all().delete()
+
+        paper = self.manager.fetch_many(['23144831'])[0]
+        self.assertEqual(Journal.objects.get().pk, paper.published_in.pk)
+
+    def test_concurrent_workers(self):
+        # Another worker saves records with the same headings after this
+        # one has looked them up, but before it inserts them.
+        lookup = ingest._lookup
+        raced = []
+
+        def lookup_then_race(model, keys, fields):
+            found = lookup(model, keys, fields)
+            if model is MeSHDescriptor and not raced:
+                raced.append(model)
+                FixturePubMedManager().fetch_many(['22028469'])
+            return found
+
+        ingest._lookup = lookup_then_race
+        try:
+            paper = self.manager.fetch_many(['23144831'])[0]
+        finally:
+            ingest._lookup = lookup
+
+        self.assertTrue(raced)
+        self.assertEqual(paper.mesh_headings.count(), 4)
+        self.assertEqual(MeSHDescriptor.objects.count(), 3)
+        self.assertEqual(MeSHHeading.objects.count(), 5)
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        for name in ['a', 'b', 'c']:
+            cache.set(Country, (name,), Country(name=name))
+        self.assertTrue(cache.get(Country, ('a',)) is None)
+        self.assertEqual(cache.get(Country, ('c',)).name, 'c')
+        self.assertEqual(cache.info(), {'hits': 1, 'misses': 1, 'maxsize': 2,
+                                        'currsize': 2})
+
+
+def serve_fixture(filename):
+    def handler(utility, params):
+        with open(testdata(filename)) as f:
+            return f.read()
+    return handler
+
+
+class TestHTTPTransport(TestCase):
+    def get_manager(self, server, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        transport = HTTPTransport(rate_limiter=RateLimiter(1000), **kwargs)
+        manager = PubMedManager(transport=transport)
+        manager.eutils = server.url
+        return manager
+
+    def test_fetch_many(self):
+        with FakeEutilsServer(serve_fixture('pubmed_efetch.xml')) as server:
+            manager = self.get_manager(server)
+            papers = manager.fetch_many(['23144831', '22028469'], batch_size=1)
+
+        self.assertEqual(len(papers), 2)
+        self.assertEqual([params['id'] for utility, params in server.requests],
+                         ['23144831', '22028469'])
+        # Both batches went over the same keep-alive connection.
+        self.assertEqual(server.connections, 1)
+
+    def test_api_key(self):
+        with FakeEutilsServer(serve_fixture('pubmed_efetch.xml')) as server:
+            self.get_manager(server, api_key='abc123').fetch('23144831')
+        self.assertEqual(server.requests[0][1]['api_key'], 'abc123')
+
+    def test_retries(self):
+        with FakeEutilsServer(serve_fixture('pubmed_efetch.xml'),
+                              failures=[429, 503], gzip=False) as server:
+            paper = self.get_manager(server).fetch('23144831')
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(paper.authors.count(), 3)
+
+    def test_retries_exhausted(self):
+        with FakeEutilsServer(serve_fixture('pubmed_efetch.xml'),
+                              failures=[503, 503, 503]) as server:
+            manager = self.get_manager(server, max_retries=2)
+            with self.assertRaises(urllib2.HTTPError):
+                manager.fetch('23144831')
+        self.assertEqual(len(server.requests), 3)
+
+
+class TestRateLimiter(TestCase):
+    def test_rate(self):
+        limiter = RateLimiter(50)
+        start = time.time()
+        for i in xrange(6):
+            limiter.acquire()
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_shared_file(self):
+        path = tempfile.mktemp()
+        try:
+            limiters = [FileRateLimiter(path, 50), FileRateLimiter(path, 50)]
+            start = time.time()
+            for i in xrange(3):
+                for limiter in limiters:
+                    limiter.acquire()
+            self.assertTrue(time.time() - start >= 0.09)
+        finally:
+            os.remove(path)
+
+
+class TestHarvester(TestCase):
+    def get_manager(self, server):
+        manager = PubMedManager(transport=HTTPTransport(
+            rate_limiter=RateLimiter(1000), backoff=0, max_retries=0))
+        manager.eutils = server.url
+        return manager
+
+    def test_run(self):
+        for identifier in ['23144831', '22028469']:
+            Paper.objects.create(identifier=identifier, source='PubMed')
+
+        with FakeEutilsServer(serve_fixture('pubmed_efetch.xml')) as server:
+            harvester = Harvester(self.get_manager(server), downloaders=2,
+                                  parsers=2, batch_size=1, write_size=1)
+            stats = harvester.run(['23144831', '22028469'])
+
+        self.assertEqual(harvester.failed, [])
+        self.assertEqual(stats['download'].records, 2)
+        self.assertEqual(stats['parse'].records, 2)
+        self.assertEqual(stats['write'].records, 2)
+        self.assertEqual(stats['write'].batches, 2)
+        self.assertTrue(stats['download'].bytes > 0)
+        self.assertEqual(Paper.objects.filter(retrieved=True).count(), 2)
+        self.assertEqual(Paper.objects.get(identifier='23144831')
+                                      .authors.count(), 3)
+
+    def test_failed_downloads(self):
+        with FakeEutilsServer(serve_fixture('pubmed_efetch.xml'),
+                              failures=[500]) as server:
+            harvester = Harvester(self.get_manager(server), downloaders=1,
+                                  batch_size=1)
+            stats = harvester.run(['23144831', '22028469'])
+
+        self.assertEqual(harvester.failed, ['23144831'])
+        self.assertEqual(stats['download'].errors, 1)
+        self.assertEqual(stats['write'].records, 1)
+
+    def test_run_history(self):
+        manager = FixturePubMedManager()
+        user = User.objects.create(username='tester')
+        query = Query.objects.create(created_by=user, database='PubMed',
+                                     querystring='elegans', retmax=2)
+        manager.search(query)
+        manager.requests = []
+
+        stats = Harvester(manager, batch_size=2).run_history(query)
+
+        self.assertEqual(sorted(r['retstart'] for r in manager.requests),
+                         [0, 2])
+        self.assertEqual(stats['write'].records, 2)
+        self.assertEqual(sorted(query.results.filter(retrieved=True)
+                                .values_list('identifier', flat=True)),
+                         ['22028469', '23144831'])
+
+    def test_run_archived(self):
+        root = tempfile.mkdtemp()
+        try:
+            manager = FixturePubMedManager(
+                archive=ResponseArchive(root, ttl=1))
+            manager.fetch_many(['23144831', '22028469'])
+            manager.requests = []
+            Paper.objects.update(title='')
+
+            stats = Harvester(manager, batch_size=1).run(['23144831',
+                                                          '22028469'])
+        finally:
+            shutil.rmtree(root)
+
+        self.assertEqual(manager.requests, [])
+        self.assertEqual(stats['write'].records, 2)
+        self.assertFalse(Paper.objects.filter(title='').exists())
+
+
+class TestJobs(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='tester')
+        self.query = Query.objects.create(created_by=self.user,
+                                          database='PubMed',
+                                          querystring='elegans', retmax=2)
+        self.request = RequestFactory().post('/')
+        self.request.user = self.user
+        self.modeladmin = QueryAdmin(Query, AdminSite())
+        self.modeladmin.message_user = lambda request, message: None
+
+    def test_execute(self):
+        query_admin.execute(self.modeladmin, self.request,
+                            Query.objects.filter(pk=self.query.pk))
+        self.assertFalse(Query.objects.get(pk=self.query.pk).executed)
+
+        job = jobs.claim('test')
+        self.assertEqual(job.status, Job.RUNNING)
+        self.assertTrue(jobs.claim('test') is None)
+
+        jobs.run(job, FixturePubMedManager())
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual((job.fetched, job.total), (3, 3))
+
+        query = Query.objects.get(pk=self.query.pk)
+        self.assertTrue(query.executed)
+        self.assertEqual(query.results.count(), 3)
+        self.assertEqual(query.status(), '3/3 done')
+
+    def test_requeue_stale(self):
+        job = jobs.enqueue(Job.EXECUTE, 'PubMed', query=self.query)
+        self.assertEqual(jobs.claim('dead'), job)
+        Job.objects.filter(pk=job.pk).update(
+            updated_on=timezone.now() - datetime.timedelta(hours=2))
+
+        self.assertTrue(jobs.claim('other', lease=60 * 60 * 3) is None)
+        job = jobs.claim('other', lease=60 * 60)
+        self.assertEqual((job.status, job.worker), (Job.RUNNING, 'other'))
+
+        # The worker that lost the job no longer records on it.
+        jobs.report(Job(pk=job.pk, worker='dead'), 10)
+        self.assertEqual(Job.objects.get(pk=job.pk).fetched, 0)
+
+    def test_retrieve_results(self):
+        FixturePubMedManager().search(self.query)
+        Query.objects.filter(pk=self.query.pk).update(executed=True)
+        query_admin.retrieve_results(self.modeladmin, self.request,
+                                     Query.objects.all())
+
+        job = jobs.run(jobs.claim('test'), FixturePubMedManager())
+
+        # 21909271 is not in the fixture, so it is left unretrieved.
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual((job.fetched, job.total), (2, 3))
+        self.assertEqual(self.query.results.filter(retrieved=True).count(), 2)
+
+    def test_retrieve_results_from_history(self):
+        manager = FixturePubMedManager()
+        manager.search(self.query)
+        Query.objects.filter(pk=self.query.pk).update(executed=True)
+        jobs.enqueue(Job.RETRIEVE, 'PubMed', query=self.query)
+        manager.requests = []
+
+        jobs.run(jobs.claim('test'), manager)
+
+        # The session is read first; the paper that it does not return is
+        # then requested by identifier.
+        self.assertTrue('query_key' in manager.requests[0])
+        self.assertEqual(manager.requests[-1]['term'], '21909271')
+        self.assertEqual(self.query.results.filter(retrieved=True).count(), 2)
+
+    def test_retrieve_papers(self):
+        for identifier in ['23144831', '22028469']:
+            Paper.objects.create(identifier=identifier, source='PubMed')
+        query_admin.retrieve(self.modeladmin, self.request, Paper.objects.all())
+
+        job = jobs.claim('test')
+        self.assertEqual(job.identifiers, ['23144831', '22028469'])
+        jobs.run(job, FixturePubMedManager())
+        self.assertEqual(Paper.objects.filter(retrieved=True).count(), 2)
+
+
+class TestRefresh(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='tester')
+        self.query = Query.objects.create(created_by=user, database='PubMed',
+                                          querystring='elegans', retmax=2)
+        self.manager = FixturePubMedManager()
+        self.manager.search_ids = ['23144831', '22028469']
+        self.manager.search(self.query)
+        self.query.results.update(retrieved=True)
+        self.query.executed = True
+        self.query.executed_on = timezone.now()
+        self.query.save()
+
+    def get_searchresults(self, dates, **kwargs):
+        manager = self.manager
+        if 'datetype=mdat' in dates:
+            manager.search_ids = ['22028469']
+        elif 'datetype=edat' in dates:
+            manager.search_ids = ['21909271']
+        return FixturePubMedManager.get_searchresults(manager, **kwargs)
+
+    def test_refresh(self):
+        self.manager.get_searchresults = self.get_searchresults
+        self.manager.requests = []
+
+        self.manager.refresh(self.query)
+
+        since = (self.query.executed_on - datetime.timedelta(days=1)).date()
+        self.assertEqual([r['dates'].split('&')[1:3] for r in self.manager.requests],
+                         [['datetype=mdat', since.strftime('mindate=%Y/%m/%d')],
+                          ['datetype=edat', since.strftime('mindate=%Y/%m/%d')]])
+        self.assertEqual([r['usehistory'] for r in self.manager.requests],
+                         ['n', 'n'])
+
+        results = self.query.results.order_by('identifier')
+        self.assertEqual(list(results.values_list('identifier', 'retrieved')),
+                         [('21909271', False), ('22028469', False),
+                          ('23144831', True)])
+        query = Query.objects.get(pk=self.query.pk)
+        self.assertEqual(query.result_count, 2)
+        self.assertEqual(query.webenv, 'NCID_1_1234')
+
+    def test_refresh_job(self):
+        self.query.results.update(retrieved=False)
+        executed_on = self.query.executed_on
+        job = jobs.enqueue(Job.REFRESH, 'PubMed', query=self.query)
+        jobs.claim_job(job)
+        jobs.run(job, self.manager)
+
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.DONE)
+        self.assertEqual(self.query.results.filter(retrieved=True).count(), 2)
+        self.assertTrue(Query.objects.get(pk=self.query.pk).executed_on >
+                        executed_on)
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.archive = ResponseArchive(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put(self):
+        digest = self.archive.put('<a/>')
+        self.assertEqual(self.archive.put('<a/>'), digest)
+        self.assertEqual(self.archive.open(digest).read(), '<a/>')
+
+    def test_fetch_many(self):
+        manager = FixturePubMedManager(archive=self.archive)
+        manager.fetch_many(['23144831', '22028469'])
+
+        entries = ArchivedRecord.objects.order_by('identifier')
+        self.assertEqual(list(entries.values_list('identifier', 'kind')),
+                         [('22028469', 'efetch'), ('23144831', 'efetch')])
+        self.assertEqual(len(os.listdir(self.root)), 2)
+
+        # Without a TTL, the archive is not used as a cache.
+        manager.fetch_many(['23144831'])
+        self.assertEqual(len(manager.requests), 2)
+        self.assertEqual(ArchivedRecord.objects.count(), 2)
+
+        self.archive.ttl = 1
+        papers = manager.fetch_many(['23144831', '22028469'])
+        self.assertEqual(len(manager.requests), 2)
+        self.assertEqual(papers[0].authors.count(), 3)
+        self.assertEqual(papers[1].pubdate, datetime.date(2011, 10, 26))
+
+    def test_search(self):
+        user = User.objects.create(username='tester')
+        query = Query.objects.create(created_by=user, database='PubMed',
+                                     querystring='elegans', retmax=2)
+        FixturePubMedManager(archive=self.archive).search(query)
+        self.assertEqual(sorted(ArchivedRecord.objects.filter(kind='esearch')
+                                .values_list('identifier', flat=True)),
+                         ['%i:all:0' % query.pk, '%i:all:2' % query.pk])
+
+    def test_reprocess(self):
+        FixturePubMedManager(archive=self.archive).fetch_many(['23144831',
+                                                              '22028469'])
+        Paper.objects.update(title='', pubdate=None)
+
+        with override_settings(NCBI_ARCHIVE_ROOT=self.root):
+            call_command('reprocess', batch_size=1, stdout=StringIO())
+
+        self.assertFalse(Paper.objects.filter(title='').exists())
+        self.assertEqual(Paper.objects.get(identifier='23144831').pubdate,
+                         datetime.date(2012, 11, 12))
+
+
+class TestExport(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='tester')
+        self.query = Query.objects.create(created_by=user, database='PubMed',
+                                          querystring='elegans')
+        papers = FixturePubMedManager().fetch_many(['23144831', '22028469'])
+        self.query.results.add(*papers)
+
+    def test_csv(self):
+        data = ''.join(export(self.query.results.all(), 'csv'))
+        rows = list(csv.reader(StringIO(data)))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0][:3], ['identifier', 'source', 'title'])
+        self.assertEqual([row[0] for row in rows[1:]],
+                         ['23144831', '22028469'])
+        self.assertEqual(len(rows[1][7].split('; ')), 3)
+
+    def test_jsonl(self):
+        lines = ''.join(export(self.query.results.all(), 'jsonl',
+                               chunk_size=1)).splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([r['identifier'] for r in records],
+                         ['23144831', '22028469'])
+        self.assertEqual(records[0]['journal'], 'PLoS genetics')
+        self.assertEqual(len(records[0]['mesh_headings']), 4)
+        self.assertEqual(records[1]['grants'],
+                         ['R01 GM089972 (NIGMS NIH HHS)'])
+
+    def test_columnar(self):
+        groups = [json.loads(line) for line in
+                  ''.join(export(self.query.results.all(), 'columnar',
+                                 chunk_size=1)).splitlines()]
+        self.assertEqual([g['rows'] for g in groups], [1, 1])
+        self.assertEqual(groups[1]['columns']['identifier'], ['22028469'])
+
+    def test_queries_per_chunk(self):
+        def count_queries(queryset):
+            with CaptureQueriesContext(connection) as queries:
+                list(export(queryset, 'jsonl'))
+            return len(queries)
+
+        self.assertEqual(count_queries(self.query.results.all()),
+                         count_queries(self.query.results.filter(
+                             identifier='23144831')))
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('export', str(self.query.pk), format='jsonl',
+                     stdout=stdout)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 2)
+
+
+class TestLookupIndexes(TestCase):
+    def test_identifier_unique_per_source(self):
+        Paper.objects.create(identifier='1', source='PubMed')
+        Paper.objects.create(identifier='1', source='PMC')
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Paper.objects.create(identifier='1', source='PubMed')
+
+    def test_migrations_match_models(self):
+        executor = MigrationExecutor(connection)
+        changes = MigrationAutodetector(
+            executor.loader.project_state(),
+            ProjectState.from_apps(apps)).changes(graph=executor.loader.graph)
+        self.assertFalse(changes.get('query'))
+
+    def test_lookup_benchmark(self):
+        results = lookup_benchmark(rows=50, lookups=10, batch_size=4)
+        self.assertEqual([name for name, single, batch in results],
+                         ['Person', 'MeSHDescriptor', 'Paper'])
+        # Indexes are restored afterwards.
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                MeSHDescriptor.objects.create(descriptor=u'D0000000')
+
+
+class TestMergeDuplicates(TransactionTestCase):
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('query', target)])
+        return executor.loader.project_state(('query', target)).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph
+                     .leaf_nodes('query')[0][1])
+
+    def test_merge(self):
+        old = self.migrate('0001_initial')
+        Paper = old.get_model('query', 'Paper')
+        MeSHDescriptor = old.get_model('query', 'MeSHDescriptor')
+        MeSHHeading = old.get_model('query', 'MeSHHeading')
+        first, second = [MeSHDescriptor.objects.create(descriptor='Humans')
+                         for i in range(2)]
+        headings = [MeSHHeading.objects.create(descriptor=descriptor)
+                    for descriptor in (first, second)]
+        paper = Paper.objects.create(identifier='1', source='PubMed')
+        paper.mesh_headings.add(*headings)
+        other = Paper.objects.create(identifier='2', source='PubMed')
+        other.mesh_headings.add(headings[1])
+
+        self.migrate('0003_lookup_indexes')
+        self.assertEqual(MeSHDescriptor.objects.count(), 1)
+        self.assertEqual(MeSHHeading.objects.get().descriptor_id, first.pk)
+        self.assertEqual(MeSHHeading.objects.get().pk, headings[0].pk)
+        for identifier in ('1', '2'):
+            self.assertEqual(Paper.objects.get(identifier=identifier)
+                                  .mesh_headings.count(), 1)
+
+    def test_merge_links_between_duplicates(self):
+        old = self.migrate('0001_initial')
+        Paper = old.get_model('query', 'Paper')
+        MeSHDescriptor = old.get_model('query', 'MeSHDescriptor')
+        MeSHQualifier = old.get_model('query', 'MeSHQualifier')
+        MeSHHeading = old.get_model('query', 'MeSHHeading')
+        descriptor = MeSHDescriptor.objects.create(descriptor='Humans')
+        qualifier = MeSHQualifier.objects.create(subheading='genetics')
+        headings = [MeSHHeading.objects.create(descriptor=descriptor)
+                    for i in range(3)]
+        qualified = MeSHHeading.objects.create(descriptor=descriptor,
+                                               qualifier=qualifier)
+        paper = Paper.objects.create(identifier='1', source='PubMed')
+        # Linked to two duplicates, but not to the heading that is kept.
+        paper.mesh_headings.add(headings[1], headings[2], qualified)
+
+        self.migrate('0003_lookup_indexes')
+        self.assertEqual(sorted(MeSHHeading.objects.values_list('pk',
+                                                                flat=True)),
+                         [headings[0].pk, qualified.pk])
+        self.assertEqual(sorted(Paper.objects.get(identifier='1')
+                                .mesh_headings.values_list('pk', flat=True)),
+                         [headings[0].pk, qualified.pk])
+
+
+class TestAdminQueries(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com',
+                                                  'password')
+        self.client.login(username='admin', password='password')
+        self.papers = FixturePubMedManager().fetch_many(['23144831',
+                                                         '22028469'])
+
+    def create_query(self):
+        query = Query.objects.create(created_by=self.user, database='PubMed',
+                                     querystring='elegans')
+        query.results.add(*self.papers)
+        jobs.enqueue(Job.EXECUTE, 'PubMed', query=query)
+        return query
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_changelist(self):
+        self.create_query()
+        url = '/admin/query/query/'
+        one = self.count_queries(url)
+        for i in range(4):
+            self.create_query()
+        self.assertEqual(self.count_queries(url), one)
+        self.assertContains(self.client.get(url), '2 results', count=5)
+
+    def test_paper_change_view(self):
+        url = '/admin/query/paper/{0}/'
+        self.client.get(url.format(self.papers[0].pk))    # Warms caches.
+        self.assertEqual(self.count_queries(url.format(self.papers[0].pk)),
+                         self.count_queries(url.format(self.papers[1].pk)))
+
+    def test_query_filter(self):
+        queries = [self.create_query() for i in range(12)]
+        other = Query.objects.create(created_by=self.user, database='PubMed',
+                                     querystring='other')
+        other.results.add(self.papers[0])
+        request = RequestFactory().get('/')
+        model_admin = query_admin.admin.site._registry[Paper]
+
+        # Only the latest queries are listed, and the selected one.
+        spec = QueryListFilter(request, {'query': str(queries[0].pk)}, Paper,
+                               model_admin)
+        self.assertEqual(len(spec.lookup_choices), QueryListFilter.limit + 1)
+        self.assertEqual(spec.lookup_choices[0][0], str(queries[0].pk))
+
+        # Filters the queryset it is given rather than all papers.
+        spec = QueryListFilter(request, {'query': str(other.pk)}, Paper,
+                               model_admin)
+        self.assertEqual(list(spec.queryset(request, Paper.objects.filter(
+            identifier='22028469'))), [])
+        self.assertEqual(list(spec.queryset(request, Paper.objects.all())),
+                         [self.papers[0]])
+
+        response = self.client.get('/admin/query/paper/',
+                                   {'query': other.pk})
+        self.assertContains(response, 'query-filter-choices')
+        self.assertContains(response, '1 paper')
+
+        response = self.client.get('/admin/query/query/autocomplete/',
+                                   {'term': 'oth'})
+        self.assertEqual([result['id'] for result
+                          in json.loads(response.content)['results']],
+                         [other.pk])
+
+    def test_approximate_count(self):
+        for i in range(3):
+            Paper.objects.create(identifier='x{0}'.format(i), source='PubMed')
+        Paper.objects.filter(identifier='x0').delete()
+        paginator = ApproximatePaginator(Paper.objects.all(), 10)
+        paginator.threshold = 1
+        self.assertEqual(paginator.count, Paper.objects.latest('pk').pk)
+        paginator = ApproximatePaginator(
+            Paper.objects.filter(source='PubMed'), 10)
+        paginator.threshold = 1
+        self.assertEqual(paginator.count, 4)
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.manager = FixturePubMedManager()
+        self.manager.fetch_many(['23144831', '22028469'])
+
+    def identifiers(self, text):
+        return [paper.identifier for paper in search.search(text)]
+
+    def test_search(self):
+        self.assertEqual(self.identifiers('pigmentation'), ['23144831'])
+        self.assertEqual(self.identifiers('avermectin resistance'),
+                         ['22028469'])
+        # Matches headings, and ranks matching titles first.
+        self.assertEqual(self.identifiers('caenorhabditis'),
+                         ['23144831', '22028469'])
+        self.assertEqual(self.identifiers('"avermectin" -(*'),
+                         ['22028469'])
+        self.assertEqual(self.identifiers(' '), [])
+
+    def test_incremental(self):
+        self.manager.fetch_many(['23144831'])
+        self.assertEqual(self.identifiers('pigmentation'), ['23144831'])
+        Paper.objects.filter(identifier='23144831').delete()
+        self.assertEqual(self.identifiers('pigmentation'), [])
+
+    def test_rebuild(self):
+        search.remove(Paper.objects.values_list('pk', flat=True))
+        self.assertEqual(self.identifiers('elegans'), [])
+        stdout = StringIO()
+        call_command('rebuildsearchindex', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Indexed 2 papers')
+        self.assertEqual(len(self.identifiers('elegans')), 2)
+
+    def test_admin(self):
+        User.objects.create_superuser('admin', 'admin@example.com',
+                                      'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get('/admin/query/paper/',
+                                   {'q': 'avermectin'})
+        self.assertContains(response, '22028469')
+        self.assertNotContains(response, '23144831')
+
+        # Punctuation alone has no words to rank by.
+        response = self.client.get('/admin/query/paper/', {'q': '"-(*'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, '22028469')
+
+
+class TestMeSHTree(TestCase):
+    def setUp(self):
+        FixturePubMedManager().fetch_many(['23144831', '22028469'])
+        call_command('loadmesh', testdata('mesh_descriptors.xml'),
+                     batch_size=3, stdout=StringIO())
+
+    def identifiers(self, tree_number):
+        return sorted(mesh.papers_under(tree_number)
+                          .values_list('identifier', flat=True))
+
+    def test_load(self):
+        descriptor = MeSHDescriptor.objects.get(
+            descriptor='Genome-Wide Association Study')
+        self.assertEqual(descriptor.ui, 'D055106')
+        self.assertEqual(descriptor.tree_numbers,
+                         ['E05.337.325', 'N05.715.360.330.500'])
+        self.assertEqual(sorted(descriptor.tree_nodes.values_list(
+            'number', flat=True)), descriptor.tree_numbers)
+        # Humans does not head either paper, but is still imported.
+        self.assertEqual(MeSHDescriptor.objects.get(descriptor='Humans').ui,
+                         'D006801')
+
+    def test_reload(self):
+        count = MeSHTreeNumber.objects.count()
+        MeSHDescriptor.objects.filter(descriptor='Humans').update(ui='')
+        with open(testdata('mesh_descriptors.xml')) as stream:
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(mesh.load(stream), 4)
+        self.assertEqual(MeSHTreeNumber.objects.count(), count)
+        self.assertEqual(MeSHDescriptor.objects.get(descriptor='Humans').ui,
+                         'D006801')
+        # Only the changed descriptor is updated.
+        self.assertEqual(len([query for query in queries
+                              if 'UPDATE' in query['sql']]), 1)
+
+    def test_papers_under(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.identifiers('B01.050'),
+                             ['22028469', '23144831'])
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self.identifiers('E05'), ['23144831'])
+        self.assertEqual(self.identifiers('E05.337.325.'), ['23144831'])
+        self.assertEqual(self.identifiers('E05.33'), [])
+        self.assertEqual(self.identifiers('B01.050.150'), [])
+        self.assertEqual(list(mesh.descriptors_under('B01.050.150')
+                                  .values_list('descriptor', flat=True)),
+                         ['Humans'])
+
+
+class TestAuthors(TestCase):
+    def mention(self, fore_name, *features):
+        return {'pk': None, 'author_id': None, 'fore_name': fore_name,
+                'last_name': u'Smith', 'features': list(features)}
+
+    def test_blocking_key(self):
+        self.assertEqual(blocking_key(u'John', u'Smith'), u'smith j')
+        self.assertEqual(blocking_key(u'', u"O'Brien-M\xfcller", u'J'),
+                         u'obrienmuller j')
+
+    def test_fill_blocks(self):
+        for fore_name in (u'John', u'Jane', u'Ann'):
+            Person.objects.create(fore_name=fore_name, last_name=u'Smith')
+        Person.objects.update(block='')
+        with CaptureQueriesContext(connection) as queries:
+            authors.fill_blocks(batch_size=10)
+        # One UPDATE per block.
+        self.assertEqual(len([query for query in queries
+                              if 'UPDATE' in query['sql']]), 2)
+        self.assertEqual(sorted(Person.objects.values_list('block',
+                                                           flat=True)),
+                         [u'smith a', u'smith j', u'smith j'])
+
+    def test_compatible(self):
+        self.assertTrue(authors.compatible(u'J', u'John A'))
+        self.assertTrue(authors.compatible(u'John A', u'John Alan'))
+        self.assertFalse(authors.compatible(u'John', u'James'))
+        self.assertFalse(authors.compatible(u'John A', u'John B'))
+
+    def test_cluster_block(self):
+        doe = ('coauthor', u'doe j')
+        mentions = [
+            self.mention(u'John', doe),
+            self.mention(u'J', doe, ('coauthor', u'roe r')),
+            self.mention(u'James', ('coauthor', u'roe r')),
+            self.mention(u'John', ('journal', 1), ('mesh', 1), ('mesh', 2),
+                         ('mesh', 3)),
+            self.mention(u'John', ('journal', 1), ('mesh', 1), ('mesh', 2),
+                         ('mesh', 3)),
+            self.mention(u'John', ('journal', 1), ('mesh', 1)),
+        ]
+        # "J" joins John, since they share more; James, though sharing a
+        # co-author with "J", cannot then join them. A journal and one MeSH
+        # descriptor are not enough to merge.
+        self.assertEqual(authors.cluster_block(mentions),
+                         [[0, 1], [2], [3, 4], [5]])
+
+    def test_disambiguate(self):
+        manager = FixturePubMedManager()
+        manager.fetch_many(['23144831', '22028469'])
+        stdout = StringIO()
+        call_command('disambiguate', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(),
+                         'Clustered 4 blocks, creating 4 authors')
+        andersen = Authorship.objects.filter(person__last_name='Andersen')
+        self.assertEqual(len(set(andersen.values_list('author', flat=True))),
+                         1)
+        self.assertEqual(andersen.count(), 2)
+
+        # New authorships join existing authors.
+        paper = Paper.objects.create(identifier='1', source='PubMed')
+        for person in Person.objects.filter(last_name__in=['Andersen',
+                                                           'Kruglyak']):
+            Authorship.objects.create(paper=paper, person=person)
+        self.assertEqual(authors.disambiguate(), (2, 0))
+        self.assertEqual(Authorship.objects.filter(author=None).count(), 0)
+        self.assertEqual(Author.objects.get(last_name='Andersen')
+                               .authorships.count(), 3)
+
+        self.assertEqual(authors.disambiguate(rebuild=True), (4, 4))
+
+
+class TestJSONField(TestCase):
+    def test_lazy_decoding(self):
+        MeSHDescriptor.objects.create(descriptor=u'Animals',
+                                      tree_numbers=[u'B01.050'])
+        descriptor = MeSHDescriptor.objects.get()
+        self.assertEqual(descriptor.__dict__['tree_numbers'], u'["B01.050"]')
+        self.assertEqual(descriptor.tree_numbers, [u'B01.050'])
+        descriptor.tree_numbers.append(u'B01.051')
+        descriptor.save()
+        self.assertEqual(MeSHDescriptor.objects.get().tree_numbers,
+                         [u'B01.050', u'B01.051'])
+
+    def test_save_undecoded(self):
+        MeSHDescriptor.objects.create(descriptor=u'Animals',
+                                      tree_numbers=[u'B01.050'])
+        descriptor = MeSHDescriptor.objects.get()
+        descriptor.ui = u'D000818'
+        descriptor.save()
+        self.assertEqual(MeSHDescriptor.objects.get().tree_numbers,
+                         [u'B01.050'])
+        self.assertEqual(MeSHDescriptor().tree_numbers, [])
+
+    def test_migration(self):
+        migration = import_module('query.migrations.0007_json_fields')
+        self.assertEqual(migration.literal_to_json(u"[u'B01.050', u'B02']"),
+                         '["B01.050", "B02"]')
+        self.assertEqual(migration.literal_to_json(u'["B01"]'), u'["B01"]')
+        self.assertEqual(migration.literal_to_json(None), '[]')
+        self.assertEqual(migration.json_to_literal(u'["B01"]'), u"[u'B01']")
+
+
+class TestGraphs(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='graphs')
+        self.query = Query.objects.create(created_by=user, database='PubMed',
+                                          querystring='graphs')
+        date = datetime.date(2012, 1, 1)
+        papers = [Paper.objects.create(identifier=str(i), source='PubMed',
+                                       pubdate=date) for i in range(3)]
+        self.query.results.add(*papers)
+        # Not a result of the query, so left out of its graphs.
+        other = Paper.objects.create(identifier='3', source='PubMed')
+
+        people = [Person.objects.create(fore_name=name, last_name=u'Smith')
+                  for name in [u'Ann', u'Bob', u'Cy']]
+        for paper, authors in [(papers[0], people), (papers[1], people[:2]),
+                               (papers[2], people[2:]), (other, people[1:])]:
+            for person in authors:
+                Authorship.objects.create(paper=paper, person=person)
+
+        descriptors = [MeSHDescriptor.objects.create(descriptor=name)
+                       for name in [u'Animals', u'Humans']]
+        qualifier = MeSHQualifier.objects.create(subheading=u'genetics')
+        headings = [MeSHHeading.objects.create(descriptor=descriptors[0]),
+                    MeSHHeading.objects.create(descriptor=descriptors[1],
+                                               qualifier=qualifier)]
+        for paper in papers[:2]:
+            paper.mesh_headings.add(*headings)
+
+        country = Country.objects.create(name=u'USA')
+        agency = Agency.objects.create(name=u'NIH', country=country)
+        papers[0].funding.add(Grant.objects.create(
+            grant_id=u'R01', acronym=u'GM', awarded_by=agency))
+        for person, name in [(people[0], u'MIT'), (people[1], u'<Yale>')]:
+            Affiliation.objects.create(
+                person=person, date=date,
+                institution=Institution.objects.create(name=name))
+        self.people = people
+
+    def node(self, person):
+        return u'person-{0}'.format(person.pk)
+
+    def test_cooccurrence(self):
+        pairs = [(1, 'a'), (1, 'b'), (1, 'c'), (2, 'a'), (2, 'b'), (2, 'b'),
+                 (3, 'a'), (3, 'b'), (3, 'c'), (3, 'd')]
+        self.assertEqual(graphs.cooccurrence(pairs),
+                         [('a', 'b', 3), ('a', 'c', 2), ('a', 'd', 1),
+                          ('b', 'c', 2), ('b', 'd', 1), ('c', 'd', 1)])
+        self.assertEqual(graphs.cooccurrence(pairs, max_items=3),
+                         [('a', 'b', 2), ('a', 'c', 1), ('b', 'c', 1)])
+        self.assertEqual(graphs.bipartite([(1, 'x'), (2, 'x')],
+                                          [(1, 'a'), (2, 'a'), (2, 'b')]),
+                         [('x', 'a', 2), ('x', 'b', 1)])
+        # Each side is limited on its own.
+        self.assertEqual(graphs.bipartite([(1, 'x'), (1, 'y')],
+                                          [(1, 'a'), (1, 'b'), (1, 'c')],
+                                          max_items=3),
+                         [('x', 'a', 1), ('x', 'b', 1), ('x', 'c', 1),
+                          ('y', 'a', 1), ('y', 'b', 1), ('y', 'c', 1)])
+        self.assertEqual(graphs.bipartite([(1, 'x')],
+                                          [(1, 'a'), (1, 'b'), (1, 'c')],
+                                          max_items=2), [])
+
+    def test_coauthorship(self):
+        ann, bob, cy = [self.node(person) for person in self.people]
+        with self.assertNumQueries(5):
+            graph = graphs.coauthorship(self.query, chunk_size=2)
+        self.assertEqual(graph.edges, [(ann, bob, 2), (ann, cy, 1),
+                                       (bob, cy, 1)])
+        self.assertEqual(graph.nodes[cy], u'Cy Smith')
+
+    def test_mesh_cooccurrence(self):
+        graph = graphs.mesh_cooccurrence(self.query)
+        self.assertEqual(graph.edges, [
+            (u'descriptor-{0}'.format(pk), u'descriptor-{0}'.format(pk + 1), 2)
+            for pk in MeSHDescriptor.objects.filter(descriptor=u'Animals')
+                                            .values_list('pk', flat=True)])
+        self.assertEqual(sorted(graph.nodes.values()), [u'Animals', u'Humans'])
+
+    def test_funder_institution(self):
+        graph = graphs.funder_institution(self.query)
+        self.assertEqual(
+            [(graph.nodes[a], graph.nodes[b], weight)
+             for a, b, weight in graph.edges],
+            [(u'NIH', u'MIT', 1), (u'NIH', u'<Yale>', 1)])
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('graph', str(self.query.pk), format='graphml',
+                     kind='funder-institution', stdout=stdout)
+        root = ET.fromstring(stdout.getvalue())
+        namespace = '{http://graphml.graphdrawing.org/xmlns}'
+        labels = [data.text for data in root.iter(namespace + 'data')
+                  if data.get('key') == 'label']
+        self.assertEqual(sorted(labels), [u'<Yale>', u'MIT', u'NIH'])
+        self.assertEqual(len(list(root.iter(namespace + 'edge'))), 2)
+
+        stdout = StringIO()
+        call_command('graph', str(self.query.pk), stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[0].split('\t'), ['source', 'source_label',
+                                                'target', 'target_label',
+                                                'weight'])
+        self.assertEqual(len(lines), 4)
+
+
+class TestIngestBenchmark(TestCase):
+    def test_corpus(self):
+        manager = PubMedManager(archive=None)
+        corpus = FixtureCorpus(manager, 'pubmed_efetch.xml',
+                               'pubmed_esearch.xml', ['7', '8', '9'])
+        stream = StringIO(corpus.fetch(['1', '2', '3']))
+        records = manager.parse_records(stream)
+        self.assertEqual([r['identifier'] for r in records], ['1', '2', '3'])
+        self.assertEqual(records[2]['title'], records[0]['title'])
+
+        page = ET.fromstring(corpus.handle('esearch', {
+            'retstart': '1', 'retmax': '1', 'usehistory': 'n'}))
+        self.assertEqual(page.find('Count').text, '3')
+        self.assertEqual([e.text for e in page.findall('IdList/Id')], ['8'])
+        self.assertTrue(page.find('WebEnv') is None)
+
+    def test_ingest_benchmark(self):
+        results = ingest_benchmark('PubMed', scales=[1, 3])
+        self.assertEqual([(r['path'], r['scale'], r['records'])
+                          for r in results[:2]],
+                         [('process_resource', 1, 1),
+                          ('process_resource', 3, 3)])
+        self.assertEqual([r['records'] for r in results], [1, 3] * 5)
+        self.assertTrue(all(r['queries_per_record'] > 0 for r in results))
+        self.assertEqual(Paper.objects.filter(source='PubMed').count(), 20)
+
+    def test_regressions(self):
+        path = tempfile.mktemp()
+        result = {'path': 'fetch_many', 'source': 'PubMed', 'scale': 100,
+                  'rate': 500., 'queries_per_record': 0.5, 'memory': 2048}
+        try:
+            save_results(path, [dict(result, rate=100.)])
+            save_results(path, [result])
+            baseline = load_results(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(regressions(baseline, [dict(result, rate=450.)]), [])
+        slower = dict(result, rate=300., queries_per_record=1.)
+        self.assertEqual([(metric, before, after) for r, metric, before, after
+                          in regressions(baseline, [slower])],
+                         [('rate', 500., 300.),
+                          ('queries_per_record', 0.5, 1.)])
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.metrics = get_metrics()
+        self.metrics.reset()
+
+    def test_stages(self):
+        received = []
+
+        def receiver(sender, stage, seconds, counts, **kwargs):
+            received.append(stage)
+        metrics.stage_finished.connect(receiver)
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                FixturePubMedManager().fetch_many(['23144831', '22028469'])
+        finally:
+            metrics.stage_finished.disconnect(receiver)
+
+        stages = self.metrics.snapshot()
+        self.assertEqual(stages['extract']['calls'], 2)
+        self.assertEqual(stages['iter_records']['records'], 2)
+        self.assertTrue(stages['iter_records']['elements'] > 2)
+        self.assertEqual(stages['process_records']['records'], 2)
+        self.assertEqual(stages['process_records']['queries'], len(queries))
+        self.assertTrue('cache_misses' in stages['process_records'])
+        self.assertEqual(received[-1], 'process_records')
+
+    def test_stage_restores_cursor(self):
+        with self.assertRaises(RuntimeError):
+            with metrics.stage('failing', queries=True):
+                Paper.objects.count()
+                raise RuntimeError
+        self.assertFalse('cursor' in connections['default'].__dict__)
+        stages = self.metrics.snapshot()
+        self.assertEqual((stages['failing']['queries'],
+                          stages['failing']['errors']), (1, 1))
+
+    def test_download(self):
+        with FakeEutilsServer(serve_fixture('pubmed_efetch.xml')) as server:
+            manager = PubMedManager(transport=HTTPTransport(
+                rate_limiter=RateLimiter(1000)))
+            manager.eutils = server.url
+            manager.fetch_many(['23144831'])
+
+        stages = self.metrics.snapshot()
+        self.assertEqual(stages['request']['calls'], 1)
+        self.assertEqual(stages['download']['bytes'],
+                         os.path.getsize(testdata('pubmed_efetch.xml')))
+
+    def test_render(self):
+        sink = Metrics()
+        sink.record('parse', 0.5, {'elements': 3})
+        sink.record('parse', 0.25, {})
+        self.assertEqual(sink.render().splitlines(), [
+            '# TYPE ncbi_stage_calls_total counter',
+            'ncbi_stage_calls_total{stage="parse"} 2',
+            '# TYPE ncbi_stage_elements_total counter',
+            'ncbi_stage_elements_total{stage="parse"} 3',
+            '# TYPE ncbi_stage_seconds_total counter',
+            'ncbi_stage_seconds_total{stage="parse"} 0.75',
+        ])
+
+        self.metrics.record('parse', 0.5, {})
+        request = RequestFactory().get('/metrics')
+        request.user = User.objects.create(username='staff', is_staff=True)
+        response = views.metrics(request)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertTrue('ncbi_stage_calls_total{stage="parse"} 1'
+                        in response.content)
+
+    def test_render_access(self):
+        request = RequestFactory().get('/metrics')
+        request.user = AnonymousUser()
+        self.assertEqual(views.metrics(request).status_code, 302)
+        with override_settings(NCBI_METRICS_PUBLIC=True):
+            self.assertEqual(views.metrics(request).status_code, 200)
+
+    def test_file_metrics(self):
+        path = tempfile.mktemp()
+        try:
+            worker = FileMetrics(path, interval=0)
+            web = FileMetrics(path, interval=60)
+            worker.record('request', 1., {})
+            web.record('request', 2., {})
+            self.assertEqual(worker.snapshot()['request'],
+                             {'calls': 1, 'seconds': 1.})
+            self.assertEqual(web.snapshot()['request'],
+                             {'calls': 2, 'seconds': 3.})
+        finally:
+            os.remove(path)
+
+    def test_file_metrics_without_file(self):
+        with override_settings(NCBI_METRICS_FILE=None):
+            sink = FileMetrics(interval=0)
+        sink.record('request', 1., {})
+        self.assertEqual(sink.snapshot()['request'],
+                         {'calls': 1, 'seconds': 1.})
+        sink.reset()
+        self.assertEqual(sink.snapshot(), {})
+
+    def test_profile(self):
+        user = User.objects.create(username='tester')
+        query = Query.objects.create(created_by=user, database='PubMed',
+                                     querystring='elegans')
+        job = jobs.enqueue(Job.EXECUTE, 'PubMed', query=query)
+        jobs.claim_job(job, 'test')
+
+        directory = tempfile.mkdtemp()
+        try:
+            jobs.run(job, FixturePubMedManager(), profile_dir=directory)
+            stats = pstats.Stats(os.path.join(directory,
+                                              'job-%i.prof' % job.pk))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(job.status, Job.DONE)
+        self.assertTrue('process_searchresults' in
+                        [name for path, line, name in stats.stats])
+
+
+class TestClaims(TestCase):
+    def setUp(self):
+        for identifier in ['23144831', '22028469', '21909271', '1']:
+            Paper.objects.create(identifier=identifier, source='PubMed')
+        Paper.objects.filter(identifier='1').update(retrieved=True)
+
+    def test_claim(self):
+        self.assertEqual(claim_papers('PubMed', 'a', 2),
+                         ['23144831', '22028469'])
+        self.assertEqual(claim_papers('PubMed', 'b', 2), ['21909271'])
+        self.assertEqual(claim_papers('PubMed', 'c', 2), [])
+
+        self.assertEqual(release_papers('a'), 2)
+        self.assertEqual(claim_papers('PubMed', 'c', 5),
+                         ['23144831', '22028469'])
+
+    def test_claim_among(self):
+        papers = Paper.objects.filter(identifier__in=['22028469', '1'])
+        self.assertEqual(claim_papers('PubMed', 'a', 5, papers), ['22028469'])
+
+    def test_release_stale(self):
+        claim_papers('PubMed', 'a', 1)
+        self.assertEqual(release_stale('PubMed', 60), 0)
+        Paper.objects.filter(claimed_by='a').update(
+            claimed_on=timezone.now() - datetime.timedelta(minutes=2))
+        self.assertEqual(release_stale('PubMed', 60), 1)
+        self.assertEqual(Paper.objects.exclude(claimed_by='').count(), 0)
+
+    def test_harvest_claimed(self):
+        # Another worker holds one of the papers.
+        claim_papers('PubMed', 'other', 1)
+        with FakeEutilsServer(serve_fixture('pubmed_efetch.xml')) as server:
+            manager = PubMedManager(transport=HTTPTransport(
+                rate_limiter=RateLimiter(1000), backoff=0, max_retries=0))
+            manager.eutils = server.url
+            retrieved, failed = harvest_claimed(manager, 'a', claim_size=1,
+                                                batch_size=1)
+
+        # 21909271 is not in the fixture, so it is not retrieved.
+        self.assertEqual((retrieved, failed), (1, ['21909271']))
+        self.assertEqual([params['id'] for utility, params in server.requests],
+                         ['22028469', '21909271'])
+        self.assertEqual(Paper.objects.get(identifier='22028469').claimed_by,
+                         '')
+        self.assertEqual(sorted(Paper.objects.exclude(claimed_by='')
+                                     .values_list('identifier', 'claimed_by')),
+                         [('23144831', 'other')])
+
+
+class TestExtract(TestCase):
+    def parse_fixture(self, manager, filename):
+        with open(testdata(filename)) as f:
+            root = ET.fromstring(f.read())
+        return [(record, manager.parse_resource(
+                    record, record.find(manager.record_id_path).text))
+                for record in root.findall(manager.record_path)]
+
+    def test_pubmed(self):
+        record = self.parse_fixture(PubMedManager(archive=None),
+                                    'pubmed_efetch.xml')[0][1]
+        self.assertEqual(record['identifier'], '23144831')
+        self.assertEqual(record['pubdate'], datetime.date(2012, 11, 12))
+        self.assertEqual(record['abstract'],
+                         'Pigmentation is a model trait. We mapped three loci.')
+        self.assertEqual(record['journal'], ('1553-7404', 'PLoS genetics'))
+        self.assertEqual([author['last_name'] for author in record['authors']],
+                         ['Andersen', 'Bloom', 'Kruglyak'])
+        self.assertEqual(record['authors'][2]['affiliations'], [])
+        self.assertEqual(record['grants'][2]['acronym'], '')
+        self.assertEqual(record['headings'][:3], [
+            ('Animals', None),
+            ('Caenorhabditis elegans', 'genetics'),
+            ('Caenorhabditis elegans', 'physiology')])
+
+    def test_pmc(self):
+        record = self.parse_fixture(PMCManager(archive=None),
+                                    'pmc_efetch.xml')[0][1]
+        self.assertEqual(record['title'], 'Genome-wide association study of '
+                                          'pigmentation in Caenorhabditis')
+        self.assertEqual(record['pubdate'], datetime.date(2012, 11, 8))
+        self.assertEqual(record['journal'], ('1553-7390', 'PLoS Genetics'))
+        self.assertEqual(len(record['authors']), 2)
+        self.assertEqual(record['authors'][1]['initials'], '')
+        self.assertEqual(len(record['authors'][1]['affiliations']), 2)
+        self.assertEqual((record['grants'], record['headings']), ([], []))
+
+    def test_matches_legacy(self):
+        # Abstracts no longer include escaped markup, and PMC titles are no
+        # longer empty; everything else is as before.
+        for manager, filename in [(PubMedManager(archive=None),
+                                   'pubmed_efetch.xml'),
+                                  (PMCManager(archive=None),
+                                   'pmc_efetch.xml')]:
+            legacy = LEGACY_PARSERS[manager.db]()
+            for record, parsed in self.parse_fixture(manager, filename):
+                wrapper = ET.Element('root')
+                wrapper.append(record)
+                expected = legacy.parse_resource(wrapper,
+                                                 parsed['identifier'])
+                for field in ('abstract', 'title'):
+                    del expected[field], parsed[field]
+                self.assertEqual(parsed, expected)
+
+    def test_missing_elements(self):
+        manager = PubMedManager(archive=None)
+        record = manager.parse_resource(ET.fromstring(
+            '<PubmedArticle><MedlineCitation><PMID>1</PMID>'
+            '</MedlineCitation></PubmedArticle>'), '1')
+        self.assertEqual(record, {
+            'identifier': '1', 'pubdate': None, 'title': '', 'abstract': '',
+            'journal': None, 'authors': [], 'grants': [], 'headings': []})
+        self.assertRaises(ValueError, manager.parse_resource,
+                          ET.fromstring('<PubmedArticleSet/>'), '1')
+
+    def test_irregular_values(self):
+        manager = PubMedManager(archive=None)
+
+        def parse(date, headings=''):
+            return manager.parse_resource(ET.fromstring(
+                '<PubmedArticle><MedlineCitation><PMID>1</PMID>'
+                '<DateCreated>{0}</DateCreated>'
+                '<MeshHeadingList>{1}</MeshHeadingList>'
+                '</MedlineCitation></PubmedArticle>'.format(date, headings)),
+                '1')
+
+        self.assertEqual(parse('<Year>2012</Year><Month>Nov</Month>'
+                               '<Day>12</Day>')['pubdate'],
+                         datetime.date(2012, 11, 12))
+        self.assertEqual(parse('<Year>2012</Year><Month>September</Month>'
+                               '<Day/>')['pubdate'],
+                         datetime.date(2012, 9, 1))
+        self.assertEqual(parse('<Year>2012</Year><Month>Winter</Month>'
+                               '<Day>31</Day>')['pubdate'],
+                         datetime.date(2012, 1, 31))
+        self.assertEqual(parse('<Year>2012</Year><Month>2</Month>'
+                               '<Day>30</Day>')['pubdate'],
+                         datetime.date(2012, 2, 1))
+        self.assertEqual(parse('<Year/>')['pubdate'], None)
+        record = parse('<Year>2012</Year>',
+                       '<MeshHeading><DescriptorName/></MeshHeading>'
+                       '<MeshHeading><DescriptorName>Animals</DescriptorName>'
+                       '</MeshHeading>')
+        self.assertEqual(record['headings'], [('Animals', None)])
+
+    def test_backends(self):
+        backends = [ElementTreeBackend()]
+        if lxml_etree is not None:
+            backends.append(LxmlBackend())
+        for backend in backends:
+            manager = PubMedManager(archive=None, backend=backend)
+            with open(testdata('pubmed_efetch.xml')) as f:
+                records = manager.parse_records(f)
+            self.assertEqual([r['identifier'] for r in records],
+                             ['23144831', '22028469'])
+            self.assertEqual(len(records[0]['authors']), 3)
+
+    def test_extract_benchmark(self):
+        results = extract_benchmark('PMC', records=4)
+        self.assertEqual([label for label, parse, extract in results][:2],
+                         ['legacy handle_* methods', 'compiled schema, etree'])
+        self.assertTrue(all(parse > 0 and extract > 0
+                            for label, parse, extract in results))
+
+
+class TestCache(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.manager = FixturePubMedManager()
+        user = User.objects.create(username='test')
+        self.query = Query.objects.create(created_by=user, database='PubMed',
+                                          querystring='test')
+
+    def papers(self, pks):
+        return cache.papers(pks, api.RESOURCES['papers'].load)
+
+    def test_papers(self):
+        papers = self.manager.fetch_many(['23144831', '22028469'])
+        pks = [paper.pk for paper in papers]
+        records = self.papers(pks + [0])
+        self.assertEqual(sorted(records), sorted(pks))
+        self.assertEqual(records[pks[1]]['identifier'], '22028469')
+        self.assertEqual(len(records[pks[0]]['authors']), 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.papers(pks), records)
+
+    def test_process_records_invalidates(self):
+        paper = self.manager.fetch_many(['23144831'])[0]
+        title = self.papers([paper.pk])[paper.pk]['title']
+        Paper.objects.filter(pk=paper.pk).update(title='Changed')
+        self.assertEqual(self.papers([paper.pk])[paper.pk]['title'], title)
+
+        with open(testdata('pubmed_efetch.xml')) as f:
+            record = self.manager.parse_records(f, ['23144831'])[0]
+        record['title'] = 'Retitled'
+        self.manager.process_records([record])
+        self.assertEqual(self.papers([paper.pk])[paper.pk]['title'],
+                         'Retitled')
+
+        Paper.objects.get(pk=paper.pk).delete()
+        self.assertEqual(self.papers([paper.pk]), {})
+
+    def test_retrieved_invalidates(self):
+        paper = Paper.objects.create(identifier='23144831', source='PubMed')
+        self.assertFalse(self.papers([paper.pk])[paper.pk]['retrieved'])
+        Harvester(self.manager).run(['23144831'])
+        self.assertTrue(self.papers([paper.pk])[paper.pk]['retrieved'])
+
+    def test_result_ids(self):
+        self.manager.search_ids = ['23144831', '22028469']
+        self.manager.search(self.query)
+        ids = cache.result_ids(self.query.pk)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(cache.result_ids(self.query.pk, after=ids[0]),
+                         ids[1:])
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.result_ids(self.query.pk), ids)
+
+        # New results move the query on to a new version.
+        self.manager.search_ids = ['21909271']
+        self.manager.search(self.query)
+        self.assertEqual(len(cache.result_ids(self.query.pk)), 3)
+
+    def test_api(self):
+        self.manager.search(self.query)
+        factory = RequestFactory()
+        staff = User.objects.create(username='staff', is_staff=True)
+
+        def get(view, *args, **params):
+            request = factory.get('/api/', params)
+            request.user = staff
+            return json.loads(view(request, *args).content)
+
+        first = get(api.query_papers, self.query.pk, limit=2)
+        self.assertEqual(len(first['results']), 2)
+        second = get(api.query_papers, self.query.pk, after=first['next'])
+        self.assertEqual(second['next'], None)
+        self.assertEqual(sorted([r['identifier'] for r
+                                 in first['results'] + second['results']]),
+                         ['21909271', '22028469', '23144831'])
+        # Result IDs and papers are now cached; only the query is checked.
+        with self.assertNumQueries(1):
+            self.assertEqual(get(api.query_papers, self.query.pk, limit=2),
+                             first)
+
+        pk = Paper.objects.get(identifier='23144831').pk
+        with self.assertNumQueries(0):
+            paper = get(api.detail, 'papers', pk)
+        self.assertEqual((paper['id'], paper['journal']), (pk, None))
+        self.assertRaises(Http404, get, api.detail, 'papers', 0)
+
+
+class TestAPI(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.factory = RequestFactory()
+        manager = FixturePubMedManager()
+        self.papers = manager.fetch_many(['23144831', '22028469'])
+        self.user = User.objects.create(username='test', is_staff=True)
+        self.query = Query.objects.create(created_by=self.user,
+                                          database='PubMed',
+                                          querystring='test')
+        manager.search(self.query)
+
+    def get(self, view, *args, **params):
+        headers = {}
+        if 'etag' in params:
+            headers['HTTP_IF_NONE_MATCH'] = params.pop('etag')
+        request = self.factory.get('/api/', params, **headers)
+        request.user = self.user
+        response = view(request, *args)
+        if response.status_code == 304:
+            return response, None
+        # Fields are serialized in the order of the resource.
+        return response, json.loads(response.content,
+                                    object_pairs_hook=OrderedDict)
+
+    def test_keyset_pagination(self):
+        identifiers = []
+        after = 0
+        while after is not None:
+            response, page = self.get(api.listing, 'papers', limit=2,
+                                      after=after)
+            identifiers.extend([r['identifier'] for r in page['results']])
+            after = page['next']
+        self.assertEqual(sorted(identifiers),
+                         ['21909271', '22028469', '23144831'])
+
+        Paper.objects.filter(identifier='23144831').update(retrieved=True)
+        response, page = self.get(api.listing, 'papers', retrieved='true')
+        self.assertEqual([r['identifier'] for r in page['results']],
+                         ['23144831'])
+        self.assertEqual(self.get(api.listing, 'papers', limit='x')[0]
+                             .status_code, 400)
+
+    def test_fields(self):
+        response, paper = self.get(api.detail, 'papers', self.papers[0].pk,
+                                   fields='authors,title')
+        self.assertEqual(paper.keys(), ['id', 'title', 'authors'])
+        self.assertEqual(len(paper['authors']), 3)
+
+        response, paper = self.get(api.detail, 'papers', self.papers[0].pk)
+        self.assertEqual(paper['journal']['issn'], '1553-7404')
+        self.assertEqual(len(paper['mesh_headings']), 4)
+        self.assertEqual(paper['grants'][0]['country'], 'United States')
+
+        response, error = self.get(api.listing, 'grants', fields='nope')
+        self.assertEqual(response.status_code, 400)
+        self.assertRaises(Http404, self.get, api.listing, 'nope')
+        self.assertRaises(Http404, self.get, api.detail, 'queries', 0)
+
+    def test_query_count(self):
+        # One query for the page and one per prefetched relation, however
+        # many papers there are on it.
+        for limit in (1, 2):
+            with self.assertNumQueries(4):
+                self.get(api.listing, 'papers', limit=limit,
+                         fields='title,authors,mesh_headings,grants')
+        # With all fields, cached papers are not loaded again.
+        self.get(api.listing, 'papers', limit=2)
+        with self.assertNumQueries(1):
+            self.get(api.listing, 'papers', limit=2)
+        with self.assertNumQueries(1):
+            self.get(api.listing, 'headings', limit=10)
+
+    def test_query_papers(self):
+        response, page = self.get(api.query_papers, self.query.pk,
+                                  fields='identifier')
+        self.assertEqual(sorted([r['identifier'] for r in page['results']]),
+                         ['21909271', '22028469', '23144831'])
+        self.assertEqual(page['next'], None)
+
+    def test_staff_only(self):
+        for user in (AnonymousUser(), User.objects.create(username='other')):
+            request = self.factory.get('/api/queries')
+            request.user = user
+            self.assertEqual(api.listing(request, 'queries').status_code, 302)
+
+        response, page = self.get(api.detail, 'queries', self.query.pk)
+        self.assertEqual(page['created_by'], self.user.pk)
+
+    def test_etag(self):
+        response, page = self.get(api.listing, 'authors')
+        etag = response['ETag']
+        response, page = self.get(api.listing, 'authors', etag=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Person.objects.create(fore_name='New', last_name='Person')
+        response, page = self.get(api.listing, 'authors', etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class TestAffiliations(TestCase):
+    def test_refetch(self):
+        manager = FixturePubMedManager()
+        manager.fetch_many(['23144831', '22028469'])
+        manager.fetch_many(['23144831', '22028469'])
+        self.assertEqual(Affiliation.objects.count(), 3)
+        paper = Paper.objects.get(identifier='23144831')
+        self.assertEqual(sorted(paper.affiliations.values_list(
+                             'person__last_name', flat=True)),
+                         ['Andersen', 'Bloom'])
+        self.assertEqual(paper.affiliations.first().date, paper.pubdate)
+
+    def test_compact(self):
+        person = Person.objects.create(fore_name=u'John', last_name=u'Smith')
+        mit = Institution.objects.create(name=u'MIT')
+        yale = Institution.objects.create(name=u'Yale')
+        for institution, date in [
+                (mit, datetime.date(2010, 1, 1)),
+                (mit, datetime.date(2010, 1, 1)),
+                (mit, datetime.date(2010, 6, 1)),
+                (mit, datetime.date(2014, 1, 1)),
+                (yale, datetime.date(2012, 1, 1)),
+                (yale, datetime.date(2012, 1, 1))]:
+            Affiliation.objects.create(person=person, institution=institution,
+                                       date=date)
+
+        stdout = StringIO()
+        call_command('compactaffiliations', max_gap=365, stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(),
+                         'Compacted 6 affiliations into 3')
+        self.assertEqual(sorted(Affiliation.objects.values_list(
+                             'institution__name', 'date', 'end_date')),
+                         [(u'MIT', datetime.date(2010, 1, 1),
+                           datetime.date(2010, 6, 1)),
+                          (u'MIT', datetime.date(2014, 1, 1), None),
+                          (u'Yale', datetime.date(2012, 1, 1), None)])
+
+        paper = Paper.objects.create(identifier='1', source='PubMed',
+                                     pubdate=datetime.date(2010, 3, 1))
+        found = affiliated_institutions([(paper.pk, person.pk)],
+                                        {paper.pk: paper.pubdate})
+        self.assertEqual(found[(paper.pk, person.pk)], set([mit.pk]))
+
+    def test_compact_alternating(self):
+        person = Person.objects.create(fore_name=u'John', last_name=u'Smith')
+        mit = Institution.objects.create(name=u'MIT')
+        yale = Institution.objects.create(name=u'Yale')
+        for institution, date in [
+                (mit, datetime.date(2010, 1, 1)),
+                (yale, datetime.date(2011, 1, 1)),
+                (mit, datetime.date(2012, 1, 1)),
+                (mit, datetime.date(2012, 1, 1)),
+                (mit, datetime.date(2012, 6, 1))]:
+            Affiliation.objects.create(person=person, institution=institution,
+                                       date=date)
+
+        # By default, only repeats of a date are merged.
+        call_command('compactaffiliations', stdout=StringIO())
+        self.assertEqual(Affiliation.objects.filter(institution=mit).count(),
+                         3)
+
+        # A range never spans a date at another institution.
+        call_command('compactaffiliations', max_gap=3650, stdout=StringIO())
+        self.assertEqual(sorted(Affiliation.objects.values_list(
+                             'institution__name', 'date', 'end_date')),
+                         [(u'MIT', datetime.date(2010, 1, 1), None),
+                          (u'MIT', datetime.date(2012, 1, 1),
+                           datetime.date(2012, 6, 1)),
+                          (u'Yale', datetime.date(2011, 1, 1), None)])
+
+        paper = Paper.objects.create(identifier='1', source='PubMed',
+                                     pubdate=datetime.date(2011, 1, 1))
+        found = affiliated_institutions([(paper.pk, person.pk)],
+                                        {paper.pk: paper.pubdate})
+        self.assertEqual(found[(paper.pk, person.pk)], set([yale.pk]))
@@ -0,0 +1,308 @@
+"""
+HTTP transport for the E-utilities connector.
+
+:class:`HTTPTransport` keeps one persistent connection per host and thread,
+asks for gzip-compressed responses, retries with exponential backoff when
+NCBI answers 429 or 5xx, and waits on a token-bucket :class:`RateLimiter` so
+that requests stay within NCBI's usage policy: 3 requests per second, or 10
+with an API key.
+
+The transport used by :class:`query.connector.NCBIManager` is configured by
+these settings:
+
+``NCBI_TRANSPORT``
+    Dotted path of the transport class.
+``NCBI_API_KEY``
+    Sent with every request, and raises the default rate to 10/s.
+``NCBI_RATE_LIMIT``
+    Requests per second; overrides the default.
+``NCBI_RATE_LIMIT_FILE``
+    If set, the rate limit is shared through this file by every process on
+    the host, instead of only by the threads of one process.
+``NCBI_MAX_RETRIES``
+    Number of retries for throttled or failed requests.
+"""
+
+import fcntl
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by the threads of one process.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, updated):
+        now = time.time()
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0.
+        return tokens, now, (1 - tokens) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a request may be made.
+        """
+        while True:
+            with self._lock:
+                self._tokens, self._updated, wait = self._take(self._tokens,
+                                                               self._updated)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class FileRateLimiter(RateLimiter):
+    """
+    Token bucket whose state lives in a locked file, so that it is shared by
+    every thread and process that uses the same ``path``.
+    """
+
+    def __init__(self, path, rate, capacity=1):
+        super(FileRateLimiter, self).__init__(rate, capacity)
+        self.path = path
+
+    def acquire(self):
+        while True:
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        tokens, updated = map(float, f.read().split())
+                    except ValueError:
+                        tokens, updated = float(self.capacity), time.time()
+                    tokens, updated, wait = self._take(tokens, updated)
+                    f.seek(0)
+                    f.truncate()
+                    f.write('%r %r' % (tokens, updated))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class Response(object):
+    """
+    File-like response body that decodes gzip transparently. The underlying
+    connection is returned to the pool once the body has been read to the
+    end, and discarded if the response is closed early.
+    """
+
+    def __init__(self, transport, key, conn, response):
+        self.transport = transport
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.closed = False
+        self._buffer = ''
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decoder = None
+
+    def read(self, size=-1):
+        if self.closed:
+            return ''
+        if self._decoder is None:
+            data = self.response.read() if size < 0 else self.response.read(size)
+        else:
+            while size < 0 or len(self._buffer) < size:
+                chunk = self.response.read(8192)
+                if not chunk:
+                    self._buffer += self._decoder.flush()
+                    break
+                self._buffer += self._decoder.decompress(chunk)
+            if size < 0:
+                data, self._buffer = self._buffer, ''
+            else:
+                data, self._buffer = self._buffer[:size], self._buffer[size:]
+        if not data and not self._buffer:
+            self.close()
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.response.isclosed():
+            self.transport.release(self.key, self.conn)
+        else:
+            self.transport.discard(self.key, self.conn)
+
+
+class HTTPTransport(object):
+    """
+    Rate-limited HTTP client with per-thread keep-alive connections.
+    """
+    user_agent = 'django-ncbi'
+
+    def __init__(self, rate_limiter=None, api_key=None, max_retries=5,
+                 backoff=0.5, timeout=60):
+        self.rate_limiter = rate_limiter
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def _pool(self):
+        if not hasattr(self._local, 'pool'):
+            self._local.pool = {}
+        return self._local.pool
+
+    def connection(self, key):
+        scheme, netloc = key
+        if key not in self._pool:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self._pool[key] = [conn, False]
+        conn, busy = self._pool[key]
+        if busy:
+            # The previous response is still being read on this connection;
+            # leave it to that response and open a new one.
+            del self._pool[key]
+            return self.connection(key)
+        self._pool[key][1] = True
+        return conn
+
+    def release(self, key, conn):
+        """
+        Makes ``conn`` available for the next request to the same host.
+        """
+        if key in self._pool and self._pool[key][0] is conn:
+            self._pool[key][1] = False
+
+    def discard(self, key, conn):
+        if key in self._pool and self._pool[key][0] is conn:
+            del self._pool[key]
+        conn.close()
+
+    def close(self):
+        for key, (conn, busy) in self._pool.items():
+            self.discard(key, conn)
+
+    def prepare(self, url):
+        if not self.api_key:
+            return url
+        separator = '&' if '?' in url else '?'
+        return url + separator + urllib.urlencode({'api_key': self.api_key})
+
+    def wait(self, attempt, response=None):
+        delay = self.backoff * (2 ** attempt)
+        if response is not None:
+            retry_after = response.getheader('retry-after')
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        time.sleep(delay)
+
+    def open(self, url):
+        """
+        Requests ``url`` and returns a file-like :class:`Response`. Raises
+        :class:`urllib2.HTTPError` for error statuses, once retries are
+        exhausted.
+        """
+        url = self.prepare(url)
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urlparse.urlunsplit(('', '', parts.path, parts.query, ''))
+        headers = {
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+            'User-Agent': self.user_agent,
+        }
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            conn = self.connection(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as E:
+                # Keep-alive connections may have been closed by the server.
+                self.discard(key, conn)
+                if attempt >= self.max_retries or \
+                        isinstance(E, socket.gaierror):
+                    raise urllib2.URLError(E)
+                self.wait(attempt)
+                attempt += 1
+                continue
+
+            if response.status == 200:
+                return Response(self, key, conn, response)
+
+            response.read()
+            self.release(key, conn)
+            if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                self.wait(attempt, response)
+                attempt += 1
+                continue
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+
+
+def get_rate_limiter(path=None):
+    """
+    Returns a rate limiter configured by settings, shared through ``path``
+    if given.
+    """
+    api_key = getattr(settings, 'NCBI_API_KEY', None)
+    rate = getattr(settings, 'NCBI_RATE_LIMIT', None) or (10 if api_key else 3)
+    path = path or getattr(settings, 'NCBI_RATE_LIMIT_FILE', None)
+    if path:
+        return FileRateLimiter(path, rate)
+    return RateLimiter(rate)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Returns the process-wide transport, configured by settings.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = build_transport(get_rate_limiter())
+    return _transport
+
+
+def build_transport(rate_limiter):
+    """
+    Returns a new transport configured by settings, that waits on
+    ``rate_limiter``.
+    """
+    transport_class = import_string(getattr(
+        settings, 'NCBI_TRANSPORT', 'query.transport.HTTPTransport'))
+    return transport_class(rate_limiter=rate_limiter,
+                           api_key=getattr(settings, 'NCBI_API_KEY', None),
+                           max_retries=getattr(settings, 'NCBI_MAX_RETRIES', 5))
@@ -1,3 +1,23 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
 
-# Create your views here.
+from .metrics import get_metrics
+
+
+def _metrics(request):
+    return HttpResponse(get_metrics().render(),
+                        content_type='text/plain; version=0.0.4')
+
+_staff_metrics = staff_member_required(_metrics)
+
+
+def metrics(request):
+    """
+    Exports the stage metrics of :mod:`query.metrics` for Prometheus. Like
+    the API, they are for staff users only, unless ``NCBI_METRICS_PUBLIC``
+    is set for a scraper that cannot log in.
+    """
+    if getattr(settings, 'NCBI_METRICS_PUBLIC', False):
+        return _metrics(request)
+    return _staff_metrics(request)